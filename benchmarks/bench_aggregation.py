@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Benchmark per-sample clade aggregation: the previous DataFrame.iterrows
+loop against sylph_tax.aggregate.aggregate_clades, and against
+aggregate_nodes over an already interned TaxonomyTree (the steady state of a
+taxprof run, where lineages are interned once by the resolver).
+
+    python benchmarks/bench_aggregation.py --rows 50000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sylph_tax.aggregate import aggregate_clades, aggregate_nodes
+from sylph_tax.taxonomy_tree import TaxonomyTree
+
+
+def make_group(num_rows, seed=0):
+    rng = random.Random(seed)
+    tax_strs = []
+    for i in range(num_rows):
+        tax_strs.append(
+            f"r__Duplodnaviria;k__Heunggongvirae;p__Uroviricota;c__Caudoviricetes;"
+            f"o__O{rng.randrange(20)};f__F{rng.randrange(200)};g__G{rng.randrange(2000)};"
+            f"s__S{i % (num_rows // 2 + 1)};t__IMGVR_UViG_{i:010d}"
+        )
+    return pd.DataFrame(
+        {
+            "tax_str": tax_strs,
+            "Taxonomic_abundance": [rng.random() for _ in range(num_rows)],
+            "Sequence_abundance": [rng.random() for _ in range(num_rows)],
+            "Adjusted_ANI": [95 + rng.random() * 5 for _ in range(num_rows)],
+            "Eff_cov": [rng.random() * 10 for _ in range(num_rows)],
+        }
+    )
+
+
+def legacy_aggregate(group_df):
+    tax_abundance = defaultdict(float)
+    seq_abundance = defaultdict(float)
+    ani_dict = defaultdict(float)
+    cov_dict = defaultdict(float)
+    for idx, row in group_df.iterrows():
+        ani = float(row["Adjusted_ANI"])
+        cov = float(row["Eff_cov"])
+        abundance = float(row["Sequence_abundance"])
+        rel_abundance = float(row["Taxonomic_abundance"])
+        cur_tax = ""
+        for level in row["tax_str"].split(";"):
+            if level == "":
+                level = "UNKNOWN"
+            if cur_tax:
+                cur_tax += "|"
+            cur_tax += level
+            tax_abundance[cur_tax] += rel_abundance
+            seq_abundance[cur_tax] += abundance
+            if "t__" in cur_tax:
+                ani_dict[cur_tax] = ani
+                cov_dict[cur_tax] = cov
+    level_to_key = dict()
+    for key in tax_abundance.keys():
+        level_to_key.setdefault(len(key.split("|")), []).append(key)
+    ordered = []
+    for level in sorted(level_to_key):
+        ordered.extend(
+            sorted(level_to_key[level], key=lambda x: tax_abundance[x], reverse=True)
+        )
+    return ordered, tax_abundance, seq_abundance
+
+
+def columnar_aggregate(group_df):
+    return aggregate_clades(
+        group_df["tax_str"].tolist(),
+        group_df["Taxonomic_abundance"].to_numpy(dtype=float),
+        group_df["Sequence_abundance"].to_numpy(dtype=float),
+        group_df["Adjusted_ANI"].to_numpy(dtype=float),
+        group_df["Eff_cov"].to_numpy(dtype=float),
+    )
+
+
+def node_aggregate(tree, leaves, group_df):
+    return aggregate_nodes(
+        tree,
+        leaves,
+        group_df["Taxonomic_abundance"].to_numpy(dtype=float),
+        group_df["Sequence_abundance"].to_numpy(dtype=float),
+        group_df["Adjusted_ANI"].to_numpy(dtype=float),
+        group_df["Eff_cov"].to_numpy(dtype=float),
+    )
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000, help="Rows per sample")
+    args = parser.parse_args()
+
+    group_df = make_group(args.rows)
+    legacy_time, (ordered, tax_abundance, seq_abundance) = timed(
+        legacy_aggregate, group_df
+    )
+    columnar_time, profile = timed(columnar_aggregate, group_df)
+    tree = TaxonomyTree()
+    leaves = [tree.intern(t) for t in group_df["tax_str"]]
+    node_time, node_profile = timed(node_aggregate, tree, leaves, group_df)
+
+    for p in (profile, node_profile):
+        assert p.clades == ordered
+        assert p.tax_abundance.tolist() == [tax_abundance[c] for c in ordered]
+        assert p.seq_abundance.tolist() == [seq_abundance[c] for c in ordered]
+
+    print(f"rows: {args.rows}, clades: {len(profile)}")
+    print(f"iterrows loop:    {legacy_time:.3f}s")
+    print(f"aggregate_clades: {columnar_time:.3f}s ({legacy_time / columnar_time:.1f}x)")
+    print(f"aggregate_nodes:  {node_time:.3f}s ({legacy_time / node_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Benchmark per-row taxonomy lookup cost with and without key-typed metadata
+sources, on viral-heavy synthetic data.
+
+    python benchmarks/bench_lookup.py --accessions 1000000 --viral-fraction 0.9 --index
+
+Generates data with benchmarks/generate_data.py (or reuses --data-dir) and
+resolves every distinct (Genome_file, Contig_name) pair of the sylph result
+twice: with the IMGVR-style metadata untagged, so every key probes every
+source, and tagged contig-keyed (taxprof --contig-keyed), so genome file keys
+only probe the GTDB-style source and contig keys only the IMGVR-style one.
+Resolutions are checked to be identical; lookup time per pair and per rule
+is reported.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_data import add_generator_options, generate, generator_kwargs
+
+from sylph_tax.metadata_loader import build_index, load_metadata
+from sylph_tax.resolver import resolve_taxonomy
+from sylph_tax.sylph_reader import open_sylph_result, read_sylph_result
+
+
+def distinct_pairs(sylph_result):
+    columns, source = open_sylph_result(sylph_result, warn=False)
+    with source:
+        df = read_sylph_result(source, columns)
+    pairs = df[["Genome_file", "Contig_name"]].drop_duplicates()
+    return list(pairs.itertuples(index=False, name=None)), len(df)
+
+
+def time_lookups(metadata, pairs, repeats):
+    """Best-of-repeats seconds to resolve all pairs, and the resolutions."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        resolutions = [resolve_taxonomy(metadata, g, c) for g, c in pairs]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, resolutions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_generator_options(parser)
+    parser.set_defaults(viral_fraction=0.9)
+    parser.add_argument("--data-dir", help="Reuse (or keep) generated data in this directory")
+    parser.add_argument("--index", action="store_true", help="Look up in compiled indexes instead of in-memory stores")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp()
+    try:
+        if args.data_dir and os.path.exists(os.path.join(data_dir, "sylph_result.tsv")):
+            data = {
+                "metadata": [
+                    os.path.join(data_dir, "gtdb_metadata.tsv.gz"),
+                    os.path.join(data_dir, "imgvr_metadata.tsv.gz"),
+                ],
+                "sylph_result": os.path.join(data_dir, "sylph_result.tsv"),
+            }
+        else:
+            data = generate(data_dir, **generator_kwargs(args))
+        gtdb, imgvr = data["metadata"]
+        if args.index:
+            for file_name in data["metadata"]:
+                build_index(file_name, None)
+
+        pairs, rows = distinct_pairs(data["sylph_result"])
+        timings = dict()
+        results = dict()
+        for name, contig_keyed in (("untagged", None), ("contig-keyed", [imgvr])):
+            with contextlib.redirect_stdout(io.StringIO()):
+                metadata, _ = load_metadata([gtdb, imgvr], None, contig_keyed=contig_keyed)
+            timings[name], results[name] = time_lookups(metadata, pairs, args.repeats)
+
+        assert results["untagged"] == results["contig-keyed"]
+        rules = dict()
+        for resolution in results["untagged"]:
+            rules[resolution.rule] = rules.get(resolution.rule, 0) + 1
+
+        print(
+            f"sylph rows: {rows}, distinct pairs: {len(pairs)}, "
+            f"lookup: {'compiled index' if args.index else 'in-memory store'}"
+        )
+        print("rules: " + ", ".join(f"{rule} {n}" for rule, n in sorted(rules.items())))
+        for name, seconds in timings.items():
+            print(f"{name:>13}: {seconds:.3f}s, {seconds / len(pairs) * 1e6:.2f} us/pair")
+        print(f"speedup: {timings['untagged'] / timings['contig-keyed']:.2f}x")
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Scaling benchmark for sylph-tax merge: the previous iterative outer join
+against the single-pass merge_sylph_taxprof.merge_data.
+
+    python benchmarks/bench_merge.py --samples 100 1000 10000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sylph_tax.merge_sylph_taxprof import column_header, merge_data, read_tsv
+from sylph_tax.profile_io import record_sample_name
+
+
+def write_profiles(out_dir, num_samples, clades_per_sample, clade_pool, seed=0):
+    rng = random.Random(seed)
+    pool = [
+        f"d__Bacteria|p__P{i % 40}|c__C{i % 300}|s__S{i}|t__GCF_{i:09d}.1"
+        for i in range(clade_pool)
+    ]
+    files = []
+    for s in range(num_samples):
+        path = os.path.join(out_dir, f"sample_{s}.sylphmpa")
+        with open(path, "w") as f:
+            f.write(f"#SampleID\tsample_{s}.fq\tTaxonomies_used:['GTDB_r220']\n")
+            f.write(
+                "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\n"
+            )
+            for clade in rng.sample(pool, clades_per_sample):
+                f.write(f"{clade}\t{rng.random()}\t{rng.random()}\t{95 + rng.random() * 5}\t{rng.random()}\n")
+        files.append(path)
+    return files
+
+
+def legacy_merge_data(files, column_name):
+    merged_df = None
+    column_name = column_header(column_name)
+    for file in files:
+        with open(file) as f:
+            sample_name = record_sample_name(f.readline())
+        df = read_tsv(file, column_name)
+        df.rename(columns={column_name: sample_name}, inplace=True)
+        if merged_df is None:
+            merged_df = df
+        else:
+            merged_df = merged_df.join(df, how="outer")
+    merged_df.dropna(how="all", inplace=True)
+    merged_df.fillna(0, inplace=True)
+    return merged_df
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--clades-per-sample", type=int, default=200)
+    parser.add_argument("--clade-pool", type=int, default=20000)
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=1000,
+        help="Only time the legacy join for sample counts up to this value",
+    )
+    args = parser.parse_args()
+
+    print("samples\tlegacy_s\tsingle_pass_s\tspeedup")
+    for num_samples in args.samples:
+        out_dir = tempfile.mkdtemp(prefix="sylph-tax-bench-")
+        try:
+            files = write_profiles(
+                out_dir, num_samples, args.clades_per_sample, args.clade_pool
+            )
+            new_time, merged = timed(merge_data, files, "relative_abundance")
+            if num_samples <= args.legacy_max:
+                legacy_time, legacy = timed(legacy_merge_data, files, "relative_abundance")
+                pd.testing.assert_frame_equal(legacy, merged, check_index_type=False)
+                print(f"{num_samples}\t{legacy_time:.2f}\t{new_time:.2f}\t{legacy_time / new_time:.1f}x")
+            else:
+                print(f"{num_samples}\tskipped\t{new_time:.2f}\t-")
+        finally:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Synthetic scale benchmark for sylph-tax taxprof, profile-matrix and merge.
+
+    python benchmarks/bench_scale.py --accessions 1000000 --samples 10000 --rows-per-sample 50000 --output results.json
+
+Generates data with benchmarks/generate_data.py (or reuses --data-dir), then
+runs every case in a fresh Python process so that peak RSS is per case:
+
+  taxprof         sylph_to_taxprof.main
+  merge           merge_sylph_taxprof.main over the taxprof outputs
+  profile_matrix  profile_matrix.main
+
+Each case runs with a --profile-report style report active, so its per-phase
+timings (metadata loading, reading, resolution, aggregation, writing, ...)
+and counts are included. Results (wall and CPU seconds, peak RSS, data set
+description, versions) are written as JSON so runs can be compared across
+versions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_data import add_generator_options, generate, generator_kwargs
+
+from sylph_tax import profiling
+
+CASES = ("taxprof", "merge", "profile_matrix")
+
+
+def taxprof_args(data, out_dir, **kwargs):
+    args = dict(
+        sylph_results=[data["sylph_result"]],
+        taxonomy_metadata=data["metadata"],
+        taxonomy_dir=None,
+        output_prefix=os.path.join(out_dir, ""),
+        annotate_virus_hosts=False,
+        add_folder_information=False,
+        pavian=False,
+        overwrite=True,
+        threads=1,
+    )
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def run_taxprof(data, out_dir):
+    from sylph_tax.sylph_to_taxprof import main
+
+    main(taxprof_args(data, out_dir), None)
+
+
+def run_merge(data, out_dir):
+    from sylph_tax.merge_sylph_taxprof import main
+
+    files = sorted(
+        os.path.join(data["profiles_dir"], f)
+        for f in os.listdir(data["profiles_dir"])
+        if f.endswith(".sylphmpa")
+    )
+    main(
+        Namespace(
+            files=files,
+            column=["relative_abundance"],
+            format="tsv",
+            output=os.path.join(out_dir, "merged.tsv"),
+        ),
+        None,
+    )
+
+
+def run_profile_matrix(data, out_dir):
+    from sylph_tax.profile_matrix import main
+
+    main(
+        taxprof_args(
+            data,
+            out_dir,
+            column=["relative_abundance"],
+            format="tsv",
+            output=os.path.join(out_dir, "merged.tsv"),
+        ),
+        None,
+    )
+
+
+def run_case(case, data, out_dir):
+    """Run one case in this process and return its profiling report."""
+    runner = globals()["run_" + case]
+    report = profiling.start(case)
+    ### Progress output goes to stderr; the report is the last stdout line
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        runner(data, out_dir)
+    finally:
+        sys.stdout = stdout
+        profiling.stop()
+    return report.to_dict()
+
+
+def run_case_subprocess(case, data, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", case, json.dumps(data), out_dir],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"benchmark case {case} failed with exit code {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    import numpy
+    import pandas
+
+    from sylph_tax.version import __version__
+
+    return {
+        "sylph_tax": __version__,
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--run-case":
+        result = run_case(sys.argv[2], json.loads(sys.argv[3]), sys.argv[4])
+        print(json.dumps(result))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_generator_options(parser)
+    parser.add_argument("--data-dir", help="Generate data here and keep it; reused if it already contains a data set")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--output", default="bench_scale_results.json", help="JSON results file (default: bench_scale_results.json)")
+    args = parser.parse_args()
+
+    work_dir = args.data_dir or tempfile.mkdtemp(prefix="sylph-tax-bench-")
+    info_file = os.path.join(work_dir, "dataset.json")
+    try:
+        if os.path.exists(info_file):
+            with open(info_file) as f:
+                data = json.load(f)
+            print(f"Reusing data set in {work_dir}")
+        else:
+            print(f"Generating data set in {work_dir} ...")
+            start = time.perf_counter()
+            data = generate(work_dir, **generator_kwargs(args))
+            data["config"] = generator_kwargs(args)
+            data["generate_s"] = time.perf_counter() - start
+            with open(info_file, "w") as f:
+                json.dump(data, f)
+
+        results = dict()
+        profiles_dir = os.path.join(work_dir, "runs", "taxprof")
+        data["profiles_dir"] = profiles_dir
+        for case in args.cases:
+            if case == "merge" and not os.path.isdir(profiles_dir):
+                results["taxprof"] = run_case_subprocess("taxprof", data, profiles_dir)
+            print(f"Running {case} ...")
+            out_dir = os.path.join(work_dir, "runs", case)
+            if case != "taxprof":
+                shutil.rmtree(out_dir, ignore_errors=True)
+            results[case] = run_case_subprocess(case, data, out_dir)
+            print(
+                f"  {case}: {results[case]['wall_s']:.2f}s wall, {results[case]['cpu_s']:.2f}s CPU, {results[case]['peak_rss_mib']:.0f} MiB peak RSS"
+            )
+
+        report = {
+            "benchmark": "bench_scale",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": environment(),
+            "dataset": {k: v for k, v in data.items() if k != "profiles_dir"},
+            "cases": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
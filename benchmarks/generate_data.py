@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Generate synthetic sylph results and matching taxonomy metadata at scale.
+
+    python benchmarks/generate_data.py OUT_DIR --accessions 1000000 --samples 10000 --rows-per-sample 50000
+
+Writes OUT_DIR/gtdb_metadata.tsv.gz and OUT_DIR/imgvr_metadata.tsv.gz (GTDB- and
+IMGVR-style accessions, lineages and virus hosts) and OUT_DIR/sylph_result.tsv.
+Prokaryotic rows use GTDB-style Genome_file paths; viral rows come from a single
+IMGVR database fasta with pipe-separated Contig_names. A fraction of rows
+reference genomes missing from the metadata, and a fraction of viral contig
+names contain a stray tab (as in databases built from fasta ids with tabs).
+"""
+
+import argparse
+import gzip
+import os
+import random
+
+SYLPH_COLUMNS = [
+    "Sample_file",
+    "Genome_file",
+    "Taxonomic_abundance",
+    "Sequence_abundance",
+    "Adjusted_ANI",
+    "Eff_cov",
+    "ANI_5-95_percentile",
+    "Eff_lambda",
+    "Lambda_5-95_percentile",
+    "Median_cov",
+    "Mean_cov_geq1",
+    "Containment_ind",
+    "Naive_ANI",
+    "kmers_reassigned",
+    "Contig_name",
+]
+
+IMGVR_DATABASE = "imgvr_reps.fna"
+
+
+def gtdb_accession(i):
+    return f"{'GCF' if i % 3 == 0 else 'GCA'}_{100000000 + i:09d}.1"
+
+
+def imgvr_accession(i):
+    return f"IMGVR_UViG_{3300000000 + i // 1000}_{i % 1000:06d}"
+
+
+def gtdb_lineage(rng):
+    p = rng.randrange(180)
+    c = p * 4 + rng.randrange(4)
+    o = c * 4 + rng.randrange(4)
+    f = o * 4 + rng.randrange(4)
+    g = f * 5 + rng.randrange(5)
+    s = g * 6 + rng.randrange(6)
+    return f"d__Bacteria;p__P{p};c__C{c};o__O{o};f__F{f};g__G{g};s__G{g} sp{s}"
+
+
+def imgvr_lineage(rng):
+    c = rng.randrange(40)
+    f = c * 10 + rng.randrange(10)
+    ### IMGVR lineages often stop above genus level, leaving empty ranks
+    g = f"g__V{f * 20 + rng.randrange(20)}" if rng.random() < 0.5 else ""
+    return f"r__Duplodnaviria;k__Heunggongvirae;p__Uroviricota;c__Caudoviricetes{c};o__;f__F{f};{g}"
+
+
+def gtdb_genome_file(accession):
+    digits = accession[4:13]
+    return (
+        f"gtdb_genomes_reps_r220/database/{accession[:3]}/{digits[:3]}/{digits[3:6]}/"
+        f"{digits[6:9]}/{accession}_genomic.fna.gz"
+    )
+
+
+def write_metadata(out_dir, num_gtdb, num_imgvr, seed=0):
+    """Write the GTDB- and IMGVR-style metadata files; returns their paths."""
+    rng = random.Random(seed)
+    gtdb = os.path.join(out_dir, "gtdb_metadata.tsv.gz")
+    with gzip.open(gtdb, "wt", compresslevel=1) as f:
+        f.write("accession\tgtdb_taxonomy\n")
+        for i in range(num_gtdb):
+            f.write(f"{gtdb_accession(i)}\t{gtdb_lineage(rng)}\n")
+    imgvr = os.path.join(out_dir, "imgvr_metadata.tsv.gz")
+    with gzip.open(imgvr, "wt", compresslevel=1) as f:
+        f.write("accession\ttaxonomy\tvirus_host\n")
+        for i in range(num_imgvr):
+            if rng.random() < 0.3:
+                host = gtdb_lineage(rng)
+            else:
+                host = ""
+            f.write(f"{imgvr_accession(i)}\t{imgvr_lineage(rng)}\t{host}\n")
+    return [gtdb, imgvr]
+
+
+def sylph_row(rng, sample, genome_file, contig_name):
+    ani = 95 + rng.random() * 5
+    cov = rng.random() * 50
+    return (
+        f"{sample}\t{genome_file}\t{rng.random() * 2:.4f}\t{rng.random() * 2:.4f}\t"
+        f"{ani:.2f}\t{cov:.3f}\tNA-NA\tHIGH\tNA-NA\t{int(cov)}\t{cov:.3f}\t"
+        f"{rng.randrange(1, 1000)}/1000\t{ani:.2f}\t0\t{contig_name}\n"
+    )
+
+
+def write_sylph_result(
+    path,
+    num_gtdb,
+    num_imgvr,
+    num_samples,
+    rows_per_sample,
+    unresolved_fraction=0.01,
+    stray_tab_fraction=0.001,
+    seed=0,
+):
+    """Write a multi-sample sylph result; returns the number of rows written."""
+    rng = random.Random(seed + 1)
+    num_accessions = num_gtdb + num_imgvr
+    rows_per_sample = min(rows_per_sample, num_accessions)
+    rows = 0
+    with open(path, "w") as f:
+        f.write("\t".join(SYLPH_COLUMNS) + "\n")
+        for s in range(num_samples):
+            sample = f"reads/sample_{s:05d}_1.fastq.gz"
+            for i in rng.sample(range(num_accessions), rows_per_sample):
+                if rng.random() < unresolved_fraction:
+                    genome_file = f"custom_bins/bin_{i}.fa"
+                    contig_name = f"bin_{i}_contig_1 length=52311"
+                elif i < num_gtdb:
+                    accession = gtdb_accession(i)
+                    genome_file = gtdb_genome_file(accession)
+                    contig_name = f"NZ_JA{i:06d}010000001.1 Bacterium sp. {accession} contig_1"
+                else:
+                    accession = imgvr_accession(i - num_gtdb)
+                    genome_file = IMGVR_DATABASE
+                    contig_name = f"{accession}|{3300000000 + i // 1000}|Ga0{i:07d}_1001"
+                    ### The very first row gets one too, so sylph-tax's check fires
+                    if rows == 0 or rng.random() < stray_tab_fraction:
+                        contig_name += "\tfragment"
+                f.write(sylph_row(rng, sample, genome_file, contig_name))
+                rows += 1
+    return rows
+
+
+def generate(
+    out_dir,
+    accessions,
+    samples,
+    rows_per_sample,
+    viral_fraction=0.5,
+    unresolved_fraction=0.01,
+    stray_tab_fraction=0.001,
+    seed=0,
+):
+    """Generate a complete data set; returns a dict describing it."""
+    os.makedirs(out_dir, exist_ok=True)
+    num_imgvr = int(accessions * viral_fraction)
+    num_gtdb = accessions - num_imgvr
+    metadata = write_metadata(out_dir, num_gtdb, num_imgvr, seed)
+    sylph_result = os.path.join(out_dir, "sylph_result.tsv")
+    rows = write_sylph_result(
+        sylph_result,
+        num_gtdb,
+        num_imgvr,
+        samples,
+        rows_per_sample,
+        unresolved_fraction,
+        stray_tab_fraction,
+        seed,
+    )
+    return {
+        "metadata": metadata,
+        "sylph_result": sylph_result,
+        "metadata_rows": accessions,
+        "sylph_rows": rows,
+        "samples": samples,
+    }
+
+
+def add_generator_options(parser):
+    parser.add_argument("--accessions", type=int, default=100000, help="Metadata accessions (default: 100000)")
+    parser.add_argument("--samples", type=int, default=20, help="Samples in the sylph result (default: 20)")
+    parser.add_argument("--rows-per-sample", type=int, default=5000, help="Sylph rows per sample (default: 5000)")
+    parser.add_argument("--viral-fraction", type=float, default=0.5, help="Fraction of IMGVR-style accessions (default: 0.5)")
+    parser.add_argument("--unresolved-fraction", type=float, default=0.01, help="Fraction of rows without metadata (default: 0.01)")
+    parser.add_argument("--stray-tab-fraction", type=float, default=0.001, help="Fraction of viral rows with a tab in the contig name (default: 0.001)")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generator_kwargs(args):
+    return dict(
+        accessions=args.accessions,
+        samples=args.samples,
+        rows_per_sample=args.rows_per_sample,
+        viral_fraction=args.viral_fraction,
+        unresolved_fraction=args.unresolved_fraction,
+        stray_tab_fraction=args.stray_tab_fraction,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir")
+    add_generator_options(parser)
+    args = parser.parse_args()
+    info = generate(args.out_dir, **generator_kwargs(args))
+    print(f"Wrote {info['sylph_rows']} sylph rows and {info['metadata_rows']} metadata rows to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
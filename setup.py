@@ -7,6 +7,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         "pandas",
+        "numpy",
         "requests",
     ],
     scripts=['bin/sylph-tax'],  # This tells setup.py to install your bin script
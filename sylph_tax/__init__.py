@@ -1 +1,13 @@
 setup = True
+
+### Python API (see sylph_tax/api.py). It is imported on first use, so that the
+### command line tool does not import pandas just by importing sylph_tax.
+__all__ = ["Taxonomy", "SylphTaxError", "profile", "merge"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from sylph_tax import api
+
+        return getattr(api, name)
+    raise AttributeError(f"module 'sylph_tax' has no attribute {name!r}")
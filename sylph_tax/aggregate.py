@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+from sylph_tax.taxonomy_tree import TaxonomyTree
+
+
+def lineage_clades(tax_str):
+    """Output clade names for every prefix of a ;-separated taxonomy string,
+    e.g. 'd__A;;s__B' -> ['d__A', 'd__A|UNKNOWN', 'd__A|UNKNOWN|s__B']."""
+    clades = []
+    cur_tax = ""
+    for level in tax_str.split(";"):
+        if level == "":
+            level = "UNKNOWN"
+        if cur_tax:
+            cur_tax += "|"
+        cur_tax += level
+        clades.append(cur_tax)
+    return clades
+
+
+class CladeProfile:
+    """Aggregated clade table of one sample, already in output order: by clade
+    level, then by decreasing relative abundance (ties keep first-seen order).
+    ani and cov are NaN for clades that are not strain-level (t__)."""
+
+    def __init__(self, clades, tax_abundance, seq_abundance, ani, cov, strain):
+        self.clades = clades
+        self.tax_abundance = tax_abundance
+        self.seq_abundance = seq_abundance
+        self.ani = ani
+        self.cov = cov
+        self.strain = strain
+
+    def __len__(self):
+        return len(self.clades)
+
+    def to_dataframe(self):
+        return pd.DataFrame(
+            {
+                "relative_abundance": self.tax_abundance,
+                "sequence_abundance": self.seq_abundance,
+                "ANI (if strain-level)": self.ani,
+                "Coverage (if strain-level)": self.cov,
+            },
+            index=pd.Index(self.clades, name="clade_name"),
+        )
+
+
+def aggregate_clades(tax_strs, tax_abundance, seq_abundance, ani, cov):
+    """aggregate_nodes over taxonomy strings, interned into a fresh tree."""
+    tree = TaxonomyTree()
+    leaves = [tree.intern(tax_str) for tax_str in tax_strs]
+    return aggregate_nodes(tree, leaves, tax_abundance, seq_abundance, ani, cov)
+
+
+def aggregate_nodes(tree, leaves, tax_abundance, seq_abundance, ani, cov):
+    """Sum per-row abundances into every clade on each row's lineage.
+
+    leaves are the TaxonomyTree nodes of the rows. Rows are grouped by leaf,
+    the ancestor paths of the distinct leaves are exploded into (row, clade)
+    entries, and the sums are taken with np.bincount. bincount accumulates
+    sequentially in row order, so the floating point results are identical to
+    adding row by row. Strain-level clades take the ANI/coverage of the last
+    row that reaches them.
+    """
+    codes, unique_leaves = pd.factorize(np.asarray(leaves, dtype=np.int64), sort=False)
+    paths = [tree.path(leaf) for leaf in unique_leaves]
+    if paths:
+        path_nodes = np.concatenate(paths)
+    else:
+        path_nodes = np.zeros(0, dtype=np.int64)
+
+    ### Number the sample's clades in first-seen order, which breaks abundance ties
+    nodes, first, inverse = np.unique(
+        path_nodes, return_index=True, return_inverse=True
+    )
+    seen_order = np.argsort(first, kind="stable")
+    local_ids = np.empty(len(nodes), dtype=np.int64)
+    local_ids[seen_order] = np.arange(len(nodes))
+    clade_nodes = nodes[seen_order]
+    flat_paths = local_ids[inverse]
+    num_clades = len(clade_nodes)
+
+    lengths = np.array([len(p) for p in paths], dtype=np.int64)
+    path_starts = np.cumsum(lengths) - lengths
+
+    row_lengths = lengths[codes]
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    num_entries = int(row_lengths.sum())
+    within = np.arange(num_entries) - np.repeat(row_starts, row_lengths)
+    exploded = flat_paths[np.repeat(path_starts[codes], row_lengths) + within]
+    entry_rows = np.repeat(np.arange(len(codes)), row_lengths)
+
+    tax_sum = np.bincount(
+        exploded,
+        weights=np.repeat(np.asarray(tax_abundance, dtype=float), row_lengths),
+        minlength=num_clades,
+    )
+    seq_sum = np.bincount(
+        exploded,
+        weights=np.repeat(np.asarray(seq_abundance, dtype=float), row_lengths),
+        minlength=num_clades,
+    )
+
+    ### Last row reaching each clade: first occurrence in the reversed entries
+    last_row = np.empty(num_clades, dtype=np.int64)
+    uniq, first = np.unique(exploded[::-1], return_index=True)
+    last_row[uniq] = entry_rows[::-1][first]
+
+    strain = np.array([tree.strain[n] for n in clade_nodes], dtype=bool)
+    clade_ani = np.where(strain, np.asarray(ani, dtype=float)[last_row], np.nan)
+    clade_cov = np.where(strain, np.asarray(cov, dtype=float)[last_row], np.nan)
+
+    levels = np.array([tree.depth[n] for n in clade_nodes], dtype=np.int64)
+    order = np.lexsort((np.arange(num_clades), -tax_sum, levels))
+
+    return CladeProfile(
+        tree.labels(clade_nodes[order]),
+        tax_sum[order],
+        seq_sum[order],
+        clade_ani[order],
+        clade_cov[order],
+        strain[order],
+    )
@@ -0,0 +1,168 @@
+import io
+import os
+import sys
+from argparse import Namespace
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from sylph_tax.aggregate import CladeProfile
+from sylph_tax.json_config import JsonConfig, default_config_location
+from sylph_tax.merge_sylph_taxprof import MERGE_COLUMNS, CladeMatrixBuilder, column_header
+from sylph_tax.profile_matrix import PROFILE_COLUMNS
+from sylph_tax.sylph_reader import iter_dataframe_groups, iter_sample_groups, open_sylph_result
+from sylph_tax.sylph_to_taxprof import format_virus_host, load_run_metadata, profile_sample
+
+VIRUS_HOST_COLUMN = "Virus_host (if viral)"
+
+
+class SylphTaxError(Exception):
+    """Raised by the Python API where the command line tool prints an error
+    and exits."""
+
+
+class _Tee(io.StringIO):
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+        return super().write(text)
+
+
+@contextmanager
+def _cli_errors(verbose):
+    """Run code shared with the command line tool. Its progress messages are
+    only printed if verbose, and an exit becomes a SylphTaxError carrying the
+    error messages."""
+    buffer = _Tee(sys.stdout) if verbose else io.StringIO()
+    try:
+        with redirect_stdout(buffer):
+            yield
+    except SystemExit as e:
+        errors = [line for line in buffer.getvalue().splitlines() if line.startswith("ERROR")]
+        raise SylphTaxError("\n".join(errors) or f"sylph-tax exited with status {e.code}") from None
+
+
+class Taxonomy:
+    """Taxonomy metadata loaded once, for profiling any number of sylph results.
+
+        taxonomy = Taxonomy(["GTDB_r226", "my_taxonomy.tsv"])
+        profiles = taxonomy.profile("sylph_result.tsv")
+        table = merge(profiles)
+
+    metadata are pre-built taxonomy names, found in taxonomy_dir or the
+    directory configured by 'sylph-tax download' (unless use_config is False),
+    and/or custom metadata files. If sylph_results are given, only the
+    accessions they can reach are loaded, as taxprof does; the Taxonomy then
+    only resolves those results. With verbose, the messages taxprof would
+    print (metadata loading, unresolved genomes, ...) are printed.
+    contig_keyed lists the custom metadata files keyed by contig, as taxprof
+    --contig-keyed does."""
+
+    def __init__(
+        self,
+        metadata,
+        taxonomy_dir=None,
+        use_config=True,
+        sylph_results=None,
+        verbose=False,
+        contig_keyed=None,
+    ):
+        if isinstance(metadata, (str, os.PathLike)):
+            metadata = [metadata]
+        self.taxonomy_metadata = [str(m) for m in metadata]
+        self.verbose = verbose
+        with _cli_errors(verbose):
+            config = None
+            if use_config and taxonomy_dir is None:
+                try:
+                    config = JsonConfig(default_config_location())
+                except ValueError:
+                    print(f"WARNING: Could not load config file at '{default_config_location()}'.")
+            args = Namespace(
+                taxonomy_metadata=self.taxonomy_metadata,
+                taxonomy_dir=None if taxonomy_dir is None else str(taxonomy_dir),
+                no_config=config is None,
+                sylph_results=[str(f) for f in sylph_results or []],
+                contig_keyed=[str(f) for f in contig_keyed or []],
+            )
+            self.resolver, self.metadata_files = load_run_metadata(args, config)
+
+    def _sample_groups(self, sylph_result):
+        if isinstance(sylph_result, pd.DataFrame):
+            df = sylph_result
+            if "Sample_file" in df.columns:
+                df = df.assign(Sample_file=df["Sample_file"].astype(str))
+            return iter_dataframe_groups(df)
+        sylph_result = str(sylph_result)
+        columns, source = open_sylph_result(sylph_result)
+        return iter_sample_groups(sylph_result, columns, source=source)
+
+    def profile(self, sylph_result, annotate_virus_hosts=False, as_frame=True):
+        """Profile every sample of a sylph result, given as a path (gzipped, or
+        '-' for standard input) or as a DataFrame read from one. Returns
+        {Sample_file: profile} in taxprof's sample order.
+
+        A profile is a DataFrame with the rows and columns of the sample's
+        .sylphmpa file: clade_name index, relative_abundance,
+        sequence_abundance, and ANI/Coverage (NaN above strain level), plus the
+        virus host column (NaN where there is none) with annotate_virus_hosts.
+        With as_frame=False it is the CladeProfile (clades list and numpy
+        arrays) instead."""
+        profiles = dict()
+        with _cli_errors(self.verbose):
+            for sample_file, group_df in self._sample_groups(sylph_result):
+                messages = []
+                profile = profile_sample(group_df, self.resolver, self.metadata_files, messages)
+                for message in messages:
+                    print(message)
+                if as_frame:
+                    profile = self.profile_frame(profile, annotate_virus_hosts)
+                profiles[sample_file] = profile
+        return profiles
+
+    def profile_frame(self, profile, annotate_virus_hosts=False):
+        df = profile.to_dataframe()
+        if annotate_virus_hosts:
+            metadata = self.resolver.metadata
+            hosts = []
+            for clade, strain in zip(profile.clades, profile.strain.tolist()):
+                host = metadata.get_additional_data(clade.split("t__")[-1]) if strain else None
+                hosts.append(np.nan if host is None else format_virus_host(host))
+            df[VIRUS_HOST_COLUMN] = hosts
+        return df
+
+
+def profile(sylph_result, taxonomy, **kwargs):
+    """Taxonomy.profile with a loaded Taxonomy, or with metadata names/paths
+    that are loaded for this call only."""
+    if not isinstance(taxonomy, Taxonomy):
+        sylph_results = None if isinstance(sylph_result, pd.DataFrame) else [sylph_result]
+        taxonomy = Taxonomy(taxonomy, sylph_results=sylph_results)
+    return taxonomy.profile(sylph_result, **kwargs)
+
+
+def merge(profiles, column="relative_abundance"):
+    """Merge in-memory profiles into one clades x samples DataFrame, as
+    'sylph-tax merge' does for .sylphmpa files. profiles is a {sample: profile}
+    dict (e.g. from profile(), possibly of several results merged) or an
+    iterable of (sample, profile) pairs; profiles are DataFrames or
+    CladeProfiles."""
+    if column not in MERGE_COLUMNS:
+        raise SylphTaxError(f"Unknown column {column}; choose from {', '.join(MERGE_COLUMNS)}")
+    if isinstance(profiles, dict):
+        profiles = profiles.items()
+    header = column_header(column)
+    builder = CladeMatrixBuilder()
+    for sample, sample_profile in profiles:
+        if isinstance(sample_profile, CladeProfile):
+            clades = sample_profile.clades
+            values = getattr(sample_profile, PROFILE_COLUMNS[column])
+        else:
+            clades = sample_profile.index.tolist()
+            values = sample_profile[header].to_numpy(dtype=float)
+        builder.add_sample(sample, clades, values)
+    return builder.to_dataframe()
@@ -0,0 +1,69 @@
+import json
+import os
+import socket
+import sys
+
+### Kept free of numpy/pandas imports so that submitting to a running server
+### starts quickly (see sylph_tax/server.py for the server side).
+
+### taxprof options sent with a profiling request
+REQUEST_OPTIONS = (
+    "sylph_results",
+    "output_prefix",
+    "annotate_virus_hosts",
+    "add_folder_information",
+    "pavian",
+    "overwrite",
+    "compress",
+    "precision",
+    "consolidated",
+    "stream",
+    "chunk_rows",
+)
+
+
+def send_request(socket_path, request):
+    """Send one JSON request to a server and return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("the server closed the connection without a response")
+    return json.loads(line)
+
+
+def server_is_running(socket_path):
+    try:
+        send_request(socket_path, {"command": "ping"})
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def client_request(socket_path, request):
+    """Send a request, print the server's output and exit with its code."""
+    try:
+        response = send_request(socket_path, request)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Could not reach a sylph-tax server on {socket_path}: {e}")
+        sys.exit(1)
+    sys.stdout.write(response["output"])
+    if response["exit_code"]:
+        sys.exit(response["exit_code"])
+
+
+def stop(socket_path):
+    client_request(socket_path, {"command": "stop"})
+
+
+def main(args, config):
+    """Profile sylph results on a running 'sylph-tax serve' server."""
+    if "-" in args.sylph_results:
+        print("ERROR: submit cannot read sylph results from standard input; the server reads the files.")
+        sys.exit(1)
+    request = {key: getattr(args, key) for key in REQUEST_OPTIONS}
+    request["command"] = "taxprof"
+    request["cwd"] = os.getcwd()
+    client_request(args.socket, request)
@@ -1,11 +1,52 @@
+import gzip
+import http.client
 import json
 import os
 import sys
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 from sylph_tax.version import __version__
-from sylph_tax.metadata_files import __metadata_file_urls__
+from sylph_tax.metadata_files import __metadata_file_urls__, __name_to_metadata_file__
+
+
+### Bytes read per network read while downloading.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def urls_for_names(names):
+    """Download URLs of pre-built taxonomies selected by name (see
+    __name_to_metadata_file__), in the order given. Exits on unknown names."""
+    urls = []
+    for name in names:
+        if name not in __name_to_metadata_file__:
+            print(
+                f"ERROR: Unknown taxonomy {name}. Available taxonomies: [{', '.join(__name_to_metadata_file__.keys())}]"
+            )
+            sys.exit(1)
+        file_name = __name_to_metadata_file__[name]
+        url = next(u for u in __metadata_file_urls__ if u.split("/")[-1] == file_name)
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def verify_download(path, filename):
+    """Check the integrity of a gzipped download by reading it to the end,
+    which validates the gzip CRC and length trailer."""
+    if not filename.endswith(".gz"):
+        return
+    with gzip.open(path, "rb") as f:
+        while f.read(DOWNLOAD_CHUNK_SIZE):
+            pass
 
 
 class SylphTaxDownloader:
@@ -15,37 +56,134 @@ class SylphTaxDownloader:
         else:
             self.taxonomy_location = db_location
 
-    def download_file(self, url: str) -> Path:
-        """Download a file from Zenodo with simple progress reporting."""
+    def _fetch(self, url, part_path, show_progress):
+        """One request for the rest of a file, appending to part_path if the
+        server honours the Range header."""
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            ### The range starts past the end: the partial file is unusable
+            part_path.unlink()
+            raise IncompleteDownload("server rejected the resume request")
+        with response:
+            if response.status == 206:
+                ### Content-Range: bytes <start>-<end>/<total>
+                byte_range, total = response.headers["Content-Range"].split("/")
+                if int(byte_range.split()[-1].split("-")[0]) != offset:
+                    part_path.unlink()
+                    raise IncompleteDownload("server resumed at the wrong offset")
+                total = int(total)
+                mode = "ab"
+            else:
+                offset = 0
+                length = response.headers.get("Content-Length")
+                total = int(length) if length is not None else None
+                mode = "wb"
+            received = offset
+            with open(part_path, mode) as f:
+                while True:
+                    data = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    received += len(data)
+                    if show_progress and total:
+                        print(f"\rProgress: {received * 100 / total:.1f}%", end="")
+        if total is not None and received != total:
+            raise IncompleteDownload(f"received {received} of {total} bytes")
+
+    def download_file(self, url: str, show_progress=True, force=False) -> Path:
+        """Download a file from Zenodo into <name>.part, resuming a previous
+        partial download with an HTTP Range request and retrying dropped
+        connections. The file is verified and renamed into place only once it
+        is complete, so an existing file is always a finished download and is
+        skipped unless force is set."""
         filename = url.split("/")[-1]
         output_path = Path(self.taxonomy_location) / filename
+        part_path = output_path.with_name(filename + ".part")
 
-        print(f"Downloading {filename}...")
-
-        try:
-            urllib.request.urlretrieve(
-                url,
-                output_path,
-                lambda count, block_size, total_size: print(
-                    f"\rProgress: {count * block_size * 100 / total_size:.1f}%", end=""
-                ),
-            )
-            print("\nDownload complete!")
+        if output_path.exists() and not force:
+            print(f"{filename} is already downloaded; skipping.")
             return output_path
+        if force and part_path.exists():
+            part_path.unlink()
 
+        if part_path.exists():
+            print(f"Resuming {filename} from {part_path.stat().st_size} bytes...")
+        else:
+            print(f"Downloading {filename}...")
+
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                self._fetch(url, part_path, show_progress)
+                break
+            except (IncompleteDownload, http.client.HTTPException, OSError) as e:
+                if isinstance(e, urllib.error.HTTPError) or attempt == DOWNLOAD_RETRIES:
+                    print(f"\nError downloading {filename}: {e}", file=sys.stderr)
+                    raise
+                print(f"\nConnection problem downloading {filename} ({e}); resuming...")
+
+        try:
+            verify_download(part_path, filename)
         except Exception as e:
-            print(f"\nError downloading {filename}: {e}", file=sys.stderr)
-            if output_path.exists():
-                output_path.unlink()
+            print(f"\nError downloading {filename}: corrupt download ({e})", file=sys.stderr)
+            part_path.unlink()
             raise
+        os.replace(part_path, output_path)
+        if show_progress:
+            print("\nDownload complete!")
+        else:
+            print(f"Downloaded {filename}.")
+        return output_path
+
+    def download_taxonomy(self, urls: List[str], threads=1, force=False) -> List[Path]:
+        """Download multiple files from a list of URLs, with up to threads
+        downloads running at once. Returns the paths in the order of urls."""
+        if threads <= 1 or len(urls) <= 1:
+            return [self.download_file(url, force=force) for url in urls]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [
+                executor.submit(self.download_file, url, False, force) for url in urls
+            ]
+            errors = [f.exception() for f in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return [f.result() for f in futures]
+
+    def index_taxonomy(self, paths: List[Path], force=False) -> List[Path]:
+        """Compile a binary index for each downloaded metadata file, unless
+        its index is current."""
+        ### Imported here: indexing needs numpy, downloading does not
+        from sylph_tax.metadata_loader import build_index
+
+        index_paths = []
+        for path in paths:
+            index_file, rebuilt = build_index(str(path), None, force=force)
+            if rebuilt:
+                print(f"Compiled index for {path.name}.")
+            else:
+                print(f"Index for {path.name} is up to date.")
+            index_paths.append(index_file)
+        return index_paths
+
 
-    def download_taxonomy(self, urls: List[str]) -> List[Path]:
-        """Download multiple files from a list of URLs."""
-        downloaded_paths = []
-        for url in urls:
-            path = self.download_file(url)
-            downloaded_paths.append(path)
-        return downloaded_paths
+def download_and_index(downloader, args):
+    only = getattr(args, "only", None)
+    urls = urls_for_names(only) if only else __metadata_file_urls__
+    paths = downloader.download_taxonomy(
+        urls,
+        threads=getattr(args, "threads", 1),
+        force=getattr(args, "force", False),
+    )
+    if not getattr(args, "no_index", False):
+        downloader.index_taxonomy(paths, force=getattr(args, "force", False))
 
 
 def main(args, config):
@@ -66,7 +204,7 @@ def main(args, config):
         # download without config
         os.makedirs(download_dest, exist_ok=True)
         downloader = SylphTaxDownloader(download_dest)
-        downloader.download_taxonomy(__metadata_file_urls__)
+        download_and_index(downloader, args)
         print(
             f"DOWNLOAD: Taxonomy metadata files have been downloaded to {download_dest}."
         )
@@ -84,7 +222,7 @@ def main(args, config):
         os.makedirs(download_dest, exist_ok=True)
         config.set_taxonomy_dir(download_dest)
         downloader = SylphTaxDownloader(download_dest)
-        downloader.download_taxonomy(__metadata_file_urls__)
+        download_and_index(downloader, args)
         print(
             f"DOWNLOAD: Taxonomy metadata files have been downloaded to {download_dest}."
         )
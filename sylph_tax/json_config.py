@@ -1,7 +1,19 @@
 import json
+import os
+import tempfile
 from pathlib import Path
+from sylph_tax.metadata_files import __tax_env_variable__
 from sylph_tax.version import __version__
 
+
+def default_config_location() -> Path:
+    """$SYLPH_TAXONOMY_CONFIG, or ~/.config/sylph-tax/config.json."""
+    env_config_loc = os.environ.get(__tax_env_variable__)
+    if env_config_loc:
+        return Path(env_config_loc)
+    return Path('~/.config/sylph-tax/config.json').expanduser()
+
+
 class JsonConfig:
 
     def __init__(self, config_location):
@@ -21,31 +33,41 @@ class JsonConfig:
         config_dir.parent.mkdir(parents=True, exist_ok=True)
 
     def _load_config(self, config_location) -> dict:
-        """Load or create config file."""
-        self._make_config_dir(config_location)
+        """Load the config file, or the default config if there is none yet.
 
-        if config_location.exists():
+        Loading never touches the file system beyond reading: the file (and its
+        directory) is only created when a setting is saved, so many concurrent
+        runs can share one config without racing to create it."""
+        try:
             with open(config_location) as f:
                 return json.load(f)
+        except FileNotFoundError:
+            pass
 
         # Default config
-        default_config = {
+        return {
             'version': __version__,
             'taxonomy_dir': "NONE"
         }
 
-        # Save default config
-        with open(config_location, 'w') as f:
-            json.dump(default_config, f, indent=2)
-
-        return default_config
+    def _save_config(self) -> None:
+        """Write the config atomically, so concurrent readers never see a
+        partially written file."""
+        self._make_config_dir(self.config_location)
+        config_dir = Path(self.config_location).parent
+        fd, tmp_path = tempfile.mkstemp(dir=config_dir, prefix='.config.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.json, f, indent=2)
+            os.replace(tmp_path, self.config_location)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     def set_taxonomy_dir(self, path: str) -> None:
         """Set and save custom database directory."""
         abs_path = Path(path).absolute()
         self.json['taxonomy_dir'] = str(abs_path)
-
-        with open(self.config_location, 'w') as f:
-            json.dump(self.json, f, indent=2)
+        self._save_config()
 
 
@@ -1,40 +1,472 @@
 #!/usr/bin/env python3
 
-import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 
+from sylph_tax import profiling
+from sylph_tax.profile_io import (
+    as_buffer,
+    is_compressed,
+    iter_profile_texts,
+    record_sample_name,
+    require_compression,
+    split_profile_texts,
+)
+from sylph_tax.taxonomy_index import file_fingerprint
+from sylph_tax.version import __version__
+
+MERGE_COLUMNS = ['relative_abundance', 'sequence_abundance', 'ANI', 'Coverage']
+### Sidecar of a merged tsv table listing its samples and the fingerprints of
+### the files they were read from, so that 'merge --update' can skip files
+### that are already merged without parsing them.
+MANIFEST_SUFFIX = '.manifest.json'
+
 def read_tsv(file_path, column_name):
-    df = pd.read_csv(file_path, sep='\t', usecols=['clade_name', column_name], dtype={column_name: float}, comment='#')
+    """Read the clade_name column and one (or a list of) value columns."""
+    column_names = [column_name] if isinstance(column_name, str) else list(column_name)
+    df = pd.read_csv(file_path, sep='\t', usecols=['clade_name'] + column_names, dtype={c: float for c in column_names}, comment='#')
     df.set_index('clade_name', inplace=True)
     return df
 
-def merge_data(files, column_name):
-    merged_df = None
+def as_read_back(values):
+    """Profile values as read_tsv parses them from a .sylphmpa file. The
+    default pandas float parser can be one unit in the last place off the
+    written value, and merge has always used it."""
+    if len(values) == 0:
+        return np.asarray(values, dtype=float)
+    text = '\n'.join(map(str, np.asarray(values, dtype=float).tolist()))
+    return pd.read_csv(as_buffer(text), header=None, dtype=float).iloc[:, 0].to_numpy()
+
+def column_header(column_name):
     if column_name == 'ANI':
-        column_name = 'ANI (if strain-level)'
+        return 'ANI (if strain-level)'
     elif column_name == 'Coverage':
-        column_name = 'Coverage (if strain-level)'
+        return 'Coverage (if strain-level)'
+    return column_name
+
+class CladeMatrixBuilder:
+    """Accumulates (clade, sample, value) triplets against one global clade
+    dictionary and builds the merged matrix in a single step. Builders for
+    different columns of the same files can share their clade dictionary."""
+
+    def __init__(self, clade_ids=None):
+        if clade_ids is None:
+            clade_ids = dict()
+        self.clade_ids = clade_ids
+        self.samples = []
+        ### Membership checks of samples, which can number in the tens of thousands
+        self.sample_set = set()
+        self.rows = []
+        self.cols = []
+        self.values = []
+
+    def add_sample(self, sample_name, clades, values):
+        if sample_name in self.sample_set:
+            raise ValueError(f"columns overlap but no suffix specified: {sample_name}")
+        col = len(self.samples)
+        self.samples.append(sample_name)
+        self.sample_set.add(sample_name)
+        clade_ids = self.clade_ids
+        self.rows.append(np.fromiter(
+            (clade_ids.setdefault(c, len(clade_ids)) for c in clades),
+            dtype=np.int64, count=len(clades)))
+        self.cols.append(np.full(len(clades), col, dtype=np.int64))
+        self.values.append(np.asarray(values, dtype=float))
+
+    def add_dense(self, sample_names, clades, matrix):
+        """Add the samples of an already merged dense table (clades x samples)
+        as merging their profiles again would. Zero entries are not stored, but
+        every clade of the table is kept."""
+        for sample_name in sample_names:
+            if sample_name in self.sample_set:
+                raise ValueError(f"columns overlap but no suffix specified: {sample_name}")
+        if not sample_names:
+            return
+        col = len(self.samples)
+        self.samples.extend(sample_names)
+        self.sample_set.update(sample_names)
+        clade_ids = self.clade_ids
+        ids = np.fromiter(
+            (clade_ids.setdefault(c, len(clade_ids)) for c in clades),
+            dtype=np.int64, count=len(clades))
+        rows, cols = np.nonzero(matrix)
+        ### A clade that is zero in every sample keeps one explicit zero entry
+        zero_rows = np.flatnonzero(~matrix.any(axis=1))
+        self.rows.append(np.concatenate([ids[rows], ids[zero_rows]]))
+        self.cols.append(np.concatenate([cols + col, np.full(len(zero_rows), col, dtype=np.int64)]))
+        self.values.append(np.concatenate([matrix[rows, cols], np.zeros(len(zero_rows))]))
+
+    def clade_order(self):
+        """Row order of the merged table. A single profile keeps its own order;
+        merging several sorts the clade union, as an outer join does."""
+        clades = list(self.clade_ids)
+        if len(self.samples) == 1:
+            return clades
+        return sorted(clades)
+
+    def entries(self):
+        """(clade index, sample index, value) arrays over every parsed entry in
+        input order, with clade indices referring to clade_order()."""
+        order = self.clade_order()
+        remap = np.empty(len(self.clade_ids), dtype=np.int64)
+        remap[[self.clade_ids[c] for c in order]] = np.arange(len(order))
+        if not self.rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return order, empty, empty, np.zeros(0)
+        rows = remap[np.concatenate(self.rows)]
+        cols = np.concatenate(self.cols)
+        values = np.concatenate(self.values)
+        return order, rows, cols, values
+
+    def triplets(self):
+        """Like entries(), restricted to non-missing values."""
+        order, rows, cols, values = self.entries()
+        present = ~np.isnan(values)
+        return order, rows[present], cols[present], values[present]
+
+    def sparse(self):
+        """(clades, samples, rows, cols, values) of the merged table without
+        densifying it. Clades that are missing or NaN in every sample are
+        dropped (dropna(how="all")); entries are sorted by clade, then sample."""
+        order, rows, cols, values = self.triplets()
+        keep = np.zeros(len(order), dtype=bool)
+        keep[rows] = True
+        compact = np.cumsum(keep) - 1
+        clades = [c for c, k in zip(order, keep) if k]
+        rows = compact[rows]
+        entry_order = np.lexsort((cols, rows))
+        return clades, list(self.samples), rows[entry_order], cols[entry_order], values[entry_order]
+
+    def to_dataframe(self):
+        clades, samples, rows, cols, values = self.sparse()
+        matrix = np.zeros((len(clades), len(samples)))
+        matrix[rows, cols] = values
+        index = pd.Index(clades, name='clade_name', dtype=object)
+        return pd.DataFrame(matrix, index=index, columns=samples)
+
+def write_matrix_market(output_file, clades, samples, rows, cols, values):
+    """Coordinate Matrix Market file (1-based, clades x samples) plus
+    <output>.clades.txt and <output>.samples.txt label files."""
+    nonzero = values != 0
+    rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+    with open(output_file, 'w') as f:
+        f.write("%%MatrixMarket matrix coordinate real general\n")
+        f.write(f"{len(clades)} {len(samples)} {len(values)}\n")
+        f.writelines(f"{r + 1} {c + 1} {v}\n" for r, c, v in zip(rows.tolist(), cols.tolist(), values.tolist()))
+    with open(f"{output_file}.clades.txt", 'w') as f:
+        f.writelines(f"{c}\n" for c in clades)
+    with open(f"{output_file}.samples.txt", 'w') as f:
+        f.writelines(f"{s}\n" for s in samples)
+    return [output_file, f"{output_file}.clades.txt", f"{output_file}.samples.txt"]
+
+def write_biom(output_file, clades, samples, rows, cols, values):
+    """BIOM 1.0 (JSON) sparse table; observations are clades."""
+    nonzero = values != 0
+    rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+    header = {
+        "id": None,
+        "format": "Biological Observation Matrix 1.0.0",
+        "format_url": "http://biom-format.org",
+        "type": "Taxon table",
+        "generated_by": f"sylph-tax {__version__}",
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "matrix_type": "sparse",
+        "matrix_element_type": "float",
+        "shape": [len(clades), len(samples)],
+    }
+    with open(output_file, 'w') as f:
+        f.write(json.dumps(header)[:-1])
+        f.write(', "rows": [')
+        f.write(", ".join(json.dumps({"id": c, "metadata": None}) for c in clades))
+        f.write('], "columns": [')
+        f.write(", ".join(json.dumps({"id": s, "metadata": None}) for s in samples))
+        f.write('], "data": [')
+        for i, (r, c, v) in enumerate(zip(rows.tolist(), cols.tolist(), values.tolist())):
+            if i:
+                f.write(", ")
+            f.write(f"[{r}, {c}, {v!r}]")
+        f.write("]}\n")
+    return [output_file]
+
+def write_long(output_file, column_name, clades, samples, rows, cols, values):
+    """Long/tidy TSV with one (clade_name, sample, value) row per non-zero entry."""
+    nonzero = values != 0
+    rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+    with open(output_file, 'w') as f:
+        f.write(f"clade_name\tsample\t{column_name}\n")
+        f.writelines(
+            f"{clades[r]}\t{samples[c]}\t{v}\n"
+            for r, c, v in zip(rows.tolist(), cols.tolist(), values.tolist())
+        )
+    return [output_file]
+
+def write_long_multi(output_file, builders, column_names):
+    """Long TSV with one row per (clade_name, sample) and one value column per
+    merged column; missing values are written as NA."""
+    order, rows, cols, _ = builders[column_names[0]].entries()
+    ### Every builder saw the same clades of the same files, so entries align
+    values = np.column_stack([builders[c].entries()[3] for c in column_names]) if len(rows) else np.zeros((0, len(column_names)))
+    keep = np.any(~np.isnan(values) & (values != 0), axis=1)
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    entry_order = np.lexsort((cols, rows))
+    samples = builders[column_names[0]].samples
+    with open(output_file, 'w') as f:
+        f.write("clade_name\tsample\t" + "\t".join(column_names) + "\n")
+        for r, c, vals in zip(rows[entry_order].tolist(), cols[entry_order].tolist(), values[entry_order].tolist()):
+            formatted = "\t".join("NA" if v != v else str(v) for v in vals)
+            f.write(f"{order[r]}\t{samples[c]}\t{formatted}\n")
+    return [output_file]
+
+def iter_profile_sources(files):
+    """(sample name, readable source) for every profile in the inputs;
+    consolidated and compressed files are split into their sample records.
+    Consolidated files are recognized by their records, so their index is not
+    needed."""
     for file in files:
-        with open(file) as f:
-            first_line = f.readline()
-            sample_name = first_line.split('\t')[1].strip()
-        df = read_tsv(file, column_name)
-        df.rename(columns={column_name: sample_name}, inplace=True)
-        if merged_df is None:
-            merged_df = df
+        if is_compressed(file):
+            for text in iter_profile_texts(file):
+                yield record_sample_name(text), as_buffer(text)
         else:
-            merged_df = merged_df.join(df, how='outer')
-    merged_df.dropna(how="all", inplace=True)
-    merged_df.fillna(0, inplace=True)
+            with open(file) as f:
+                text = f.read()
+            for record in split_profile_texts(text):
+                yield record_sample_name(record), as_buffer(record)
 
-    return merged_df
+def build_matrices(files, column_names, builders=None):
+    """Parse every file once, filling one builder per requested column (new
+    ones sharing a clade dictionary, or the given builders)."""
+    headers = [column_header(c) for c in column_names]
+    if builders is None:
+        clade_ids = dict()
+        builders = {c: CladeMatrixBuilder(clade_ids) for c in column_names}
+    clade_ids = builders[column_names[0]].clade_ids
+    for sample_name, source in profiling.timed(iter_profile_sources(files), 'read'):
+        with profiling.phase('parse'):
+            df = read_tsv(source, headers)
+        with profiling.phase('build'):
+            clades = df.index.tolist()
+            for column_name, header in zip(column_names, headers):
+                builders[column_name].add_sample(sample_name, clades, df[header].to_numpy())
+        profiling.count('samples')
+        profiling.count('rows', len(clades))
+    profiling.count('files', len(files))
+    profiling.count('clades', len(clade_ids))
+    return builders
+
+def build_matrix(files, column_name):
+    return build_matrices(files, [column_name])[column_name]
+
+def merge_data(files, column_name):
+    return build_matrix(files, column_name).to_dataframe()
+
+def write_merged(builder, output_file, output_format, column_name):
+    """Write a merged table in the requested format; returns the files written.
+    Sparse formats are written from the triplets without densifying."""
+    if output_format == 'tsv':
+        builder.to_dataframe().to_csv(output_file, sep='\t')
+        return [output_file]
+    sparse = builder.sparse()
+    if output_format == 'mtx':
+        return write_matrix_market(output_file, *sparse)
+    elif output_format == 'biom':
+        return write_biom(output_file, *sparse)
+    elif output_format == 'long':
+        return write_long(output_file, column_name, *sparse)
+    raise ValueError(f"Unknown merge output format: {output_format}")
+
+def default_output_file(output_format):
+    """Output name without -o: merged_data with the suffix of the format."""
+    suffix = {'mtx': '.mtx', 'biom': '.biom'}.get(output_format, '.tsv')
+    return f"merged_data{suffix}"
+
+def column_output_file(output_file, column_name):
+    """merged_data.tsv -> merged_data.<column>.tsv"""
+    path = Path(output_file)
+    return str(path.with_name(f"{path.stem}.{column_name}{path.suffix}"))
+
+def requested_columns(column_args):
+    """Expand the --column arguments ('all' or repeated names) in order."""
+    if isinstance(column_args, str):
+        column_args = [column_args]
+    columns = []
+    for column_name in column_args:
+        for c in MERGE_COLUMNS if column_name == 'all' else [column_name]:
+            if c not in columns:
+                columns.append(c)
+    return columns
+
+def write_merged_columns(builders, columns, output_file, output_format):
+    """Write the tables of every merged column; returns the files written."""
+    with profiling.phase('write'):
+        if len(columns) == 1:
+            written = write_merged(builders[columns[0]], output_file, output_format, columns[0])
+        elif output_format == 'long':
+            written = write_long_multi(output_file, builders, columns)
+        else:
+            written = []
+            for column_name in columns:
+                written += write_merged(builders[column_name], column_output_file(output_file, column_name), output_format, column_name)
+    if profiling.active() is not None:
+        profiling.count('bytes_written', sum(os.path.getsize(f) for f in written))
+    return written
+
+def column_output_files(output_file, columns):
+    """The tsv tables written for the merged columns."""
+    if len(columns) == 1:
+        return [output_file]
+    return [column_output_file(output_file, c) for c in columns]
+
+def manifest_path_for(output_file):
+    return output_file + MANIFEST_SUFFIX
+
+def file_entry(file, fingerprint=None):
+    stat = os.stat(file)
+    return {
+        'path': os.path.abspath(file),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'fingerprint': fingerprint or file_fingerprint(file, full=True),
+    }
+
+def write_manifest(output_file, columns, samples, file_entries):
+    manifest = {
+        'sylph_tax_version': __version__,
+        'columns': columns,
+        'samples': samples,
+        'files': file_entries,
+    }
+    path = manifest_path_for(output_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
+
+def read_manifest(merged_file, samples):
+    """File entries of the manifest of merged_file, or None if there is no
+    usable manifest (missing, or not matching the samples of the table)."""
+    path = manifest_path_for(merged_file)
+    if not os.path.exists(path):
+        print(f"No manifest {path} found; every input file will be read.")
+        return None
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        print(f"WARNING: Could not read manifest {path}; every input file will be read.")
+        return None
+    if manifest.get('samples') != samples:
+        print(f"WARNING: Manifest {path} does not match the samples of {merged_file}; every input file will be read.")
+        return None
+    return manifest['files']
+
+def read_merged_table(merged_file):
+    """(samples, clades, values matrix) of a merged tsv table."""
+    if not os.path.exists(merged_file):
+        print(f"ERROR: Merged table {merged_file} not found. Exiting.")
+        sys.exit(1)
+    ### Our own output: read the written values back exactly
+    df = pd.read_csv(merged_file, sep='\t', index_col='clade_name', dtype={'clade_name': str}, keep_default_na=False, float_precision='round_trip')
+    return df.columns.tolist(), df.index.tolist(), df.to_numpy(dtype=float)
+
+def new_files(files, file_entries):
+    """Split files into those not merged yet and the manifest entries of all
+    files. A file is already merged if its path, size and modification time,
+    or else its fingerprint, match a manifest entry."""
+    by_stat = {(e['path'], e['size'], e['mtime_ns']) for e in file_entries}
+    fingerprints = {e['fingerprint'] for e in file_entries}
+    file_entries = list(file_entries)
+    unmerged = []
+    for file in files:
+        stat = os.stat(file)
+        if (os.path.abspath(file), stat.st_size, stat.st_mtime_ns) in by_stat:
+            continue
+        ### Hashed in full: consolidated .gz files have one gzip member per
+        ### record, and a trailer only covers its own member
+        fingerprint = file_fingerprint(file, full=True)
+        if fingerprint in fingerprints:
+            continue
+        fingerprints.add(fingerprint)
+        unmerged.append(file)
+        file_entries.append(file_entry(file, fingerprint))
+    return unmerged, file_entries
+
+def update_merged(files, columns, existing, output_file):
+    """Add the samples of files that are not in the existing merged table(s)
+    and write the extended table(s), as a full merge over the files of the
+    existing table followed by the new files would."""
+    existing_files = column_output_files(existing, columns)
+    clade_ids = dict()
+    builders = {c: CladeMatrixBuilder(clade_ids) for c in columns}
+    samples = None
+    with profiling.phase('read_existing'):
+        for column_name, merged_file in zip(columns, existing_files):
+            table_samples, clades, matrix = read_merged_table(merged_file)
+            if samples is not None and table_samples != samples:
+                print(f"ERROR: {merged_file} does not have the same samples as {existing_files[0]}. Exiting.")
+                sys.exit(1)
+            samples = table_samples
+            builders[column_name].add_dense(samples, clades, matrix)
+    print(f"Read {len(samples)} samples from {', '.join(existing_files)}")
+
+    file_entries = read_manifest(existing, samples)
+    unmerged, file_entries = new_files(files, file_entries or [])
+    profiling.count('skipped_files', len(files) - len(unmerged))
+    if len(unmerged) < len(files):
+        print(f"Skipping {len(files) - len(unmerged)} files that are already merged")
+    if not unmerged and output_file == existing:
+        print(f"No new samples; {existing} is up to date")
+        return []
+
+    try:
+        build_matrices(unmerged, columns, builders)
+    except ValueError as e:
+        print(f"ERROR: {e}. A sample in the merged table can only be replaced by a full merge. Exiting.")
+        sys.exit(1)
+    print(f"Added {len(builders[columns[0]].samples) - len(samples)} samples")
+
+    ### Write next to the outputs and rename, so an interrupted update leaves
+    ### the existing table intact
+    output_path = Path(output_file)
+    temp_file = str(output_path.with_name('.update-' + output_path.name))
+    written = write_merged_columns(builders, columns, temp_file, 'tsv')
+    outputs = column_output_files(output_file, columns)
+    for temp, output in zip(written, outputs):
+        os.replace(temp, output)
+    write_manifest(output_file, columns, builders[columns[0]].samples, file_entries)
+    return outputs
 
 def main(args, config):
 
-    merged_df = merge_data(args.files, args.column)
-    output_file = args.output
-    merged_df.to_csv(output_file, sep='\t')
-    print(f"Merged data written to {output_file}")
+    columns = requested_columns(args.column)
+    output_format = getattr(args, 'format', 'tsv')
+    existing = getattr(args, 'update', None)
+    manifest = getattr(args, 'manifest', False)
+    output_file = args.output or existing or default_output_file(output_format)
+    require_compression(args.files)
+    if manifest and output_format != 'tsv':
+        print("ERROR: --manifest requires --format tsv. Exiting.")
+        sys.exit(1)
+    if existing is not None:
+        if output_format != 'tsv':
+            print("ERROR: --update requires --format tsv. Exiting.")
+            sys.exit(1)
+        written = update_merged(args.files, columns, existing, output_file)
+        if written:
+            print(f"Merged data written to {', '.join(written)}")
+        return
+
+    builders = build_matrices(args.files, columns)
+    written = write_merged_columns(builders, columns, output_file, output_format)
+    if manifest:
+        ### Hashes every input again, so only on request
+        write_manifest(output_file, columns, builders[columns[0]].samples, [file_entry(f) for f in args.files])
+    print(f"Merged data written to {', '.join(written)}")
 
 if __name__ == "__main__":
     main()
@@ -33,3 +33,6 @@ __name_to_metadata_file__ = {
 
 __tax_env_variable__ = "SYLPH_TAXONOMY_CONFIG"
 
+### Pre-built taxonomies keyed by contig (see resolver.contig_to_imgvr_acc);
+### all others are keyed by genome file.
+__contig_keyed_metadata__ = ["IMGVR_4.1", "UHGV_default", "UHGV_ictv"]
@@ -0,0 +1,275 @@
+import gzip
+import sys
+from pathlib import Path
+
+from sylph_tax.metadata_files import __contig_keyed_metadata__, __name_to_metadata_file__
+from sylph_tax.metadata_store import MetadataStoreBuilder
+from sylph_tax.taxonomy_index import (
+    TaxonomyIndex,
+    compile_index,
+    index_is_current,
+    index_path_for,
+)
+
+
+### Key types of metadata sources: which lookup keys can match their accessions
+### (see resolver.KEY_RULES). Custom files are ANY_KEYED unless declared
+### contig-keyed, and are then probed with every key.
+GENOME_KEYED = "genome"
+CONTIG_KEYED = "contig"
+ANY_KEYED = "any"
+
+
+def resolve_taxonomy_dir(args, config, names):
+    """Determine taxonomy directory with precedence: --taxonomy-dir > config.
+    Exits if pre-built taxonomies are requested but no directory is known."""
+    taxonomy_dir = None
+    if hasattr(args, "taxonomy_dir") and args.taxonomy_dir is not None:
+        taxonomy_dir = args.taxonomy_dir
+    elif config is not None and config.json["taxonomy_dir"] != "NONE":
+        taxonomy_dir = config.json["taxonomy_dir"]
+
+    # Check if we'll need the taxonomy directory (i.e., if any pre-built taxonomies are requested)
+    needs_taxonomy_dir = any(f in __name_to_metadata_file__ for f in names)
+
+    if needs_taxonomy_dir and taxonomy_dir is None:
+        # Distinguish between --no-config mode and config with unset taxonomy_dir
+        if config is None:
+            print(
+                "ERROR: --taxonomy-dir is required when --no-config is set and using pre-built taxonomies. Please specify a directory using --taxonomy-dir, or provide custom taxonomy file paths directly."
+            )
+        else:
+            print(
+                "ERROR: No taxonomy directory has been configured. Please run 'sylph-tax download --download-to <directory>' first, or specify --taxonomy-dir."
+            )
+        sys.exit(1)
+
+    if taxonomy_dir is None and not needs_taxonomy_dir:
+        pass  # Custom files only, no taxonomy dir needed
+    elif taxonomy_dir is None:
+        print(
+            "WARNING: No downloaded taxonomy files could be found. Ensure that you have downloaded the taxonomy metadata files using the 'download' command."
+        )
+
+    return taxonomy_dir
+
+
+def resolve_metadata_file(file_name, taxonomy_dir):
+    """Map a pre-built taxonomy name or a custom path to (path, is_gzipped)."""
+    if file_name in __name_to_metadata_file__:
+        base_file = __name_to_metadata_file__[file_name]
+        return Path(taxonomy_dir) / base_file, True
+    ### Process gzip file instead if extension detected
+    gzipped = ".gz" in file_name or ".gzip" in file_name
+    return Path(file_name), gzipped
+
+
+def source_key_type(file_name, contig_keyed=()):
+    """Key type of a pre-built taxonomy name or custom metadata file.
+    contig_keyed lists the custom files whose accessions are contig names."""
+    if file_name in __name_to_metadata_file__:
+        if file_name in __contig_keyed_metadata__:
+            return CONTIG_KEYED
+        return GENOME_KEYED
+    if file_name in contig_keyed:
+        return CONTIG_KEYED
+    return ANY_KEYED
+
+
+def _first_found(gets):
+    """Lookup function returning the first non-None result of gets."""
+    if not gets:
+        return lambda accession: None
+    if len(gets) == 1:
+        return gets[0]
+
+    def get_taxonomy(accession):
+        for get in gets:
+            tax_str = get(accession)
+            if tax_str is not None:
+                return tax_str
+        return None
+
+    return get_taxonomy
+
+
+def iter_metadata_rows(file, gzipped):
+    """Yield the tab-split fields of every row of a metadata file."""
+    if gzipped:
+        f = gzip.open(file, "rt")
+    else:
+        f = open(file, "r")
+    with f:
+        for row in f:
+            yield row.rstrip().split("\t")
+
+
+def build_index(file_name, taxonomy_dir, force=False):
+    """Compile the index for one metadata file. Returns (index path, rebuilt)."""
+    file, gzipped = resolve_metadata_file(file_name, taxonomy_dir)
+    index_file = index_path_for(file)
+    if not force and index_is_current(file, index_file):
+        return index_file, False
+    compile_index(file, iter_metadata_rows(file, gzipped), index_file)
+    return index_file, True
+
+
+class MetadataLookup:
+    """Accession lookup over several metadata sources (in-memory dicts or
+    compiled indexes). Later sources take precedence over earlier ones, matching
+    the behaviour of loading every file into a single dict.
+
+    Every source has a key type. keyed_taxonomy gives a separate lookup per key
+    type over only the sources that can hold such keys, so that genome file
+    probes never search a contig-keyed viral taxonomy and vice versa."""
+
+    def __init__(self):
+        self.taxonomy_sources = []
+        self.additional_data_sources = []
+        self.key_types = []
+        self._keyed = dict()
+
+    def add_dict(self, genome_to_taxonomy, genome_to_additional_data, key_type=ANY_KEYED):
+        self.taxonomy_sources.append(genome_to_taxonomy.get)
+        self.additional_data_sources.append(genome_to_additional_data.get)
+        self.key_types.append(key_type)
+        self._keyed.clear()
+
+    def add_table(self, table, key_type=ANY_KEYED):
+        """Add an AccessionTable (in-memory store or compiled index)."""
+        self.taxonomy_sources.append(table.get_taxonomy)
+        self.additional_data_sources.append(table.get_additional_data)
+        self.key_types.append(key_type)
+        self._keyed.clear()
+
+    def keyed_taxonomy(self, key_type):
+        """get_taxonomy over the sources of key_type (GENOME_KEYED or
+        CONTIG_KEYED) and the ANY_KEYED ones."""
+        get = self._keyed.get(key_type)
+        if get is None:
+            gets = [
+                source
+                for source, source_type in zip(self.taxonomy_sources, self.key_types)
+                if source_type in (key_type, ANY_KEYED)
+            ]
+            get = self._keyed[key_type] = _first_found(gets[::-1])
+        return get
+
+    def keyed_taxonomies(self, key_types):
+        """Tuple of the keyed_taxonomy of each of key_types (a tuple), built
+        once until a source is added."""
+        gets = self._keyed.get(key_types)
+        if gets is None:
+            gets = self._keyed[key_types] = tuple(
+                self.keyed_taxonomy(key_type) for key_type in key_types
+            )
+        return gets
+
+    def get_taxonomy(self, accession):
+        for get in reversed(self.taxonomy_sources):
+            tax_str = get(accession)
+            if tax_str is not None:
+                return tax_str
+        return None
+
+    def get_additional_data(self, accession):
+        for get in reversed(self.additional_data_sources):
+            val = get(accession)
+            if val is not None:
+                return val
+        return None
+
+
+def load_metadata(taxonomy_metadata, taxonomy_dir, wanted_accessions=None, contig_keyed=None):
+    """Load the requested metadata files, using compiled indexes when they are
+    present and up to date. Returns (MetadataLookup, list of resolved file paths).
+
+    Files without an index are packed into compact in-memory AccessionTables.
+    wanted_accessions is an optional zero-argument callable returning the set of
+    accessions that can be looked up. It is only called if some file has to be
+    parsed, and rows for other accessions are then dropped while streaming.
+    contig_keyed lists custom files of taxonomy_metadata keyed by contig (see
+    source_key_type)."""
+    contig_keyed = contig_keyed or []
+    for file_name in contig_keyed:
+        if file_name not in taxonomy_metadata:
+            print(f"ERROR: Contig-keyed metadata {file_name} is not one of the taxonomy metadata inputs. Exiting.")
+            sys.exit(1)
+
+    lookup = MetadataLookup()
+    wanted = None
+    metadata_files_full = []
+    builder = None
+    builder_key_type = None
+
+    def add_store():
+        table = builder.build()
+        print(
+            f"Loaded {len(table)} accessions ({table.num_lineages} distinct lineages, {table.num_hosts} distinct host annotations) into {table.nbytes() / 2**20:.1f} MiB"
+        )
+        lookup.add_table(table, builder_key_type)
+
+    for file_name in taxonomy_metadata:
+        key_type = source_key_type(file_name, contig_keyed)
+        if file_name in __name_to_metadata_file__ and "UHGV" in file_name:
+            print(
+                "WARNING: the UHGV taxonomy output format differs slightly from prokaryotic taxonomies. Taxonomic ranks may be skipped (e.g., Family -> Species rather than Family -> Genus -> Species)"
+            )
+        file, gzipped = resolve_metadata_file(file_name, taxonomy_dir)
+        if not file.exists():
+            print(f"ERROR: Metadata file {file} not found. Exiting.")
+            sys.exit(1)
+
+        metadata_files_full.append(str(file))
+
+        index_file = index_path_for(file)
+        if index_file.exists():
+            if index_is_current(file, index_file):
+                print(f"Using compiled index: {index_file}")
+                if builder is not None:
+                    add_store()
+                    builder = None
+                lookup.add_table(TaxonomyIndex(index_file), key_type)
+                continue
+            print(
+                f"WARNING: Compiled index {index_file} is out of date; reading {file} instead. Run 'sylph-tax index' to rebuild it."
+            )
+
+        ### Consecutive non-indexed files of one key type share one store, as
+        ### they shared one dict
+        if builder is not None and builder_key_type != key_type:
+            add_store()
+            builder = None
+        if builder is None:
+            builder = MetadataStoreBuilder()
+            builder_key_type = key_type
+
+        if wanted is None and wanted_accessions is not None:
+            wanted = wanted_accessions()
+
+        builder.add_rows(iter_metadata_rows(file, gzipped), wanted)
+
+    if builder is not None:
+        add_store()
+
+    return lookup, metadata_files_full
+
+
+def main(args, config):
+    names = args.taxonomy_metadata
+    if not names:
+        names = list(__name_to_metadata_file__.keys())
+    taxonomy_dir = resolve_taxonomy_dir(args, config, names)
+
+    for file_name in names:
+        file, _ = resolve_metadata_file(file_name, taxonomy_dir)
+        if not file.exists():
+            if args.taxonomy_metadata:
+                print(f"ERROR: Metadata file {file} not found. Exiting.")
+                sys.exit(1)
+            continue
+        index_file, rebuilt = build_index(file_name, taxonomy_dir, force=args.force)
+        if rebuilt:
+            print(f"INDEX: Compiled {file} -> {index_file}")
+        else:
+            print(f"INDEX: {index_file} is up to date.")
@@ -0,0 +1,204 @@
+from array import array
+
+import numpy as np
+
+### Accessions are buffered as Python bytes only until this many rows have been
+### added; each full chunk is packed into a fixed-width numpy array.
+DEFAULT_CHUNK_ROWS = 1 << 20
+
+
+def string_table(strings):
+    """(offsets, blob) of a list of strings: string i is
+    blob[offsets[i]:offsets[i + 1]] decoded as utf-8."""
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+
+class AccessionTable:
+    """Array-backed accession -> lineage / additional data lookup.
+
+    Accessions are a sorted fixed-width byte string array searched with
+    np.searchsorted; each maps to a row of a deduplicated lineage table and,
+    optionally, of a deduplicated host table (-1 if none). The tables are stored
+    as one utf-8 blob plus offsets, so no per-accession Python objects exist.
+    This is also the layout of a compiled index (see taxonomy_index)."""
+
+    ARRAYS = (
+        "accessions",
+        "lineage_ids",
+        "lineage_offsets",
+        "lineage_blob",
+        "host_ids",
+        "host_offsets",
+        "host_blob",
+    )
+
+    def __init__(
+        self,
+        accessions,
+        lineage_ids,
+        lineage_offsets,
+        lineage_blob,
+        host_ids,
+        host_offsets,
+        host_blob,
+    ):
+        self.accessions = accessions
+        self.lineage_ids = lineage_ids
+        self.lineage_offsets = lineage_offsets
+        self.lineage_blob = lineage_blob
+        self.host_ids = host_ids
+        self.host_offsets = host_offsets
+        self.host_blob = host_blob
+        self._width = self.accessions.dtype.itemsize
+
+    def __len__(self):
+        return self.accessions.size
+
+    @property
+    def num_lineages(self):
+        return len(self.lineage_offsets) - 1
+
+    @property
+    def num_hosts(self):
+        return len(self.host_offsets) - 1
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def nbytes(self):
+        """Memory held by the table's arrays."""
+        return sum(arr.nbytes for arr in self.arrays().values())
+
+    def find(self, accession):
+        """Row of accession in the sorted accession table, or -1."""
+        key = accession.encode()
+        if len(key) > self._width or not key:
+            return -1
+        i = int(self.accessions.searchsorted(key))
+        if i < self.accessions.size and self.accessions[i] == key:
+            return i
+        return -1
+
+    def _string(self, offsets, blob, i):
+        return bytes(blob[offsets[i] : offsets[i + 1]]).decode()
+
+    def lineage_at(self, row):
+        return self._string(
+            self.lineage_offsets, self.lineage_blob, self.lineage_ids[row]
+        )
+
+    def host_at(self, row):
+        host_id = self.host_ids[row]
+        if host_id < 0:
+            return None
+        return self._string(self.host_offsets, self.host_blob, host_id)
+
+    def get_taxonomy(self, accession):
+        """Taxonomy string tagged with the t__ strain identifier, or None."""
+        row = self.find(accession)
+        if row < 0:
+            return None
+        return self.lineage_at(row) + ";t__" + accession
+
+    def get_additional_data(self, accession):
+        row = self.find(accession)
+        if row < 0:
+            return None
+        return self.host_at(row)
+
+
+class MetadataStoreBuilder:
+    """Collects metadata rows and packs them into an AccessionTable.
+
+    Lineage and host strings are interned into tables as rows arrive, and
+    accessions are packed into numpy chunks, so loading costs a few bytes per
+    row beyond the accession itself. A duplicated accession takes the lineage
+    of its last row and the additional data of its last row that has any,
+    matching the behaviour of loading the rows into dicts."""
+
+    def __init__(self, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self._reset()
+
+    def _reset(self):
+        self._chunks = []
+        self._pending = []
+        self._lineage_ids = array("i")
+        self._host_ids = array("i")
+        self._lineages = dict()
+        self._hosts = dict()
+
+    def __len__(self):
+        return len(self._lineage_ids)
+
+    def add(self, accession, lineage, host=None):
+        self._pending.append(accession.encode())
+        self._lineage_ids.append(
+            self._lineages.setdefault(lineage, len(self._lineages))
+        )
+        if host is None:
+            self._host_ids.append(-1)
+        else:
+            self._host_ids.append(self._hosts.setdefault(host, len(self._hosts)))
+        if len(self._pending) >= self.chunk_rows:
+            self._flush()
+
+    def add_rows(self, rows, wanted=None):
+        """Add tab-split metadata rows (accession, lineage[, additional data]),
+        skipping accessions not in wanted if it is given."""
+        for spl in rows:
+            accession = spl[0]
+            if wanted is not None and accession not in wanted:
+                continue
+            lineage = spl[1].rstrip()
+            host = spl[2].rstrip() if len(spl) > 2 else None
+            self.add(accession, lineage, host)
+
+    def _flush(self):
+        if self._pending:
+            self._chunks.append(np.array(self._pending, dtype=np.bytes_))
+            self._pending = []
+
+    def build(self):
+        """Pack the rows added so far into an AccessionTable and reset."""
+        self._flush()
+        if self._chunks:
+            accessions = np.concatenate(self._chunks)
+            self._chunks = []
+        else:
+            accessions = np.zeros(0, dtype="S1")
+        n = accessions.size
+        order = np.argsort(accessions, kind="stable")
+        accessions = accessions[order]
+        lineage_ids = np.frombuffer(self._lineage_ids, dtype=np.intc).astype(np.int32)[order]
+        host_ids = np.frombuffer(self._host_ids, dtype=np.intc).astype(np.int32)[order]
+
+        ### Rows of one accession are adjacent and in input order after the
+        ### stable sort; keep the last one, and the last host annotation.
+        last = np.ones(n, dtype=bool)
+        last[:-1] = accessions[1:] != accessions[:-1]
+        host_rows = np.where(host_ids >= 0, np.arange(n), -1)
+        if n:
+            run_starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+            last_host = np.maximum.reduceat(host_rows, run_starts)
+        else:
+            last_host = np.zeros(0, dtype=np.int64)
+        host_ids = np.where(last_host >= 0, host_ids[last_host], -1).astype(np.int32)
+
+        lineage_offsets, lineage_blob = string_table(self._lineages)
+        host_offsets, host_blob = string_table(self._hosts)
+        self._reset()
+        return AccessionTable(
+            accessions[last],
+            lineage_ids[last],
+            lineage_offsets,
+            lineage_blob,
+            host_ids,
+            host_offsets,
+            host_blob,
+        )
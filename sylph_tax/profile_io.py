@@ -0,0 +1,263 @@
+import gzip
+import io
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+### Profiles (.sylphmpa and consolidated files) are compressed according to
+### their suffix: .gz for gzip, .zst for zstd. zstd needs Python 3.14+
+### (compression.zstd) or the zstandard package.
+###
+### A consolidated profile file holds the .sylphmpa text of many samples, one
+### record after another; each record starts with its #SampleID line. If the
+### file is compressed every record is a separate gzip member or zstd frame, so
+### the whole file is still a valid compressed stream (zcat/zstdcat work) while
+### single records can be decompressed on their own. FILE.idx lists each
+### record's byte range; without it, records are found by reading the file:
+###
+###   #sylph-tax consolidated index v1
+###   name <tab> sample_file <tab> offset <tab> length
+
+INDEX_SUFFIX = ".idx"
+_INDEX_HEADER = "#sylph-tax consolidated index v1\n"
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+
+
+def consolidated_index_path(path):
+    return Path(str(path) + INDEX_SUFFIX)
+
+
+def compression_of(path):
+    """'gzip', 'zstd' or None, from the file name."""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if str(path).endswith(suffix):
+            return compression
+    return None
+
+
+def is_compressed(path):
+    return compression_of(path) is not None
+
+
+class ZstdUnavailable(RuntimeError):
+    pass
+
+
+def _zstd():
+    """(compress, decompress, open) of the available zstd implementation.
+    Both read functions handle concatenated frames. Raises ZstdUnavailable
+    without one; commands check require_compression first."""
+    try:
+        from compression import zstd
+
+        return zstd.compress, zstd.decompress, zstd.open
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ZstdUnavailable(
+            "zstd-compressed (.zst) profiles need Python 3.14+ or the zstandard package (pip install zstandard)."
+        ) from None
+
+    def decompress(data):
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True
+        )
+        return reader.read()
+
+    def open_zstd(path, mode="rb"):
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True
+        )
+        return io.TextIOWrapper(reader) if "t" in mode else reader
+
+    return zstandard.compress, decompress, open_zstd
+
+
+def require_compression(paths):
+    """Exit with an error if a path is zstd-compressed and no zstd
+    implementation is available. Run before any work is started, in particular
+    before a worker pool, where an exit would not reach the parent."""
+    if any(compression_of(path) == "zstd" for path in paths if path is not None):
+        try:
+            _zstd()
+        except ZstdUnavailable as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+
+
+def compress_text(text, path):
+    """text encoded and compressed as the name of path asks for."""
+    data = text.encode()
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if compression == "zstd":
+        return _zstd()[0](data)
+    return data
+
+
+def decompress_text(data, path):
+    compression = compression_of(path)
+    if compression == "gzip":
+        data = gzip.decompress(data)
+    elif compression == "zstd":
+        data = _zstd()[1](data)
+    return data.decode()
+
+
+def open_text(path):
+    """Open a possibly compressed profile file for reading text."""
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, "rt")
+    if compression == "zstd":
+        return _zstd()[2](path, "rt")
+    return open(path, "r")
+
+
+def write_text_file(path, text, atomic=False):
+    """Write text to path in one write, compressed according to its name.
+    With atomic, it is written under a temporary name and renamed into place,
+    so path is either complete or untouched. Returns the number of bytes
+    written."""
+    data = compress_text(text, path)
+    target = f"{path}.tmp" if atomic else path
+    with open(target, "wb") as f:
+        f.write(data)
+    if atomic:
+        os.replace(target, path)
+    return len(data)
+
+
+class ConsolidatedWriter:
+    """Appends sample profile records to a consolidated file and writes its
+    offset index on close."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = []
+        self._file = open(self.path, "wb")
+        self.bytes_written = 0
+
+    def add_record(self, name, sample_file, text):
+        data = compress_text(text, self.path)
+        self._file.write(data)
+        self.entries.append((name, sample_file, self.bytes_written, len(data)))
+        self.bytes_written += len(data)
+
+    def close(self):
+        self._file.close()
+        with open(consolidated_index_path(self.path), "w") as f:
+            f.write(_INDEX_HEADER)
+            for name, sample_file, offset, length in self.entries:
+                f.write(f"{name}\t{sample_file}\t{offset}\t{length}\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_consolidated_index(path):
+    """[(name, sample_file, offset, length), ...] in file order."""
+    entries = []
+    with open(consolidated_index_path(path)) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            name, sample_file, offset, length = line.rstrip("\n").split("\t")
+            entries.append((name, sample_file, int(offset), int(length)))
+    return entries
+
+
+def read_profile_record(path, name):
+    """Text of one sample's record, looked up by record name or Sample_file.
+    If a name occurs more than once the last record wins. Without an index
+    the file is read up to its end and only Sample_file can match."""
+    if not consolidated_index_path(path).exists():
+        match = None
+        for text in iter_profile_texts(path):
+            if record_sample_name(text) == name:
+                match = text
+        if match is None:
+            raise KeyError(f"{name} not found in {path}")
+        return match
+    match = None
+    for entry in read_consolidated_index(path):
+        if name in (entry[0], entry[1]):
+            match = entry
+    if match is None:
+        raise KeyError(f"{name} not found in {path}")
+    with open(path, "rb") as f:
+        f.seek(match[2])
+        return decompress_text(f.read(match[3]), path)
+
+
+_RECORD_STARTS = ("#SampleID\t", "#mpa_v3_sylphmock#SampleID\t")
+
+
+def _is_record_start(line):
+    return line.startswith(_RECORD_STARTS)
+
+
+def _iter_records(lines):
+    record = []
+    for line in lines:
+        if _is_record_start(line) and record:
+            yield "".join(record)
+            record = []
+        record.append(line)
+    if record:
+        yield "".join(record)
+
+
+def iter_profile_texts(path):
+    """Yield the text of every sample profile in a .sylphmpa file, a compressed
+    profile or a consolidated file (records are found by their #SampleID
+    lines, so the index is not needed)."""
+    with open_text(path) as f:
+        yield from _iter_records(f)
+
+
+def split_profile_texts(text):
+    """The sample records of the text of a .sylphmpa or consolidated file."""
+    if not any("\n" + start in text for start in _RECORD_STARTS):
+        return [text]
+    return list(_iter_records(io.StringIO(text)))
+
+
+def record_sample_name(text):
+    """Sample_file of a profile record, from its #SampleID line."""
+    return text.split("\n", 1)[0].split("\t")[1].strip()
+
+
+def as_buffer(text):
+    return io.StringIO(text)
+
+
+def profile_text_to_dataframe(text):
+    """Clade table of one profile record, indexed by clade_name."""
+    return pd.read_csv(
+        io.StringIO(text),
+        sep="\t",
+        comment="#",
+        index_col="clade_name",
+        float_precision="round_trip",
+    )
+
+
+def iter_profiles(path):
+    """Yield (Sample_file, DataFrame) for every sample profile in a file."""
+    for text in iter_profile_texts(path):
+        yield record_sample_name(text), profile_text_to_dataframe(text)
+
+
+def read_profile(path, name):
+    """DataFrame of one sample of a consolidated file (see read_profile_record)."""
+    return profile_text_to_dataframe(read_profile_record(path, name))
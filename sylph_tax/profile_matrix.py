@@ -0,0 +1,84 @@
+import sys
+
+from sylph_tax import unresolved
+from sylph_tax.merge_sylph_taxprof import (
+    CladeMatrixBuilder,
+    as_read_back,
+    default_output_file,
+    requested_columns,
+    write_merged_columns,
+)
+from sylph_tax.sylph_to_taxprof import (
+    SampleScheduler,
+    iter_sylph_results,
+    load_run_metadata,
+)
+
+### merge column -> CladeProfile attribute
+PROFILE_COLUMNS = {
+    "relative_abundance": "tax_abundance",
+    "sequence_abundance": "seq_abundance",
+    "ANI": "ani",
+    "Coverage": "cov",
+}
+
+
+class MatrixSink:
+    """Adds each sample's CladeProfile to one CladeMatrixBuilder per merged
+    column, exactly as merge would after parsing the sample's .sylphmpa file."""
+
+    def __init__(self, columns):
+        clade_ids = dict()
+        self.builders = {c: CladeMatrixBuilder(clade_ids) for c in columns}
+
+    def add_record(self, name, sample_file, profile):
+        for column_name, builder in self.builders.items():
+            builder.add_sample(
+                sample_file,
+                profile.clades,
+                as_read_back(getattr(profile, PROFILE_COLUMNS[column_name])),
+            )
+
+    def close(self):
+        pass
+
+
+def main(args, config):
+    """taxprof followed by merge, without writing or parsing .sylphmpa files.
+    Samples become columns in the order taxprof would process them."""
+    columns = requested_columns(args.column)
+    with unresolved.reporting(getattr(args, "unresolved_report", None)):
+        build_profile_matrix(args, config, columns)
+
+
+def build_profile_matrix(args, config, columns):
+    output_format = getattr(args, "format", "tsv")
+    ### Sample layouts for --stream, found by the accession scan if it runs
+    layouts = dict() if getattr(args, "stream", False) else None
+    resolver, metadata_files_full = load_run_metadata(args, config, layouts)
+    sink = MatrixSink(columns)
+    scheduler = SampleScheduler(
+        getattr(args, "threads", 1),
+        resolver,
+        args,
+        metadata_files_full,
+        sink=sink,
+    )
+
+    samples = set()
+    try:
+        for _, grouped in iter_sylph_results(args, layouts):
+            for sample_file, group_df in grouped:
+                if sample_file in samples:
+                    print(
+                        f"ERROR! Sample {sample_file} appears in more than one sylph result file. Exiting."
+                    )
+                    sys.exit(1)
+                samples.add(sample_file)
+                scheduler.submit(sample_file, group_df, sample_file)
+    finally:
+        scheduler.close()
+
+    output_file = args.output or default_output_file(output_format)
+    written = write_merged_columns(sink.builders, columns, output_file, output_format)
+    print(f"Merged data written to {', '.join(written)}")
@@ -0,0 +1,215 @@
+import json
+import platform
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from sylph_tax.version import __version__
+
+### Phase timing and resource accounting for --profile-report. The hooks below
+### are no-ops unless a report was started with start(). A phase entered inside
+### another is recorded as 'outer.inner'; phase times are inclusive.
+_END = object()
+
+
+class CollectedReport:
+    """Slot for the active report of one kind (the profiling RunReport, the
+    UnresolvedReport, ...) in this process, None unless started. new() makes
+    an empty report; reports have a picklable state() and absorb(state).
+
+    Pool tasks run under collecting(), which gives each active kind a fresh
+    report in the worker, and the parent absorb()s the states it returns."""
+
+    slots = dict()
+
+    def __init__(self, name, new):
+        self.name = name
+        self.new = new
+        self.report = None
+        CollectedReport.slots[name] = self
+
+    def start(self, *args):
+        self.report = self.new(*args)
+        return self.report
+
+    def stop(self):
+        report, self.report = self.report, None
+        return report
+
+
+def collecting(fn, *args):
+    """Run fn(*args) in a worker process under fresh reports of the kinds
+    active here. Returns (result, {kind: report state})."""
+    slots = [slot for slot in CollectedReport.slots.values() if slot.report is not None]
+    previous = [slot.report for slot in slots]
+    for slot in slots:
+        slot.start()
+    try:
+        result = fn(*args)
+        return result, {slot.name: slot.report.state() for slot in slots}
+    finally:
+        for slot, report in zip(slots, previous):
+            slot.report = report
+
+
+def absorb(states):
+    """Add the report states returned by collecting() to the active reports."""
+    for name, state in states.items():
+        CollectedReport.slots[name].report.absorb(state)
+
+
+def peak_rss_mib(who="self"):
+    """Peak resident set size of this process ('self') or of its largest
+    waited-for child ('children', e.g. a pool worker, including the memory it
+    shared with the parent when forked) in MiB, or None if unavailable."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    ### ru_maxrss is in KiB on Linux and bytes on macOS
+    maxrss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    return maxrss / 1024
+
+
+def _add_counts(into, counts):
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            _add_counts(into.setdefault(key, dict()), value)
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+class RunReport:
+    """Per-phase wall/CPU time and peak RSS plus named counters of one run."""
+
+    def __init__(self, command=None):
+        self.command = command
+        self.phases = dict()
+        self.counts = dict()
+        self.unique = dict()
+        self._stack = []
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        if self._stack:
+            name = self._stack[-1] + "." + name
+        self._stack.append(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self._record(
+                name,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+                1,
+                peak_rss_mib(),
+            )
+
+    def _record(self, name, wall_s, cpu_s, calls, rss):
+        stats = self.phases.setdefault(
+            name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0, "peak_rss_mib": None}
+        )
+        stats["wall_s"] += wall_s
+        stats["cpu_s"] += cpu_s
+        stats["calls"] += calls
+        if rss is not None:
+            stats["peak_rss_mib"] = max(stats["peak_rss_mib"] or 0, rss)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_counts(self, counts):
+        """Add a (possibly nested) dict of counters."""
+        _add_counts(self.counts, counts)
+
+    def add_unique(self, name, values):
+        self.unique.setdefault(name, set()).update(values)
+
+    def state(self):
+        """Picklable phases and counters, for absorb() in another process."""
+        return {"phases": self.phases, "counts": self.counts, "unique": self.unique}
+
+    def absorb(self, state):
+        """Add the phases and counters of a report from a worker process.
+        Worker phase times are summed over workers."""
+        for name, stats in state["phases"].items():
+            self._record(
+                name, stats["wall_s"], stats["cpu_s"], stats["calls"], stats["peak_rss_mib"]
+            )
+        self.add_counts(state["counts"])
+        for name, values in state["unique"].items():
+            self.add_unique(name, values)
+
+    def to_dict(self):
+        counts = dict(self.counts)
+        for name, values in self.unique.items():
+            counts[name] = len(values)
+        return {
+            "sylph_tax_version": __version__,
+            "command": self.command,
+            "python": platform.python_version(),
+            ### platform.platform() forks a helper, which would show up as a child
+            "platform": f"{platform.system()}-{platform.release()}-{platform.machine()}",
+            "wall_s": time.perf_counter() - self._wall,
+            "cpu_s": time.process_time() - self._cpu,
+            "peak_rss_mib": peak_rss_mib(),
+            "peak_rss_children_mib": peak_rss_mib("children"),
+            "phases": self.phases,
+            "counts": counts,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+_run_report = CollectedReport("profiling", RunReport)
+
+
+def start(command=None):
+    """Start collecting a report for this process and return it."""
+    return _run_report.start(command)
+
+
+def stop():
+    return _run_report.stop()
+
+
+def active():
+    return _run_report.report
+
+
+def phase(name):
+    if _run_report.report is None:
+        return nullcontext()
+    return _run_report.report.phase(name)
+
+
+def count(name, n=1):
+    if _run_report.report is not None:
+        _run_report.report.count(name, n)
+
+
+def timed(iterable, name):
+    """Iterate, timing each step of the iterator as phase name."""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
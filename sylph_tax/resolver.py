@@ -0,0 +1,140 @@
+from collections import Counter, namedtuple
+
+from sylph_tax.metadata_loader import CONTIG_KEYED, GENOME_KEYED
+from sylph_tax.taxonomy_tree import TaxonomyTree
+
+
+def trim_file_path(file_name):
+    return file_name.split("/")[-1]
+
+
+def trim_contig_name(contig_name):
+    return contig_name.split()[0]
+
+
+def genome_file_to_gcf_acc(file_name):
+    if "ASM" in file_name:
+        return file_name.split("/")[-1].split("_ASM")[0]
+    return file_name.split("/")[-1].split("_genomic")[0]
+
+
+def contig_to_imgvr_acc(contig_name):
+    return contig_name.split(" ")[0].split("|")[0]
+
+
+### Names of the two lookup passes and of the keys probed in each pass, in order.
+PASS_NAMES = ("accession", "trimmed")
+KEY_RULES = ("genome_file", "genome_file.gz", "contig", ".fa", ".fasta", ".fna")
+STRIPPED_RULES = (".fa", ".fasta", ".fna")
+### Metadata key type each key is looked up in (see MetadataLookup.keyed_taxonomy).
+KEY_TYPES = (GENOME_KEYED, GENOME_KEYED, CONTIG_KEYED, GENOME_KEYED, GENOME_KEYED, GENOME_KEYED)
+
+
+def lookup_passes(genome_file_name, contig_name):
+    """The two lookup passes for a sylph row: first the GCF/IMGVR-style
+    accessions, then the trimmed file and contig names. Each pass is
+    (genome_file, contig_id, accession keys in probe order); a hit in the
+    second pass takes precedence over one in the first."""
+    passes = []
+    for i in range(2):
+        if i == 0:
+            genome_file = genome_file_to_gcf_acc(genome_file_name)
+            contig_id = contig_to_imgvr_acc(contig_name)
+        else:
+            genome_file = trim_file_path(genome_file_name)
+            contig_id = trim_contig_name(contig_name)
+        keys = (
+            genome_file,
+            genome_file + ".gz",
+            contig_id,
+            genome_file.split(".fa")[0],
+            genome_file.split(".fasta")[0],
+            genome_file.split(".fna")[0],
+        )
+        passes.append((genome_file, contig_id, keys))
+    return passes
+
+
+### tax_str is the NO_TAXONOMY placeholder when found is False; genome_file and
+### contig_id are those of the last lookup pass; rule names the key that matched.
+### node is the TaxonomyTree leaf of tax_str (set by LineageResolver).
+Resolution = namedtuple(
+    "Resolution",
+    ["tax_str", "found", "genome_file", "contig_id", "rule", "node"],
+    defaults=[None],
+)
+
+
+def resolve_taxonomy(metadata, genome_file_name, contig_name):
+    """Resolve a (Genome_file, Contig_name) pair against a metadata lookup.
+    Each key is only looked up in the sources that can hold keys of its type."""
+    tax_str = None
+    rule = "unresolved"
+    gets = metadata.keyed_taxonomies(KEY_TYPES)
+    for pass_name, (genome_file, contig_id, keys) in zip(
+        PASS_NAMES, lookup_passes(genome_file_name, contig_name)
+    ):
+        for key_rule, get, key in zip(KEY_RULES, gets, keys):
+            ### Without the extension, a stripped key is genome_file, which missed
+            if key_rule in STRIPPED_RULES and key == genome_file:
+                continue
+            found = get(key)
+            if found is not None:
+                tax_str = found
+                rule = f"{pass_name}:{key_rule}"
+                break
+    if tax_str is None:
+        return Resolution(
+            "NO_TAXONOMY;t__" + genome_file + ":" + contig_id,
+            False,
+            genome_file,
+            contig_id,
+            rule,
+        )
+    return Resolution(tax_str, True, genome_file, contig_id, rule)
+
+
+class LineageResolver:
+    """Memoized (Genome_file, Contig_name) -> taxonomy resolution shared by
+    every sample of a run, so the lookup cascade runs once per distinct
+    reference. Both hits and misses are cached, and every resolved lineage is
+    interned once into the run's TaxonomyTree.
+
+    cache_hits/cache_misses count resolve() calls answered from / added to the
+    cache; rule_counts counts distinct pairs by the rule that resolved them."""
+
+    def __init__(self, metadata, tree=None):
+        if tree is None:
+            tree = TaxonomyTree()
+        self.metadata = metadata
+        self.tree = tree
+        self._cache = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rule_counts = Counter()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def resolve(self, genome_file_name, contig_name):
+        pair = (genome_file_name, contig_name)
+        resolution = self._cache.get(pair)
+        if resolution is not None:
+            self.cache_hits += 1
+            return resolution
+        self.cache_misses += 1
+        resolution = resolve_taxonomy(self.metadata, genome_file_name, contig_name)
+        resolution = resolution._replace(node=self.tree.intern(resolution.tax_str))
+        self.rule_counts[resolution.rule] += 1
+        self._cache[pair] = resolution
+        return resolution
+
+    def stats(self):
+        return {
+            "unique_references": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "unresolved": self.rule_counts["unresolved"],
+            "taxonomy_nodes": len(self.tree),
+            "rules": dict(self.rule_counts),
+        }
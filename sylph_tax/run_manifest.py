@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sys
+
+from sylph_tax.metadata_loader import resolve_metadata_file, resolve_taxonomy_dir
+from sylph_tax.taxonomy_index import file_fingerprint
+
+### Run manifest of taxprof --incremental: a JSON-lines journal next to the
+### outputs. A line is appended for every .sylphmpa file once it is completely
+### written (by the worker that wrote it, so a killed run keeps what it
+### finished), and for every sylph result file whose samples were all written.
+### Later lines win. Outputs are keyed by the fingerprint of their input file,
+### the sample name and the run settings (metadata files and their
+### fingerprints, output flags).
+MANIFEST_NAME = "taxprof.manifest.jsonl"
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value).encode()).hexdigest()
+
+
+def manifest_path_for(output_prefix):
+    return output_prefix + MANIFEST_NAME
+
+
+def run_settings(args, config):
+    """Everything besides the input rows that the contents and names of the
+    outputs depend on."""
+    taxonomy_dir = resolve_taxonomy_dir(args, config, args.taxonomy_metadata)
+    fingerprints = []
+    for file_name in args.taxonomy_metadata:
+        file, _ = resolve_metadata_file(file_name, taxonomy_dir)
+        if not file.exists():
+            print(f"ERROR: Metadata file {file} not found. Exiting.")
+            sys.exit(1)
+        fingerprints.append(file_fingerprint(file))
+    settings = {
+        "taxonomy_metadata": args.taxonomy_metadata,
+        "metadata_fingerprints": fingerprints,
+        "pavian": args.pavian,
+        "annotate_virus_hosts": args.annotate_virus_hosts,
+        "add_folder_information": args.add_folder_information,
+        "compress": getattr(args, "compress", None),
+        "precision": getattr(args, "precision", None),
+    }
+    ### Only recorded when given, so that existing manifests stay valid
+    contig_keyed = getattr(args, "contig_keyed", None)
+    if contig_keyed:
+        settings["contig_keyed"] = contig_keyed
+    return settings
+
+
+def record_output(manifest_path, entry):
+    """Append the entry of a finished output, with the output's current size
+    and modification time, to the manifest."""
+    stat = os.stat(entry["output"])
+    entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    ### One short line per write; appends of concurrent workers do not interleave
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+class RunManifest:
+    """Which outputs of earlier runs are current, read from the manifest at
+    path. An output is current if its entry matches the input fingerprint,
+    sample and settings of this run and the file on disk is unchanged since it
+    was recorded."""
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings_key = _digest(settings)
+        self.outputs = dict()
+        self.inputs = dict()
+        self._fingerprints = dict()
+        self._load()
+
+    def _load(self):
+        self.outputs.clear()
+        self.inputs.clear()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    ### Cut short by a killed run
+                    continue
+                if "output" in record:
+                    self.outputs[record["output"]] = record
+                else:
+                    self.inputs[record["input"]] = record
+
+    def input_fingerprint(self, sylph_result):
+        sylph_result = os.path.abspath(sylph_result)
+        if sylph_result not in self._fingerprints:
+            ### Hashed in full: a regenerated input may keep its size and ends
+            self._fingerprints[sylph_result] = file_fingerprint(sylph_result, full=True)
+        return self._fingerprints[sylph_result]
+
+    def output_entry(self, sylph_result, sample_file, out_file):
+        """Manifest entry that the output of a sample written now would get."""
+        key = _digest(
+            [self.settings_key, self.input_fingerprint(sylph_result), sample_file]
+        )
+        return {
+            "output": out_file,
+            "input": os.path.abspath(sylph_result),
+            "sample": sample_file,
+            "key": key,
+        }
+
+    def is_current(self, entry):
+        record = self.outputs.get(entry["output"])
+        if record is None or record["key"] != entry["key"]:
+            return False
+        try:
+            stat = os.stat(entry["output"])
+        except OSError:
+            return False
+        return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+
+    def owns(self, entry):
+        """True if an existing output file was written for the same sample of
+        the same input by an earlier run, and may be replaced."""
+        record = self.outputs.get(entry["output"])
+        return (
+            record is not None
+            and record["input"] == entry["input"]
+            and record["sample"] == entry["sample"]
+        )
+
+    def input_is_current(self, sylph_result):
+        """True if every sample of sylph_result has a current output, so the
+        file need not be read."""
+        if not os.path.isfile(sylph_result):
+            return False
+        record = self.inputs.get(os.path.abspath(sylph_result))
+        if record is None:
+            return False
+        if record["key"] != _digest([self.settings_key, self.input_fingerprint(sylph_result)]):
+            return False
+        return all(
+            self.is_current(self.output_entry(sylph_result, sample_file, out_file))
+            for sample_file, out_file in record["outputs"]
+        )
+
+    def record_input(self, sylph_result, outputs):
+        """Record that all samples of sylph_result, [(sample, output), ...],
+        were written."""
+        record = {
+            "input": os.path.abspath(sylph_result),
+            "key": _digest([self.settings_key, self.input_fingerprint(sylph_result)]),
+            "outputs": outputs,
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def compact(self):
+        """Rewrite the manifest with only the latest line of every output and
+        input."""
+        self._load()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for record in list(self.outputs.values()) + list(self.inputs.values()):
+                f.write(json.dumps(record) + "\n")
+        os.replace(temp_path, self.path)
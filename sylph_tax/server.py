@@ -0,0 +1,214 @@
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import traceback
+from argparse import Namespace
+from contextlib import contextmanager
+
+from sylph_tax.client import server_is_running
+from sylph_tax.metadata_loader import load_metadata, resolve_taxonomy_dir
+from sylph_tax.resolver import LineageResolver
+from sylph_tax.sylph_reader import DEFAULT_CHUNK_ROWS
+from sylph_tax.sylph_to_taxprof import check_output_options, write_profiles
+from sylph_tax.version import __version__
+
+### Options of a profiling request (client.REQUEST_OPTIONS) and their taxprof
+### defaults. Requests carry the client's working directory, against which
+### relative paths are resolved.
+REQUEST_DEFAULTS = {
+    "sylph_results": None,
+    "output_prefix": "",
+    "annotate_virus_hosts": False,
+    "add_folder_information": False,
+    "pavian": False,
+    "overwrite": False,
+    "compress": None,
+    "precision": None,
+    "consolidated": None,
+    "stream": False,
+    "chunk_rows": DEFAULT_CHUNK_ROWS,
+}
+PATH_OPTIONS = ("output_prefix", "consolidated")
+
+
+class SharedResolver(LineageResolver):
+    """LineageResolver shared by concurrent request threads. Resolution (and
+    with it interning into the taxonomy tree) is serialized; aggregation only
+    reads tree nodes that already exist."""
+
+    def __init__(self, metadata, tree=None):
+        super().__init__(metadata, tree)
+        self._lock = threading.Lock()
+
+    def resolve(self, genome_file_name, contig_name):
+        with self._lock:
+            return super().resolve(genome_file_name, contig_name)
+
+
+class ThreadOutput:
+    """sys.stdout replacement that sends what a request thread prints to that
+    request's buffer, and everything else to the original stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON request line in, one JSON response line out."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = {"exit_code": 1, "output": "ERROR: Malformed request.\n"}
+        else:
+            response = self.server.handle_request(request)
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class TaxprofServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server answering taxprof requests with taxonomies loaded
+    once. Each request runs in its own thread, exactly as a one-shot taxprof
+    run with the same options would, and gets back everything the run printed
+    and its exit code."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, resolver, metadata_files_full, taxonomy_metadata):
+        self.resolver = resolver
+        self.metadata_files_full = metadata_files_full
+        self.taxonomy_metadata = taxonomy_metadata
+        self.output = ThreadOutput(sys.stdout)
+        super().__init__(socket_path, RequestHandler)
+        sys.stdout = self.output
+
+    def server_bind(self):
+        ### Only the owner may connect: requests write files as the server user
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if sys.stdout is self.output:
+            sys.stdout = self.output.stream
+
+    def handle_request(self, request):
+        command = request.get("command", "taxprof")
+        if command == "ping":
+            return {
+                "exit_code": 0,
+                "output": f"sylph-tax {__version__} serving {' '.join(self.taxonomy_metadata)}\n",
+            }
+        if command == "stop":
+            threading.Thread(target=self.shutdown).start()
+            return {"exit_code": 0, "output": "Server stopping.\n"}
+        if command != "taxprof":
+            return {"exit_code": 1, "output": f"ERROR: Unknown command {command}.\n"}
+
+        with self.output.capture() as buffer:
+            exit_code = 0
+            try:
+                args = self.request_args(request)
+                check_output_options(args)
+                write_profiles(args, self.resolver, self.metadata_files_full)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    exit_code = e.code or 0
+                else:
+                    print(e.code)
+                    exit_code = 1
+            except Exception:
+                traceback.print_exc(file=buffer)
+                exit_code = 1
+        return {"exit_code": exit_code, "output": buffer.getvalue()}
+
+    def request_args(self, request):
+        """taxprof arguments of a request, with paths made absolute."""
+        args = Namespace(
+            taxonomy_metadata=self.taxonomy_metadata,
+            threads=1,
+            **{key: request.get(key, default) for key, default in REQUEST_DEFAULTS.items()},
+        )
+        if not args.sylph_results or not isinstance(args.sylph_results, list):
+            print("ERROR: The request has no sylph result files.")
+            sys.exit(1)
+        cwd = request.get("cwd") or os.getcwd()
+        args.sylph_results = [os.path.join(cwd, f) for f in args.sylph_results]
+        for key in PATH_OPTIONS:
+            value = getattr(args, key)
+            if value is not None:
+                setattr(args, key, os.path.join(cwd, value))
+        return args
+
+
+def make_server(socket_path, taxonomy_metadata, taxonomy_dir, contig_keyed=None):
+    """Load the taxonomies and bind a TaxprofServer to socket_path. All
+    accessions are loaded, since future requests are not known."""
+    if os.path.exists(socket_path):
+        if server_is_running(socket_path):
+            print(f"ERROR: A sylph-tax server is already running on {socket_path}.")
+            sys.exit(1)
+        ### Left behind by a server that did not shut down cleanly
+        os.unlink(socket_path)
+
+    print(f"Reading metadata: {taxonomy_metadata} ...")
+    metadata, metadata_files_full = load_metadata(
+        taxonomy_metadata, taxonomy_dir, contig_keyed=contig_keyed
+    )
+    return TaxprofServer(
+        socket_path, SharedResolver(metadata), metadata_files_full, taxonomy_metadata
+    )
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+
+def main(args, config):
+    taxonomy_dir = resolve_taxonomy_dir(args, config, args.taxonomy_metadata)
+    server = make_server(
+        args.socket, args.taxonomy_metadata, taxonomy_dir, args.contig_keyed
+    )
+    signal.signal(signal.SIGTERM, _terminate)
+    print(
+        f"Serving taxprof requests on {args.socket}. Submit samples with 'sylph-tax submit --socket {args.socket} SYLPH-FILE ...'; stop with 'sylph-tax serve --stop --socket {args.socket}'."
+    )
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
@@ -0,0 +1,311 @@
+import gzip
+import io
+import pickle
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+
+import pandas as pd
+
+REQUIRED_COLUMNS = ("Genome_file", "Contig_name", "Adjusted_ANI", "Sequence_abundance")
+
+### Text columns are read as str in streaming mode so that every chunk gets the
+### same dtype regardless of its contents.
+STRING_COLUMNS = {"Sample_file": str, "Genome_file": str, "Contig_name": str}
+
+DEFAULT_CHUNK_ROWS = 100000
+MAX_SPILL_BUCKETS = 256
+
+### Sylph result name for reading standard input, e.g. 'sylph profile ... | sylph-tax taxprof -'
+STDIN = "-"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_stdin(sylph_result):
+    return sylph_result == STDIN
+
+
+class _Rewound:
+    """Binary stream that returns the bytes already read from it (the sniffed
+    header) before the rest of the underlying stream, so that a sylph result
+    is read in one pass without reopening it."""
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data = self._head + self._stream.read()
+            self._head = b""
+            return data
+        data = self._head[:size]
+        self._head = self._head[size:]
+        return data
+
+    def __iter__(self):
+        head, self._head = self._head, b""
+        yield from head.splitlines(keepends=True)
+        yield from self._stream
+
+    def close(self):
+        if self._stream is not sys.stdin.buffer:
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sylph_result(sylph_result, warn=True):
+    """Open a sylph result (a TSV path or '-' for standard input, either
+    possibly gzipped) and sniff its header. Returns (columns, stream), where
+    the binary stream still yields the whole file, header included. Rows can
+    have more fields than the header when contig names contain tabs; those
+    extra fields are dropped."""
+    ### Gzip is recognized by its magic bytes, as standard input has no suffix
+    if is_stdin(sylph_result):
+        stream = sys.stdin.buffer
+        if not hasattr(stream, "peek"):
+            stream = io.BufferedReader(stream)
+        gzipped = stream.peek(len(GZIP_MAGIC)).startswith(GZIP_MAGIC)
+        if gzipped:
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    else:
+        stream = open(sylph_result, "rb")
+        gzipped = stream.peek(len(GZIP_MAGIC)).startswith(GZIP_MAGIC)
+        if gzipped:
+            stream.close()
+            stream = gzip.open(sylph_result, "rb")
+    # Read the first line of the file
+    first_line = stream.readline()
+    num_cols = len(first_line.split(b"\t"))
+    second_line = stream.readline()
+    num_cols2 = len(second_line.split(b"\t"))
+    try:
+        columns = first_line.decode().rstrip("\n").split("\t")
+    except UnicodeDecodeError:
+        name = "Standard input" if is_stdin(sylph_result) else sylph_result
+        print(f"ERROR: {name} is neither a sylph result TSV nor a gzipped one. Exiting.")
+        sys.exit(1)
+    if num_cols != num_cols2 and warn:
+        print(
+            f"WARNING: there is an extra tab, probably in the contig fasta id used for sylph's database. Removing all columns after the first {num_cols}."
+        )
+    if not is_stdin(sylph_result) and not gzipped:
+        ### A plain file is cheaper to rewind than to replay
+        stream.seek(0)
+        return columns, stream
+    return columns, _Rewound(first_line + second_line, stream)
+
+
+def sniff_columns(sylph_result, warn=True):
+    """Header columns of a sylph result file (see open_sylph_result)."""
+    columns, stream = open_sylph_result(sylph_result, warn)
+    stream.close()
+    return columns
+
+
+def check_required_columns(columns):
+    if any(c not in columns for c in REQUIRED_COLUMNS):
+        print("ERROR: Missing required columns in sylph output file. Exiting.")
+        sys.exit(1)
+
+
+def read_sylph_result(sylph_result, columns):
+    """Read a whole sylph result into a DataFrame."""
+    # Read sylph's output TSV file into a Pandas DataFrame
+    try:
+        df = pd.read_csv(sylph_result, sep="\t", usecols=range(len(columns)))
+        df["Sample_file"] = df["Sample_file"].astype(str)
+    except:
+        print("ERROR: Could not read sylph results file. Exiting.")
+        sys.exit(1)
+    return df
+
+
+def read_sylph_chunks(sylph_result, columns, chunk_rows, usecols=None):
+    """Iterate over a sylph result in chunks of chunk_rows rows."""
+    if usecols is None:
+        usecols = range(len(columns))
+    try:
+        reader = pd.read_csv(
+            sylph_result,
+            sep="\t",
+            usecols=usecols,
+            dtype=STRING_COLUMNS,
+            chunksize=chunk_rows,
+        )
+        while True:
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                return
+            if "Sample_file" in chunk:
+                chunk["Sample_file"] = chunk["Sample_file"].astype(str)
+            yield chunk
+    except Exception:
+        print("ERROR: Could not read sylph results file. Exiting.")
+        sys.exit(1)
+
+
+class SampleLayout:
+    """Whether all rows of each sample are adjacent (sylph's normal output) and
+    the number of distinct samples, tracked over the Sample_file column of a
+    sylph result read in chunks."""
+
+    def __init__(self):
+        self.seen = set()
+        self.previous = None
+        self.contiguous = True
+
+    def add(self, samples):
+        """Add the next chunk of the Sample_file column (a Series of str)."""
+        starts = samples.ne(samples.shift())
+        runs = samples[starts].tolist()
+        if runs and runs[0] == self.previous:
+            runs = runs[1:]
+        for sample in runs:
+            if sample in self.seen:
+                self.contiguous = False
+            self.seen.add(sample)
+        if len(samples):
+            self.previous = samples.iloc[-1]
+
+    @property
+    def num_samples(self):
+        return len(self.seen)
+
+
+def read_sample_layout(sylph_result, columns, chunk_rows):
+    """SampleLayout of a sylph result, read in a pass of its own."""
+    layout = SampleLayout()
+    for chunk in read_sylph_chunks(
+        sylph_result, columns, chunk_rows, usecols=[columns.index("Sample_file")]
+    ):
+        layout.add(chunk["Sample_file"])
+    return layout
+
+
+def _sample_runs(chunk):
+    """(sample, rows) for each run of identical Sample_file values."""
+    samples = chunk["Sample_file"]
+    run_ids = samples.ne(samples.shift()).cumsum()
+    for _, run in chunk.groupby(run_ids, sort=False):
+        yield run["Sample_file"].iloc[0], run
+
+
+def _iter_contiguous_groups(sylph_result, columns, chunk_rows, check_grouped=False):
+    """Emit each run of a sample's rows as soon as the next sample starts. With
+    check_grouped (for input that cannot be checked in a first pass), a sample
+    that appears again after other samples is an error."""
+    current = None
+    parts = []
+    emitted = set()
+    for chunk in read_sylph_chunks(sylph_result, columns, chunk_rows):
+        for sample, run in _sample_runs(chunk):
+            if sample != current:
+                if parts:
+                    yield current, pd.concat(parts)
+                if check_grouped:
+                    emitted.add(current)
+                    if sample in emitted:
+                        print(
+                            f"ERROR: The rows of sample {sample} are not grouped together in the sylph results read from standard input; --stream needs grouped input there. Run without --stream or from a file. Exiting."
+                        )
+                        sys.exit(1)
+                current = sample
+                parts = []
+            parts.append(run)
+    if parts:
+        yield current, pd.concat(parts)
+
+
+def _iter_spilled_groups(sylph_result, columns, chunk_rows, num_samples):
+    """Partition rows by sample into on-disk buckets, then emit the samples of
+    one bucket at a time."""
+    num_buckets = max(1, min(num_samples, MAX_SPILL_BUCKETS))
+    with tempfile.TemporaryDirectory(prefix="sylph-tax-spill-") as spill_dir:
+        bucket_paths = [Path(spill_dir) / f"{i}.pkl" for i in range(num_buckets)]
+        buckets = dict()
+        try:
+            for chunk in read_sylph_chunks(sylph_result, columns, chunk_rows):
+                for sample, rows in chunk.groupby("Sample_file", sort=False):
+                    bucket = zlib.crc32(sample.encode()) % num_buckets
+                    if bucket not in buckets:
+                        buckets[bucket] = open(bucket_paths[bucket], "wb")
+                    pickle.dump((sample, rows), buckets[bucket])
+        finally:
+            for f in buckets.values():
+                f.close()
+
+        for bucket in sorted(buckets):
+            parts = dict()
+            with open(bucket_paths[bucket], "rb") as f:
+                while True:
+                    try:
+                        sample, rows = pickle.load(f)
+                    except EOFError:
+                        break
+                    parts.setdefault(sample, []).append(rows)
+            bucket_paths[bucket].unlink()
+            for sample, sample_parts in parts.items():
+                yield sample, pd.concat(sample_parts)
+
+
+def iter_dataframe_groups(df):
+    """Yield (Sample_file, rows) for every sample of a sylph result that is
+    already a DataFrame, sorted by sample name."""
+    check_required_columns(df.columns)
+    ### Group by sample file. Output one file fo reach sample file.
+    yield from df.groupby("Sample_file")
+
+
+def iter_sample_groups(sylph_result, columns, stream=False, chunk_rows=DEFAULT_CHUNK_ROWS, source=None, layout=None):
+    """Yield (Sample_file, rows) for every sample of a sylph result (a path, a
+    gzipped path or '-' for standard input). source is the stream returned with
+    columns by open_sylph_result, if the result is already open.
+
+    By default the whole file is loaded and samples come out sorted by name.
+    With stream=True the file is read in chunks and samples are emitted in file
+    order as soon as they are complete, so memory is bounded by one sample
+    (plus one chunk). This relies on sylph writing each sample's rows together.
+    A sample emitted early cannot be taken back, so files are checked before
+    streaming: layout is their SampleLayout if it is already known (e.g. from
+    the accession scan), otherwise the Sample_file column is read in a first
+    pass, which decompresses a gzipped file once more. If rows are interleaved
+    they are spilled to temporary files. Standard input is read in a single
+    pass and must be grouped."""
+    if source is None:
+        source = open_sylph_result(sylph_result, warn=False)[1]
+    if not stream:
+        with source:
+            df = read_sylph_result(source, columns)
+        yield from iter_dataframe_groups(df)
+        return
+
+    check_required_columns(columns)
+    if "Sample_file" not in columns:
+        print("ERROR: Could not read sylph results file. Exiting.")
+        sys.exit(1)
+    if is_stdin(sylph_result):
+        with source:
+            yield from _iter_contiguous_groups(source, columns, chunk_rows, check_grouped=True)
+        return
+    if layout is None:
+        with source:
+            layout = read_sample_layout(source, columns, chunk_rows)
+        _, source = open_sylph_result(sylph_result, warn=False)
+    with source:
+        if layout.contiguous:
+            yield from _iter_contiguous_groups(source, columns, chunk_rows)
+        else:
+            print(
+                "WARNING: sylph results are not grouped by sample; spilling rows to temporary files before profiling."
+            )
+            yield from _iter_spilled_groups(source, columns, chunk_rows, layout.num_samples)
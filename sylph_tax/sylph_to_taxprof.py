@@ -1,303 +1,630 @@
+import argparse
+from collections import Counter
 import pandas as pd
 from pathlib import Path
-from collections import defaultdict
 import sys
-import csv
-import gzip
-
-from sylph_tax.metadata_files import __name_to_metadata_file__
-
-
-def trim_file_path(file_name):
-    return file_name.split("/")[-1]
-
-
-def trim_contig_name(contig_name):
-    return contig_name.split()[0]
 
+from sylph_tax import profiling, unresolved
+from sylph_tax.aggregate import aggregate_nodes
+from sylph_tax.resolver import (
+    LineageResolver,
+    contig_to_imgvr_acc,
+    genome_file_to_gcf_acc,
+    lookup_passes,
+    trim_contig_name,
+    trim_file_path,
+)
+from sylph_tax.metadata_loader import load_metadata, resolve_taxonomy_dir
+from sylph_tax.profile_io import (
+    COMPRESSION_SUFFIXES,
+    ConsolidatedWriter,
+    require_compression,
+    write_text_file,
+)
+from sylph_tax.run_manifest import (
+    RunManifest,
+    manifest_path_for,
+    record_output,
+    run_settings,
+)
+from sylph_tax.sylph_reader import (
+    DEFAULT_CHUNK_ROWS,
+    STDIN,
+    SampleLayout,
+    iter_sample_groups,
+    open_sylph_result,
+)
+
+
+def collect_candidate_accessions(sylph_results, layouts=None):
+    """Scan the Genome_file/Contig_name columns of all sylph results and return
+    every accession key the lookup passes could probe. With a layouts dict, the
+    Sample_file column is scanned too and the SampleLayout of each result is
+    stored in it, so that --stream does not read the file again to get it."""
+    candidates = set()
+    seen = set()
+    for sylph_result in sylph_results:
+        columns, stream = open_sylph_result(sylph_result, warn=False)
+        with stream:
+            if "Genome_file" not in columns or "Contig_name" not in columns:
+                ### Reported when the file is processed
+                continue
+            usecols = [columns.index("Genome_file"), columns.index("Contig_name")]
+            layout = None
+            if layouts is not None and "Sample_file" in columns:
+                layout = SampleLayout()
+                usecols.append(columns.index("Sample_file"))
+            try:
+                chunks = pd.read_csv(
+                    stream,
+                    sep="\t",
+                    usecols=usecols,
+                    dtype=str,
+                    chunksize=DEFAULT_CHUNK_ROWS,
+                )
+                for chunk in chunks:
+                    if layout is not None:
+                        layout.add(chunk["Sample_file"].astype(str))
+                    pairs = chunk[["Genome_file", "Contig_name"]]
+                    for pair in pairs.itertuples(index=False, name=None):
+                        if pair in seen:
+                            continue
+                        seen.add(pair)
+                        genome_file_name, contig_name = pair
+                        if not isinstance(genome_file_name, str) or not isinstance(
+                            contig_name, str
+                        ):
+                            continue
+                        for _, _, keys in lookup_passes(genome_file_name, contig_name):
+                            candidates.update(keys)
+            except Exception:
+                ### Reported when the file is processed
+                continue
+            if layout is not None:
+                layouts[sylph_result] = layout
+    return candidates
+
+
+def unresolved_warning(resolutions, metadata_files_full):
+    """The single warning of a sample about its unresolved entries."""
+    first = resolutions[0]
+    entry = f"entry {first.genome_file} and contig {first.contig_id}"
+    if len(resolutions) > 1:
+        entry += f" and {len(resolutions) - 1} other entries"
+    return f"WARNING: No taxonomy information found for {entry} in metadata files ({metadata_files_full}). Did you use the correct database and taxonomies? Assigning default taxonomy"
+
+
+def resolve_group_taxonomy(group_df, resolver, metadata_files_full, messages):
+    """TaxonomyTree leaf nodes for every row of a sample. Resolution is memoized
+    by the run-wide resolver; unresolved entries are reported in one warning
+    per sample, and their rows added to an active unresolved report."""
+    report = profiling.active()
+    if report is not None:
+        hits, misses, rules = resolver.cache_hits, resolver.cache_misses, resolver.rule_counts.copy()
+        row_rules = Counter()
+    unresolved_report = unresolved.active()
+    unresolved_rows = []
+    ### Distinct unresolved pairs in first-seen order
+    warned = dict()
+    leaves = []
+    for pair in zip(group_df["Genome_file"], group_df["Contig_name"]):
+        resolution = resolver.resolve(*pair)
+        if report is not None:
+            row_rules[resolution.rule] += 1
+        if not resolution.found:
+            warned.setdefault(pair, resolution)
+            if unresolved_report is not None:
+                unresolved_rows.append(len(leaves))
+        leaves.append(resolution.node)
+    if warned:
+        messages.append(unresolved_warning(list(warned.values()), metadata_files_full))
+    if unresolved_rows:
+        unresolved_report.add_rows(group_df.iloc[unresolved_rows])
+    if report is not None:
+        ### Deltas, so that the resolvers of forked workers add up. Per rule,
+        ### rows counts every row it resolved and lookups the cache misses.
+        new_rules = resolver.rule_counts - rules
+        report.add_counts(
+            {
+                "resolver": {
+                    "cache_hits": resolver.cache_hits - hits,
+                    "cache_misses": resolver.cache_misses - misses,
+                    "rules": {
+                        rule: {"rows": n, "lookups": new_rules[rule]}
+                        for rule, n in row_rules.items()
+                    },
+                }
+            }
+        )
+    return leaves
+
+
+def format_virus_host(val):
+    if val is None:
+        return "NA"
+    return ";".join(x if x != "" else "UNKNOWN" for x in val.split(";"))
+
+
+def float_formatter(precision):
+    """Formatting of profile values: the shortest repr that round-trips, or
+    at most precision significant digits."""
+    if precision is None:
+        return str
+    spec = f".{precision}g"
+    return lambda value: format(value, spec)
+
+
+def format_profile(profile, sample_file, metadata, args):
+    """The .sylphmpa text of a sample profile: the header, then the clade
+    rows, formatted in bulk."""
+    with profiling.phase("write"):
+        pavian = args.pavian
+        annotate_virus = args.annotate_virus_hosts
+        fmt = float_formatter(getattr(args, "precision", None))
+        lines = []
+
+        # Print the CAMI BioBoxes profiling format
+        if pavian:
+            lines.append("#mpa_v3_sylphmock")
+        lines.append(f"#SampleID\t{sample_file}\tTaxonomies_used:{args.taxonomy_metadata}\n")
+        if pavian:
+            lines.append("#clade_name\tplaceholder\trelative_abundance\tplaceholder2\n")
+        elif annotate_virus:
+            lines.append(
+                "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\tVirus_host (if viral)\n"
+            )
+        else:
+            lines.append(
+                "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\n"
+            )
 
-def genome_file_to_gcf_acc(file_name):
-    if "ASM" in file_name:
-        return file_name.split("/")[-1].split("_ASM")[0]
-    return file_name.split("/")[-1].split("_genomic")[0]
+        clades = profile.clades
+        tax_abundance = [fmt(v) for v in profile.tax_abundance.tolist()]
+        if pavian:
+            lines.extend(
+                f"{tax}\t{'0' + '|0' * tax.count('|')}\t{abundance}\t\n"
+                for tax, abundance in zip(clades, tax_abundance)
+            )
+            return "".join(lines)
+
+        seq_abundance = [fmt(v) for v in profile.seq_abundance.tolist()]
+        rows = zip(
+            clades,
+            tax_abundance,
+            seq_abundance,
+            profile.ani.tolist(),
+            profile.cov.tolist(),
+            profile.strain.tolist(),
+        )
+        for tax, tax_abundance, seq_abundance, ani, cov, strain in rows:
+            if strain:
+                if annotate_virus:
+                    accession = tax.split("t__")[-1]
+                    val = format_virus_host(metadata.get_additional_data(accession))
+                    lines.append(
+                        f"{tax}\t{tax_abundance}\t{seq_abundance}\t{fmt(ani)}\t{fmt(cov)}\t{val}\n"
+                    )
+                else:
+                    lines.append(
+                        f"{tax}\t{tax_abundance}\t{seq_abundance}\t{fmt(ani)}\t{fmt(cov)}\n"
+                    )
+            elif annotate_virus:
+                lines.append(f"{tax}\t{tax_abundance}\t{seq_abundance}\tNA\tNA\tNA\n")
+            else:
+                lines.append(f"{tax}\t{tax_abundance}\t{seq_abundance}\tNA\tNA\n")
+        return "".join(lines)
 
 
-def contig_to_imgvr_acc(contig_name):
-    return contig_name.split(" ")[0].split("|")[0]
+def profile_sample(group_df, resolver, metadata_files_full, messages):
+    """Resolve and aggregate the rows of one sample into a CladeProfile."""
+    # Parse the genome file... assume the file is in gtdb format.
+    # This can be changed.
+    with profiling.phase("resolve"):
+        leaves = resolve_group_taxonomy(
+            group_df, resolver, metadata_files_full, messages
+        )
+    if "Eff_cov" in group_df:
+        cov = group_df["Eff_cov"]
+    else:
+        cov = group_df["True_cov"]
+
+    with profiling.phase("aggregate"):
+        return aggregate_nodes(
+            resolver.tree,
+            leaves,
+            group_df["Taxonomic_abundance"].to_numpy(dtype=float),
+            group_df["Sequence_abundance"].to_numpy(dtype=float),
+            group_df["Adjusted_ANI"].to_numpy(dtype=float),
+            cov.to_numpy(dtype=float),
+        )
 
 
-def main(args, config):
-    # Determine taxonomy directory with precedence: --taxonomy-dir > config
-    taxonomy_dir = None
-    if hasattr(args, "taxonomy_dir") and args.taxonomy_dir is not None:
-        taxonomy_dir = args.taxonomy_dir
-    elif config is not None and config.json["taxonomy_dir"] != "NONE":
-        taxonomy_dir = config.json["taxonomy_dir"]
-
-    # Check if we'll need the taxonomy directory (i.e., if any pre-built taxonomies are requested)
-    needs_taxonomy_dir = any(
-        f in __name_to_metadata_file__ for f in args.taxonomy_metadata
+def write_sample_profile(sample_file, group_df, out_file, resolver, args, metadata_files_full, journal=None):
+    """Aggregate one sample and write its .sylphmpa file (compressed if its
+    name ends in .gz or .zst) in one write. With journal = (manifest path,
+    entry) for --incremental, the file is written atomically and recorded in
+    the run manifest. Returns the messages to report, so that parallel runs
+    can print them in sample order."""
+    messages = []
+    profile = profile_sample(group_df, resolver, metadata_files_full, messages)
+    text = format_profile(profile, sample_file, resolver.metadata, args)
+    with profiling.phase("write_file"):
+        nbytes = write_text_file(out_file, text, atomic=journal is not None)
+    profiling.count("bytes_written", nbytes)
+    if journal is not None:
+        record_output(*journal)
+    return messages
+
+
+### Set in the parent before the worker pool is forked, so workers inherit the
+### loaded taxonomy instead of receiving it with every task.
+_worker_context = None
+
+
+def _write_sample_profile_task(sample_file, group_df, out_file, journal):
+    resolver, args, metadata_files_full, _ = _worker_context
+    return write_sample_profile(
+        sample_file, group_df, out_file, resolver, args, metadata_files_full, journal
     )
 
-    if needs_taxonomy_dir and taxonomy_dir is None:
-        # Distinguish between --no-config mode and config with unset taxonomy_dir
-        if config is None:
-            print(
-                "ERROR: --taxonomy-dir is required when --no-config is set and using pre-built taxonomies. Please specify a directory using --taxonomy-dir, or provide custom taxonomy file paths directly."
-            )
-        else:
-            print(
-                "ERROR: No taxonomy directory has been configured. Please run 'sylph-tax download --download-to <directory>' first, or specify --taxonomy-dir."
-            )
-        sys.exit(1)
 
-    if taxonomy_dir is None and not needs_taxonomy_dir:
-        pass  # Custom files only, no taxonomy dir needed
-    elif taxonomy_dir is None:
-        print(
-            "WARNING: No downloaded taxonomy files could be found. Ensure that you have downloaded the taxonomy metadata files using the 'download' command."
+def _sample_record(sink_task, sample_file, group_df, resolver, metadata_files_full):
+    """(messages, record) of one sample: its CladeProfile, or what
+    sink_task(sample_file, profile) makes of it."""
+    messages = []
+    record = profile_sample(group_df, resolver, metadata_files_full, messages)
+    if sink_task is not None:
+        record = sink_task(sample_file, record)
+    return messages, record
+
+
+class WorkerExit(Exception):
+    """A pool task exited (e.g. sys.exit after printing an error); args are
+    the exit code and a description."""
+
+
+def _exit_safe(task, *task_args):
+    """Run a pool task, passing an exit or other BaseException on to the
+    parent as a WorkerExit. The pool never reports those back, so the parent
+    would wait for the result forever."""
+    try:
+        return task(*task_args)
+    except Exception:
+        raise
+    except BaseException as e:
+        code = e.code if isinstance(e, SystemExit) else 1
+        raise WorkerExit(code, repr(e)) from None
+
+
+def _sink_task(sample_file, group_df):
+    resolver, _, metadata_files_full, sink_task = _worker_context
+    return _sample_record(sink_task, sample_file, group_df, resolver, metadata_files_full)
+
+
+class SampleScheduler:
+    """Runs write_sample_profile for each sample, either inline or on a forked
+    process pool. Messages are printed in submission order, and a sample whose
+    output path is still being written by an earlier task waits for it, so the
+    final files never depend on completion order.
+
+    With a sink (e.g. a ConsolidatedWriter), each sample is only aggregated,
+    and the parent passes its CladeProfile, or sink_task(sample_file, profile)
+    if given, to sink.add_record(name, sample_file, record) in submission
+    order; out_file is then the record name. The sink is closed by close().
+
+    Pool tasks collect their own profiling and unresolved reports (see
+    profiling.collecting), which are merged into the parent's as results are
+    reported."""
+
+    def __init__(
+        self,
+        threads,
+        resolver,
+        args,
+        metadata_files_full,
+        sink=None,
+        sink_task=None,
+    ):
+        global _worker_context
+        self.context = (resolver, args, metadata_files_full)
+        self.sink = sink
+        self.sink_task = sink_task
+        self.pool = None
+        self.pending = []
+        self.pending_by_out = dict()
+        if threads > 1:
+            import multiprocessing
+
+            if "fork" in multiprocessing.get_all_start_methods():
+                _worker_context = self.context + (sink_task,)
+                self.pool = multiprocessing.get_context("fork").Pool(threads)
+            else:
+                print(
+                    "WARNING: --threads requires the 'fork' start method, which is unavailable on this platform. Running single-threaded."
+                )
+
+    def submit(self, sample_file, group_df, out_file, journal=None):
+        if self.sink is not None:
+            self._submit_record(sample_file, group_df, out_file)
+            return
+        if self.pool is None:
+            for message in write_sample_profile(
+                sample_file, group_df, out_file, *self.context, journal
+            ):
+                print(message)
+            return
+        earlier = self.pending_by_out.get(out_file)
+        if earlier is not None:
+            earlier.wait()
+        result = self._apply_async(
+            _write_sample_profile_task, (sample_file, group_df, out_file, journal)
         )
+        self.pending.append((result, None, None))
+        self.pending_by_out[out_file] = result
+        self._report(block=False)
+
+    def _submit_record(self, sample_file, group_df, name):
+        if self.pool is None:
+            resolver, _, metadata_files_full = self.context
+            messages, record = _sample_record(
+                self.sink_task, sample_file, group_df, resolver, metadata_files_full
+            )
+            self._finish(messages, name, sample_file, record)
+            return
+        result = self._apply_async(_sink_task, (sample_file, group_df))
+        self.pending.append((result, name, sample_file))
+        self._report(block=False)
 
-    annotate_virus = args.annotate_virus_hosts
-    pavian = args.pavian
+    def _apply_async(self, task, task_args):
+        return self.pool.apply_async(profiling.collecting, (_exit_safe, task) + task_args)
 
-    ### This is a dictionary that contains the genome_file
-    ### to taxonomy string mapping. It should be like
-    ### {'my_genome.fna.gz' : b__Bacteria;...}
-    genome_to_taxonomy = dict()
-    genome_to_additional_data = dict()
-    metadata_files_full = []
+    def _get(self, result):
+        try:
+            value, states = result.get()
+        except WorkerExit as e:
+            ### The worker printed its error; exit as a single process run would
+            sys.exit(e.args[0])
+        profiling.absorb(states)
+        return value
+
+    def _finish(self, messages, name, sample_file, record):
+        for message in messages:
+            print(message)
+        if name is not None:
+            with profiling.phase("write_record"):
+                self.sink.add_record(name, sample_file, record)
+
+    def _report(self, block):
+        while self.pending and (block or self.pending[0][0].ready()):
+            result, name, sample_file = self.pending.pop(0)
+            if name is None:
+                self._finish(self._get(result), None, None, None)
+            else:
+                messages, record = self._get(result)
+                self._finish(messages, name, sample_file, record)
 
+    def close(self):
+        """Wait for all submitted samples to be written."""
+        try:
+            if self.pool is not None:
+                try:
+                    with profiling.phase("wait_workers"):
+                        self._report(block=True)
+                finally:
+                    self.pool.close()
+                    self.pool.join()
+        finally:
+            if self.sink is not None:
+                self.sink.close()
+
+
+def load_run_metadata(args, config, layouts=None):
+    """Load the taxonomies of a run. Returns (LineageResolver, resolved
+    metadata file paths). Only accessions reachable from args.sylph_results are
+    kept; without sylph results (e.g. for a reusable Taxonomy), all are. If
+    the sylph results are scanned for them and layouts is a dict, their
+    SampleLayouts are stored in it (see collect_candidate_accessions)."""
+    taxonomy_dir = resolve_taxonomy_dir(args, config, args.taxonomy_metadata)
+
+    ### Accession to taxonomy string lookup. Taxonomy strings look like
+    ### {'my_genome.fna.gz' : b__Bacteria;...;t__my_genome.fna.gz}
+    ### Metadata files without a compiled index are streamed, keeping only the
+    ### accessions that can be reached from the sylph results.
     print(f"Reading metadata: {args.taxonomy_metadata} ...")
 
-    for file_name in args.taxonomy_metadata:
-        prebuilt = False
-        if file_name in __name_to_metadata_file__:
-            if "UHGV" in file_name:
-                print(
-                    "WARNING: the UHGV taxonomy output format differs slightly from prokaryotic taxonomies. Taxonomic ranks may be skipped (e.g., Family -> Species rather than Family -> Genus -> Species)"
-                )
-            base_file = __name_to_metadata_file__[file_name]
-            file = Path(taxonomy_dir) / base_file
-            prebuilt = True
-        else:
-            file = Path(file_name)
-        if not file.exists():
-            print(f"ERROR: Metadata file {file} not found. Exiting.")
-            sys.exit(1)
-        ### Process gzip file instead if extension detected
-        if ".gz" in file_name or ".gzip" in file_name or prebuilt:
-            f = gzip.open(file, "rt")
-        else:
-            f = open(file, "r")
-
-        metadata_files_full.append(str(file))
+    def wanted_accessions():
+        with profiling.phase("scan_accessions"):
+            return collect_candidate_accessions(args.sylph_results, layouts)
+
+    ### Standard input can only be read once, so it cannot be scanned first;
+    ### all accessions are then kept
+    scan = args.sylph_results and STDIN not in args.sylph_results
+    with profiling.phase("load_metadata"):
+        metadata, metadata_files_full = load_metadata(
+            args.taxonomy_metadata,
+            taxonomy_dir,
+            wanted_accessions=wanted_accessions if scan else None,
+            contig_keyed=getattr(args, "contig_keyed", None),
+        )
+    return LineageResolver(metadata), metadata_files_full
 
-        ### Tag each taxonomy string with a t__ strain level identifier
-        for row in f:
-            spl = row.rstrip().split("\t")
-            accession = spl[0]
-            taxonomy = spl[1].rstrip() + ";t__" + accession
-            if len(spl) > 2:
-                genome_to_additional_data[accession] = spl[2].rstrip()
-            genome_to_taxonomy[accession] = taxonomy
 
+def iter_sylph_results(args, layouts=None):
+    """Yield (sylph result, iterator of (Sample_file, rows)) for every input.
+    layouts maps sylph results to SampleLayouts already known from the
+    accession scan. Reading is timed as the read_sylph phase, and rows,
+    samples and distinct genomes are counted, while a profiling report is
+    active."""
     for sylph_result in args.sylph_results:
         print("Processing sylph output file: ", sylph_result)
 
-        with open(sylph_result, "r") as file:
-            # Read the first line of the file
-            first_line = file.readline()
-            num_cols = len(first_line.split("\t"))
-            second_line = file.readline()
-            num_cols2 = len(second_line.split("\t"))
-            if num_cols != num_cols2:
-                print(
-                    f"WARNING: there is an extra tab, probably in the contig fasta id used for sylph's database. Removing all columns after the first {num_cols}."
-                )
-        # Read sylph's output TSV file into a Pandas DataFrame
-        try:
-            df = pd.read_csv(sylph_result, sep="\t", usecols=range(num_cols))
-            df["Sample_file"] = df["Sample_file"].astype(str)
-        except:
-            print("ERROR: Could not read sylph results file. Exiting.")
-            sys.exit(1)
-
-        ### Group by sample file. Output one file fo reach sample file.
-        grouped = df.groupby("Sample_file")
-        outs = set()
-
-        for sample_file, group_df in grouped:
-            first_warn = False
-            if args.add_folder_information:
-                out = "_".join(sample_file.split("/"))
-            else:
-                out = sample_file.split("/")[-1]
-            out_file = args.output_prefix + out + ".sylphmpa"
-            print(f"Writing output to: {out_file} ...")
-            if out_file in outs and not args.overwrite:
-                print(
-                    f"ERROR! Multiple .sylphmpa files would have the same sample name ({out}), which will cause a file to be overwritten. Consider --add-folder-information to disambiguate sample files"
-                )
-                sys.exit(1)
-            outs.add(out_file)
-            out_file_path = Path(out_file)
-            if out_file_path.exists() and not args.overwrite:
-                print(
-                    f"ERROR! A .sylphmpa file exists with the sample name ({out}), which will cause a file to be overwritten. Consider --add-folder-information to disambiguate sample files"
-                )
-                sys.exit(1)
-            of = open(out_file, "w")
+        columns, source = open_sylph_result(sylph_result)
+        grouped = iter_sample_groups(
+            sylph_result,
+            columns,
+            stream=getattr(args, "stream", False),
+            chunk_rows=getattr(args, "chunk_rows", DEFAULT_CHUNK_ROWS),
+            source=source,
+            layout=(layouts or dict()).get(sylph_result),
+        )
+        if profiling.active() is not None:
+            grouped = _counted_groups(profiling.timed(grouped, "read_sylph"))
+        yield sylph_result, grouped
 
-            tax_abundance = defaultdict(float)
-            seq_abundance = defaultdict(float)
-            ani_dict = defaultdict(float)
-            cov_dict = defaultdict(float)
 
-            # Iterate over each row in the DataFrame
-            for idx, row in group_df.iterrows():
-                if (
-                    "Genome_file" not in row
-                    or "Contig_name" not in row
-                    or "Adjusted_ANI" not in row
-                    or "Sequence_abundance" not in row
-                ):
-                    print(
-                        "ERROR: Missing required columns in sylph output file. Exiting."
-                    )
-                    sys.exit(1)
+def _counted_groups(grouped):
+    report = profiling.active()
+    for sample_file, group_df in grouped:
+        report.count("rows", len(group_df))
+        report.count("samples")
+        report.add_unique("unique_genomes", group_df["Genome_file"])
+        yield sample_file, group_df
 
-                # Parse the genome file... assume the file is in gtdb format.
-                # This can be changed.
-                tax_str = None
-                ani = float(row["Adjusted_ANI"])
-                for i in range(2):
-                    if i == 0:
-                        genome_file = genome_file_to_gcf_acc(row["Genome_file"])
-                        contig_id = contig_to_imgvr_acc(row["Contig_name"])
-                    else:
-                        genome_file = trim_file_path(row["Genome_file"])
-                        contig_id = trim_contig_name(row["Contig_name"])
-
-                    if "Eff_cov" in row:
-                        cov = float(row["Eff_cov"])
-                    else:
-                        cov = float(row["True_cov"])
-
-                    if genome_file in genome_to_taxonomy:
-                        tax_str = genome_to_taxonomy[genome_file]
-                    elif genome_file + ".gz" in genome_to_taxonomy:
-                        tax_str = genome_to_taxonomy[genome_file + ".gz"]
-                    elif contig_id in genome_to_taxonomy:
-                        tax_str = genome_to_taxonomy[contig_id]
-                    else:
-                        split_fasta1 = genome_file.split(".fa")[0]
-                        split_fasta2 = genome_file.split(".fasta")[0]
-                        split_fasta3 = genome_file.split(".fna")[0]
-                        if split_fasta1 in genome_to_taxonomy:
-                            tax_str = genome_to_taxonomy[split_fasta1]
-                        elif split_fasta2 in genome_to_taxonomy:
-                            tax_str = genome_to_taxonomy[split_fasta2]
-                        elif split_fasta3 in genome_to_taxonomy:
-                            tax_str = genome_to_taxonomy[split_fasta3]
-
-                if tax_str is None:
-                    tax_str = "NO_TAXONOMY;t__" + genome_file + ":" + contig_id
-                    if not first_warn:
-                        print(
-                            f"WARNING: No taxonomy information found for entry {genome_file} and contig {contig_id} in metadata files ({metadata_files_full}). Did you use the correct database and taxonomies? Assigning default taxonomy"
-                        )
 
-                abundance = float(row["Sequence_abundance"])
-                rel_abundance = float(row["Taxonomic_abundance"])
-
-                # Split taxonomy string into levels and update abundance
-                tax_levels = tax_str.split(";")
-                cur_tax = ""
-                for level in tax_levels:
-                    if level == "":
-                        level = "UNKNOWN"
-                    if cur_tax:
-                        cur_tax += "|"
-                    cur_tax += level
-                    tax_abundance[cur_tax] += rel_abundance
-                    seq_abundance[cur_tax] += abundance
-                    if "t__" in cur_tax:
-                        ani_dict[cur_tax] = ani
-                    if "t__" in cur_tax:
-                        cov_dict[cur_tax] = cov
-
-            # Print the CAMI BioBoxes profiling format
-            if pavian:
-                of.write("#mpa_v3_sylphmock")
-
-            of.write(
-                f"#SampleID\t{sample_file}\tTaxonomies_used:{args.taxonomy_metadata}\n"
-            )
+def check_output_options(args):
+    precision = getattr(args, "precision", None)
+    if precision is not None and precision < 1:
+        print("ERROR: --precision must be at least 1.")
+        sys.exit(1)
+    consolidated_file = getattr(args, "consolidated", None)
+    compress = getattr(args, "compress", None)
+    require_compression([consolidated_file, COMPRESSION_SUFFIXES[compress] if compress else None])
+    if consolidated_file is not None and Path(consolidated_file).exists() and not args.overwrite:
+        print(
+            f"ERROR! The consolidated output file {consolidated_file} exists. Use --overwrite to replace it."
+        )
+        sys.exit(1)
 
-            if pavian:
-                of.write("#clade_name\tplaceholder\trelative_abundance\tplaceholder2\n")
-            elif annotate_virus:
-                of.write(
-                    "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\tVirus_host (if viral)\n"
-                )
-            else:
-                of.write(
-                    "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\n"
-                )
 
-            level_to_key = dict()
-            for key in tax_abundance.keys():
-                level = len(key.split("|"))
-                if level not in level_to_key:
-                    level_to_key[level] = [key]
+def open_run_manifest(args, config):
+    """RunManifest of an --incremental run, and the sylph result files that
+    still have samples to write."""
+    if getattr(args, "consolidated", None) is not None:
+        print("ERROR: --incremental cannot be used with --consolidated.")
+        sys.exit(1)
+    if STDIN in args.sylph_results:
+        print("ERROR: --incremental cannot be used with sylph results from standard input.")
+        sys.exit(1)
+    manifest = RunManifest(manifest_path_for(args.output_prefix), run_settings(args, config))
+    pending = [f for f in args.sylph_results if not manifest.input_is_current(f)]
+    skipped = len(args.sylph_results) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} sylph output file(s) whose samples are all up to date in {manifest.path}")
+        profiling.count("skipped_files", skipped)
+    return manifest, pending
+
+
+def main(args, config):
+    check_output_options(args)
+    with unresolved.reporting(getattr(args, "unresolved_report", None)):
+        run_taxprof(args, config)
+
+
+def run_taxprof(args, config):
+    manifest = None
+    if getattr(args, "incremental", False):
+        manifest, pending = open_run_manifest(args, config)
+        if not pending:
+            print("All outputs are up to date.")
+            manifest.compact()
+            return
+        ### Only files with work left are scanned and read
+        args = argparse.Namespace(**vars(args))
+        args.sylph_results = pending
+    ### Sample layouts for --stream, found by the accession scan if it runs
+    layouts = dict() if getattr(args, "stream", False) else None
+    resolver, metadata_files_full = load_run_metadata(args, config, layouts)
+    write_profiles(args, resolver, metadata_files_full, manifest, layouts)
+
+
+def write_profiles(args, resolver, metadata_files_full, manifest=None, layouts=None):
+    """Profile every sample of args.sylph_results with already loaded
+    taxonomies and write the .sylphmpa (or consolidated) outputs. With a
+    RunManifest, samples whose outputs are current are skipped and written
+    outputs are recorded. layouts is passed on to iter_sylph_results."""
+    consolidated_file = getattr(args, "consolidated", None)
+    consolidated = None
+    if consolidated_file is not None:
+        consolidated = ConsolidatedWriter(consolidated_file)
+    scheduler = SampleScheduler(
+        getattr(args, "threads", 1),
+        resolver,
+        args,
+        metadata_files_full,
+        sink=consolidated,
+        sink_task=lambda sample_file, profile: format_profile(
+            profile, sample_file, resolver.metadata, args
+        ),
+    )
+
+    ### Outputs submitted for earlier sylph files count as existing files even
+    ### if a worker has not written them yet.
+    submitted = set()
+    completed = []
+    compress = getattr(args, "compress", None)
+    output_suffix = COMPRESSION_SUFFIXES[compress] if compress else ""
+    try:
+        for sylph_result, grouped in iter_sylph_results(args, layouts):
+            outs = set()
+            file_outputs = []
+
+            for sample_file, group_df in grouped:
+                if args.add_folder_information:
+                    out = "_".join(sample_file.split("/"))
                 else:
-                    level_to_key[level].append(key)
+                    out = sample_file.split("/")[-1]
 
-            sorted_keys = sorted(level_to_key.keys())
+                if consolidated is not None:
+                    ### One record per sample, keyed by the sample name its .sylphmpa file would get
+                    if (out in outs or out in submitted) and not args.overwrite:
+                        print(
+                            f"ERROR! Multiple samples would have the same sample name ({out}) in {consolidated_file}. Consider --add-folder-information to disambiguate sample files"
+                        )
+                        sys.exit(1)
+                    outs.add(out)
+                    print(f"Writing {out} to: {consolidated_file} ...")
+                    scheduler.submit(sample_file, group_df, out)
+                    continue
+
+                out_file = args.output_prefix + out + ".sylphmpa" + output_suffix
+                journal = None
+                owned = False
+                if manifest is not None:
+                    entry = manifest.output_entry(sylph_result, sample_file, out_file)
+                    if out_file not in outs and manifest.is_current(entry):
+                        print(f"Up to date: {out_file}")
+                        profiling.count("skipped_samples")
+                        outs.add(out_file)
+                        file_outputs.append([sample_file, out_file])
+                        continue
+                    journal = (manifest.path, entry)
+                    owned = manifest.owns(entry)
+                print(f"Writing output to: {out_file} ...")
+                if out_file in outs and not args.overwrite:
+                    print(
+                        f"ERROR! Multiple .sylphmpa files would have the same sample name ({out}), which will cause a file to be overwritten. Consider --add-folder-information to disambiguate sample files"
+                    )
+                    sys.exit(1)
+                outs.add(out_file)
+                file_outputs.append([sample_file, out_file])
+                out_file_path = Path(out_file)
+                if (
+                    (out_file_path.exists() and not owned) or out_file in submitted
+                ) and not args.overwrite:
+                    print(
+                        f"ERROR! A .sylphmpa file exists with the sample name ({out}), which will cause a file to be overwritten. Consider --add-folder-information to disambiguate sample files"
+                    )
+                    sys.exit(1)
 
-            for level in sorted_keys:
-                keys_for_level = sorted(
-                    level_to_key[level], key=lambda x: tax_abundance[x], reverse=True
-                )
-                for tax in keys_for_level:
-                    taxid = None
-                    if pavian:
-                        tax_len = len(tax.split("|")) - 1
-                        taxid = "0"
-                        for i in range(tax_len):
-                            taxid += "|0"
-
-                    if tax in ani_dict:
-                        if pavian:
-                            of.write(f"{tax}\t{taxid}\t{tax_abundance[tax]}\t\n")
-                        elif annotate_virus:
-                            accession = tax.split("t__")[-1]
-                            if accession in genome_to_additional_data:
-                                val = genome_to_additional_data[accession]
-                                splitted = val.split(";")
-                                splitted_unknown = [
-                                    x if x != "" else "UNKNOWN" for x in splitted
-                                ]
-                                new_val = ";".join(splitted_unknown)
-                                val = new_val
-                            else:
-                                val = "NA"
-                            of.write(
-                                f"{tax}\t{tax_abundance[tax]}\t{seq_abundance[tax]}\t{ani_dict[tax]}\t{cov_dict[tax]}\t{val}\n"
-                            )
-                        else:
-                            of.write(
-                                f"{tax}\t{tax_abundance[tax]}\t{seq_abundance[tax]}\t{ani_dict[tax]}\t{cov_dict[tax]}\n"
-                            )
-                    else:
-                        if pavian:
-                            of.write(f"{tax}\t{taxid}\t{tax_abundance[tax]}\t\n")
-                        elif annotate_virus:
-                            of.write(
-                                f"{tax}\t{tax_abundance[tax]}\t{seq_abundance[tax]}\tNA\tNA\tNA\n"
-                            )
-                        else:
-                            of.write(
-                                f"{tax}\t{tax_abundance[tax]}\t{seq_abundance[tax]}\tNA\tNA\n"
-                            )
+                scheduler.submit(sample_file, group_df, out_file, journal)
+
+            submitted.update(outs)
+            completed.append((sylph_result, file_outputs))
+    finally:
+        scheduler.close()
+    if consolidated is not None:
+        profiling.count("bytes_written", consolidated.bytes_written)
+    if manifest is not None:
+        for sylph_result, file_outputs in completed:
+            manifest.record_input(sylph_result, file_outputs)
+        manifest.compact()
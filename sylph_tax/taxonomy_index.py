@@ -0,0 +1,185 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from sylph_tax.metadata_store import AccessionTable, MetadataStoreBuilder
+
+### On-disk layout of a compiled metadata index (one file per metadata TSV):
+###
+###   magic (8 bytes) | format version (u32) | header length (u64) | JSON header
+###   | padding | array sections, each aligned to _ALIGN bytes
+###
+### The header records the fingerprint of the source TSV and the dtype, shape
+### and offset of every section so the arrays can be memory-mapped directly.
+### Sections:
+###   accessions        sorted fixed-width byte strings ('S' dtype)
+###   lineage_ids       int32, lineage table row for each accession
+###   lineage_offsets   int64, offsets into lineage_blob (len = n_lineages + 1)
+###   lineage_blob      uint8, concatenated utf-8 lineage strings
+###   host_ids          int32, host table row for each accession (-1 if none)
+###   host_offsets      int64, offsets into host_blob
+###   host_blob         uint8, concatenated utf-8 additional data (virus host) strings
+
+INDEX_SUFFIX = ".sylphidx"
+INDEX_FORMAT_VERSION = 1
+
+_MAGIC = b"SYLPHIDX"
+_PREAMBLE = struct.Struct("<8sIQ")
+_ALIGN = 64
+_FINGERPRINT_BLOCK = 1 << 20
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def index_path_for(metadata_file):
+    """Location of the compiled index for a metadata file (next to the file)."""
+    metadata_file = Path(metadata_file)
+    return metadata_file.with_name(metadata_file.name + INDEX_SUFFIX)
+
+
+def file_fingerprint(path, full=False):
+    """Content fingerprint of a file: its size plus a hash of its contents.
+    For gzipped files only the first and last MiB are hashed, unless full;
+    the last block contains the gzip trailer (CRC32 of the whole uncompressed
+    stream), so any content change of a single-member file is still detected.
+    Multi-member files (bgzip, consolidated profiles) need full. Other files
+    are hashed in full. Modification times are deliberately ignored so that
+    copying a taxonomy directory does not invalidate its indexes."""
+    path = Path(path)
+    size = path.stat().st_size
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        block = f.read(_FINGERPRINT_BLOCK)
+        h.update(block)
+        if size > _FINGERPRINT_BLOCK:
+            if block.startswith(_GZIP_MAGIC) and not full:
+                f.seek(max(size - _FINGERPRINT_BLOCK, _FINGERPRINT_BLOCK))
+                h.update(f.read())
+            else:
+                while block:
+                    block = f.read(_FINGERPRINT_BLOCK)
+                    h.update(block)
+    return f"{size}:{h.hexdigest()}"
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _write_index(path, header, arrays):
+    sections = {}
+    offset = 0
+    for name, arr in arrays.items():
+        sections[name] = {
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "offset": offset,
+        }
+        offset = _align(offset + arr.nbytes)
+    header = dict(header, sections=sections)
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    tmp_path = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(_PREAMBLE.pack(_MAGIC, INDEX_FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for name, arr in arrays.items():
+                f.seek(data_start + sections[name]["offset"])
+                f.write(np.ascontiguousarray(arr).tobytes())
+        ### Atomic replacement so concurrent readers never see a partial index
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+
+
+def compile_index(metadata_file, rows, index_file=None):
+    """Compile an iterable of metadata rows (lists of tab-separated fields) into
+    an on-disk index. Duplicate accessions follow the same last-one-wins rule as
+    the in-memory loader."""
+    metadata_file = Path(metadata_file)
+    if index_file is None:
+        index_file = index_path_for(metadata_file)
+    index_file = Path(index_file)
+    fingerprint = file_fingerprint(metadata_file)
+
+    builder = MetadataStoreBuilder()
+    builder.add_rows(rows)
+    table = builder.build()
+
+    header = {
+        "source": metadata_file.name,
+        "fingerprint": fingerprint,
+        "num_accessions": len(table),
+        "num_lineages": table.num_lineages,
+        "num_hosts": table.num_hosts,
+    }
+    _write_index(index_file, header, table.arrays())
+    return index_file
+
+
+def read_index_header(index_file):
+    with open(index_file, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) != _PREAMBLE.size:
+            raise ValueError(f"{index_file} is not a sylph-tax index")
+        magic, version, header_len = _PREAMBLE.unpack(preamble)
+        if magic != _MAGIC:
+            raise ValueError(f"{index_file} is not a sylph-tax index")
+        if version != INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"{index_file} has index format version {version}, expected {INDEX_FORMAT_VERSION}"
+            )
+        header = json.loads(f.read(header_len))
+    header["data_start"] = _align(_PREAMBLE.size + header_len)
+    return header
+
+
+def index_is_current(metadata_file, index_file=None):
+    """True if a compiled index exists for metadata_file and matches its fingerprint."""
+    if index_file is None:
+        index_file = index_path_for(metadata_file)
+    if not Path(index_file).exists():
+        return False
+    try:
+        header = read_index_header(index_file)
+    except (OSError, ValueError):
+        return False
+    return header["fingerprint"] == file_fingerprint(metadata_file)
+
+
+class TaxonomyIndex(AccessionTable):
+    """Read-only, memory-mapped view of a compiled metadata index."""
+
+    def __init__(self, index_file):
+        self.index_file = Path(index_file)
+        self.header = read_index_header(self.index_file)
+        with open(self.index_file, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data_start = self.header["data_start"]
+        arrays = dict()
+        for name, section in self.header["sections"].items():
+            dtype = np.dtype(section["dtype"])
+            count = int(np.prod(section["shape"]))
+            if count == 0:
+                arr = np.zeros(section["shape"], dtype=dtype)
+            else:
+                arr = np.frombuffer(
+                    self._mmap,
+                    dtype=dtype,
+                    count=count,
+                    offset=data_start + section["offset"],
+                ).reshape(section["shape"])
+            arrays[name] = arr
+        super().__init__(**arrays)
+
+    @property
+    def fingerprint(self):
+        return self.header["fingerprint"]
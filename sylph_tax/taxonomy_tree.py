@@ -0,0 +1,65 @@
+import numpy as np
+
+### Node 0 is the root; it has no label and is never part of a profile.
+ROOT = 0
+
+
+class TaxonomyTree:
+    """Interned taxonomy: every distinct lineage prefix is one integer node
+    with a parent, a depth (clade level) and its precomputed output label,
+    e.g. 'd__A|UNKNOWN|s__B'. Empty levels are interned as UNKNOWN, so a node
+    is exactly one output clade. Strain nodes are those whose label contains
+    t__."""
+
+    def __init__(self):
+        self.parent = [-1]
+        self.depth = [0]
+        self.label = [""]
+        self.strain = [False]
+        self._children = dict()
+        self._lineages = dict()
+        self._paths = dict()
+
+    def __len__(self):
+        return len(self.parent) - 1
+
+    def child(self, node, level):
+        if level == "":
+            level = "UNKNOWN"
+        key = (node, level)
+        child = self._children.get(key)
+        if child is None:
+            child = len(self.parent)
+            label = level if node == ROOT else self.label[node] + "|" + level
+            self._children[key] = child
+            self.parent.append(node)
+            self.depth.append(label.count("|") + 1)
+            self.label.append(label)
+            self.strain.append("t__" in label)
+        return child
+
+    def intern(self, tax_str):
+        """Node of a ;-separated taxonomy string (its deepest level)."""
+        node = self._lineages.get(tax_str)
+        if node is None:
+            node = ROOT
+            for level in tax_str.split(";"):
+                node = self.child(node, level)
+            self._lineages[tax_str] = node
+        return node
+
+    def path(self, node):
+        """Node ids from the top level down to node, as an int64 array."""
+        path = self._paths.get(node)
+        if path is None:
+            nodes = []
+            ancestor = node
+            while ancestor != ROOT:
+                nodes.append(ancestor)
+                ancestor = self.parent[ancestor]
+            path = np.array(nodes[::-1], dtype=np.int64)
+            self._paths[node] = path
+        return path
+
+    def labels(self, nodes):
+        return [self.label[n] for n in nodes]
@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+
+from sylph_tax.profile_io import write_text_file
+from sylph_tax.profiling import CollectedReport
+
+### Run-wide aggregation of sylph rows without taxonomy for --unresolved-report,
+### collected per process like the profiling report.
+
+REPORT_HEADER = "Genome_file\tContig_name\tcount\ttotal_taxonomic_abundance\ttotal_sequence_abundance\n"
+
+
+class UnresolvedReport:
+    """(Genome_file, Contig_name) -> [rows, summed Taxonomic_abundance,
+    summed Sequence_abundance] of the unresolved rows of a run, in the order
+    the pairs were first seen."""
+
+    def __init__(self):
+        self.entries = dict()
+
+    def add(self, genome_file, contig_name, tax_abundance, seq_abundance):
+        entry = self.entries.get((genome_file, contig_name))
+        if entry is None:
+            self.entries[(genome_file, contig_name)] = [1, tax_abundance, seq_abundance]
+        else:
+            entry[0] += 1
+            entry[1] += tax_abundance
+            entry[2] += seq_abundance
+
+    def add_rows(self, rows_df):
+        """Add sylph rows (a DataFrame with Genome_file, Contig_name and the
+        abundance columns)."""
+        for genome_file, contig_name, tax_abundance, seq_abundance in zip(
+            rows_df["Genome_file"].tolist(),
+            rows_df["Contig_name"].tolist(),
+            rows_df["Taxonomic_abundance"].astype(float).tolist(),
+            rows_df["Sequence_abundance"].astype(float).tolist(),
+        ):
+            self.add(genome_file, contig_name, tax_abundance, seq_abundance)
+
+    def state(self):
+        return self.entries
+
+    def absorb(self, entries):
+        for (genome_file, contig_name), (count, tax_abundance, seq_abundance) in entries.items():
+            entry = self.entries.get((genome_file, contig_name))
+            if entry is None:
+                self.entries[(genome_file, contig_name)] = [count, tax_abundance, seq_abundance]
+            else:
+                entry[0] += count
+                entry[1] += tax_abundance
+                entry[2] += seq_abundance
+
+    def write(self, path):
+        """Write the report as a TSV, most frequent pairs first."""
+        lines = [REPORT_HEADER]
+        for (genome_file, contig_name), (count, tax_abundance, seq_abundance) in sorted(
+            self.entries.items(), key=lambda item: -item[1][0]
+        ):
+            lines.append(f"{genome_file}\t{contig_name}\t{count}\t{tax_abundance}\t{seq_abundance}\n")
+        write_text_file(path, "".join(lines))
+
+
+_unresolved_report = CollectedReport("unresolved", UnresolvedReport)
+
+
+def active():
+    return _unresolved_report.report
+
+
+@contextmanager
+def reporting(path):
+    """Collect unresolved rows while running the block and write them to path
+    (if not None) once it has finished."""
+    if path is None:
+        yield
+        return
+    report = _unresolved_report.start()
+    try:
+        yield
+    finally:
+        _unresolved_report.stop()
+    report.write(path)
+    print(f"Unresolved report written to {path} ({len(report.entries)} entries)")
+
@@ -1,19 +1,64 @@
 from unittest import TestCase, main
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import os
 import tempfile
 import json
 from pathlib import Path
 import argparse
+import contextlib
+import gzip
+import io
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
 import requests
 
 import sylph_tax
 
 # Import the modules we want to test
-from sylph_tax.download_taxonomy import SylphTaxDownloader, main as download_main
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sylph_tax.download_taxonomy import (
+    SylphTaxDownloader,
+    main as download_main,
+    urls_for_names,
+)
 from sylph_tax.json_config import JsonConfig
 from sylph_tax.metadata_files import __metadata_file_urls__, __name_to_metadata_file__
+from sylph_tax.taxonomy_index import (
+    TaxonomyIndex,
+    compile_index,
+    index_is_current,
+    index_path_for,
+)
+from sylph_tax.metadata_loader import iter_metadata_rows, load_metadata
+from sylph_tax.metadata_store import MetadataStoreBuilder
+from sylph_tax.resolver import LineageResolver
+from sylph_tax.merge_sylph_taxprof import (
+    build_matrices,
+    build_matrix,
+    main as merge_main,
+    merge_data,
+    requested_columns,
+    write_merged,
+)
+from sylph_tax.aggregate import aggregate_clades, aggregate_nodes, lineage_clades
+from sylph_tax.taxonomy_tree import TaxonomyTree
+from sylph_tax.profile_matrix import main as profile_matrix_main
+from sylph_tax import profiling
+from sylph_tax.client import send_request
+from sylph_tax.server import make_server
+from sylph_tax.profile_io import (
+    iter_profiles,
+    read_consolidated_index,
+    read_profile,
+    read_profile_record,
+)
 from sylph_tax.sylph_to_taxprof import (
+    collect_candidate_accessions,
     genome_file_to_gcf_acc,
     contig_to_imgvr_acc,
     main as taxprof_main,
@@ -59,6 +104,59 @@ class TestJsonConfig(TestCase):
             self.temp_config_dir.parent.rmdir()
             self.temp_config_dir.parent.parent.rmdir()
 
+    def test_load_is_read_only(self):
+        config_location = self.temp_config_dir / "nested" / "config.json"
+        config = JsonConfig(config_location)
+        self.assertEqual(config.json["taxonomy_dir"], "NONE")
+        self.assertFalse(config_location.parent.exists())
+
+    def test_set_taxonomy_dir_saves(self):
+        config_location = self.temp_config_dir / "config.json"
+        JsonConfig(config_location).set_taxonomy_dir(str(self.temp_config_dir))
+        self.assertEqual(
+            JsonConfig(config_location).json["taxonomy_dir"],
+            str(self.temp_config_dir.absolute()),
+        )
+        self.assertEqual(list(self.temp_config_dir.iterdir()), [config_location])
+
+
+class TestCliStartup(TestCase):
+    """--version, --help, download and submit must not import numpy or pandas."""
+
+    cli = Path(__file__).resolve().parent.parent / "bin" / "sylph-tax"
+
+    def run_cli(self, *argv):
+        code = (
+            "import runpy, sys\n"
+            f"sys.argv = ['sylph-tax', *{list(argv)!r}]\n"
+            "try:\n"
+            f"    runpy.run_path({str(self.cli)!r}, run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(sorted(m for m in ('numpy', 'pandas') if m in sys.modules))\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        return result.stdout.strip().splitlines()[-1]
+
+    def test_no_heavy_imports(self):
+        for argv in (["--version"], ["--help"], ["download", "--help"], ["taxprof", "--help"], ["submit", "--socket", "/nonexistent", "x.tsv"]):
+            self.assertEqual(self.run_cli(*argv), "[]", argv)
+
+    def test_startup_time(self):
+        def best_of(cmd, runs=3):
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(cmd, capture_output=True, check=True)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        version = best_of([sys.executable, str(self.cli), "--version"])
+        pandas_import = best_of([sys.executable, "-c", "import pandas"])
+        self.assertLess(version, pandas_import)
+
 
 class TestSylphToTaxprof(TestCase):
     def test_genome_file_to_gcf_acc(self):
@@ -110,8 +208,6 @@ class TestNoConfigFlag(TestCase):
 
     def tearDown(self):
         # Clean up temporary files
-        import shutil
-
         shutil.rmtree(self.temp_dir)
 
     def test_download_no_config_requires_taxonomy_dir(self):
@@ -177,6 +273,7 @@ class TestNoConfigFlag(TestCase):
             used_dir = db_location
             original_init(self, db_location)
 
+        original_download = dt.SylphTaxDownloader.download_taxonomy
         dt.SylphTaxDownloader.__init__ = tracking_init
         dt.SylphTaxDownloader.download_taxonomy = MagicMock(return_value=[])
 
@@ -185,6 +282,7 @@ class TestNoConfigFlag(TestCase):
             self.assertEqual(used_dir, str(download_dest))
         finally:
             dt.SylphTaxDownloader.__init__ = original_init
+            dt.SylphTaxDownloader.download_taxonomy = original_download
 
     def test_taxprof_no_config_requires_taxonomy_dir_for_prebuilt(self):
         """Test that taxprof with --no-config fails without --taxonomy-dir when using pre-built taxonomy."""
@@ -255,6 +353,1219 @@ class TestNoConfigFlag(TestCase):
         self.assertEqual(cm.exception.code, 1)
 
 
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Static file server for download tests. Honours Range requests unless
+    ignore_range is set, and can drop the first response for a path after
+    drop_after[path] bytes."""
+
+    files = {}
+    drop_after = {}
+    ignore_range = False
+    requests = []
+
+    def do_GET(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        range_header = self.headers.get("Range")
+        self.requests.append((self.path, range_header))
+        start = 0
+        if range_header and not self.ignore_range:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        drop = self.drop_after.pop(self.path, None)
+        if drop is not None:
+            self.wfile.write(body[:drop])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestParallelDownloads(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.contents = {
+            f"/files/{name}": gzip.compress(
+                "".join(f"ACC_{name}_{i}\td__X;s__{i}\n" for i in range(20000)).encode(),
+                mtime=0,
+            )
+            for name in ("a_metadata.tsv.gz", "b_metadata.tsv.gz")
+        }
+        self.handler = type(
+            "Handler",
+            (RangeRequestHandler,),
+            {"files": self.contents, "drop_after": {}, "requests": []},
+        )
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        ).start()
+        port = self.server.server_address[1]
+        self.urls = [f"http://127.0.0.1:{port}{path}" for path in self.contents]
+        self.downloader = SylphTaxDownloader(self.temp_dir)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def assertDownloaded(self, paths):
+        for path, data in zip(paths, self.contents.values()):
+            self.assertEqual(path.read_bytes(), data)
+        self.assertEqual(list(Path(self.temp_dir).glob("*.part")), [])
+
+    def test_parallel_download(self):
+        paths = self.downloader.download_taxonomy(self.urls, threads=2)
+        self.assertEqual([p.name for p in paths], ["a_metadata.tsv.gz", "b_metadata.tsv.gz"])
+        self.assertDownloaded(paths)
+        ### Finished files are skipped on the next run
+        self.downloader.download_taxonomy(self.urls, threads=2)
+        self.assertEqual(len(self.handler.requests), 2)
+
+    def test_resume_partial_file(self):
+        data = self.contents["/files/a_metadata.tsv.gz"]
+        part = Path(self.temp_dir) / "a_metadata.tsv.gz.part"
+        part.write_bytes(data[:1000])
+        path = self.downloader.download_file(self.urls[0], show_progress=False)
+        self.assertEqual(self.handler.requests, [("/files/a_metadata.tsv.gz", "bytes=1000-")])
+        self.assertDownloaded([path])
+
+    def test_dropped_connection_is_resumed(self):
+        self.handler.drop_after["/files/a_metadata.tsv.gz"] = 5000
+        path = self.downloader.download_file(self.urls[0], show_progress=False)
+        self.assertEqual(
+            self.handler.requests,
+            [("/files/a_metadata.tsv.gz", None), ("/files/a_metadata.tsv.gz", "bytes=5000-")],
+        )
+        self.assertDownloaded([path])
+
+    def test_server_without_range_support(self):
+        self.handler.ignore_range = True
+        part = Path(self.temp_dir) / "a_metadata.tsv.gz.part"
+        part.write_bytes(b"garbage")
+        path = self.downloader.download_file(self.urls[0], show_progress=False)
+        self.assertDownloaded([path])
+
+    def test_corrupt_download_not_renamed(self):
+        self.contents["/files/a_metadata.tsv.gz"] = b"not gzip data"
+        with self.assertRaises(Exception):
+            self.downloader.download_file(self.urls[0], show_progress=False)
+        self.assertEqual(list(Path(self.temp_dir).iterdir()), [])
+
+    def test_only_selects_taxonomies(self):
+        urls = urls_for_names(["GTDB_r232", "IMGVR_4.1"])
+        self.assertEqual(
+            [u.split("/")[-1] for u in urls],
+            ["gtdb_r232_metadata.tsv.gz", "IMGVR_4.1_metadata.tsv.gz"],
+        )
+        with self.assertRaises(SystemExit):
+            urls_for_names(["GTDB_r999"])
+
+
+def write_taxprof_inputs(temp_dir):
+    """Small custom taxonomy + sylph result used by the taxprof tests."""
+    custom_tax = Path(temp_dir) / "custom_taxonomy.tsv"
+    custom_tax.write_text(
+        "accession\ttaxonomy\n"
+        "GCF_000001.1\td__Bacteria;p__A;;s__A1\n"
+        "GCF_000002.1\td__Bacteria;p__A;;s__A2\tHOST;;x\n"
+        "IMGVR_1\tr__Virus;k__\td__Bacteria;p__H\n"
+    )
+    sylph_result = Path(temp_dir) / "result.tsv"
+    sylph_result.write_text(
+        "Sample_file\tGenome_file\tTaxonomic_abundance\tSequence_abundance\tAdjusted_ANI\tEff_cov\tContig_name\n"
+        "s1.fq\tdb/GCF_000001.1_genomic.fna.gz\t50.0\t40.0\t99.1\t3.0\tc1 desc\n"
+        "s1.fq\tdb/GCF_000002.1_ASM2v1_genomic.fna.gz\t30.0\t30.0\t98.0\t2.0\tc2\n"
+        "s1.fq\tviruses.fna\t15.0\t20.0\t97.5\t1.5\tIMGVR_1|x|y\n"
+        "s1.fq\tunknown.fna\t5.0\t10.0\t96.0\t1.0\tc9\n"
+        "s2.fq\tdb/GCF_000002.1_ASM2v1_genomic.fna.gz\t100.0\t100.0\t99.9\t9.0\tc2\n"
+    )
+    return custom_tax, sylph_result
+
+
+def taxprof_args(**kwargs):
+    args = dict(
+        taxonomy_dir=None,
+        no_config=True,
+        annotate_virus_hosts=False,
+        pavian=False,
+        output_prefix="",
+        add_folder_information=False,
+        overwrite=True,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class TaxprofInputsTestCase(TestCase):
+    """The write_taxprof_inputs files in a fresh temporary directory."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.custom_tax, self.sylph_result = write_taxprof_inputs(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def taxprof(self, prefix, sylph_results=None, quiet=False, **kwargs):
+        """Run taxprof on the inputs with outputs prefixed by prefix in the
+        temporary directory. With quiet, returns its captured stdout."""
+        args = taxprof_args(
+            sylph_results=sylph_results or [str(self.sylph_result)],
+            taxonomy_metadata=[str(self.custom_tax)],
+            output_prefix=str(Path(self.temp_dir) / prefix),
+            **kwargs,
+        )
+        if not quiet:
+            taxprof_main(args, config=None)
+            return None
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            taxprof_main(args, config=None)
+        return output.getvalue()
+
+
+class TestTaxonomyIndex(TaxprofInputsTestCase):
+    def compile(self):
+        return compile_index(
+            self.custom_tax, iter_metadata_rows(self.custom_tax, False)
+        )
+
+    def test_lookup(self):
+        index = TaxonomyIndex(self.compile())
+        self.assertEqual(len(index), 4)
+        self.assertEqual(
+            index.get_taxonomy("GCF_000001.1"), "d__Bacteria;p__A;;s__A1;t__GCF_000001.1"
+        )
+        self.assertEqual(index.get_additional_data("GCF_000002.1"), "HOST;;x")
+        self.assertIsNone(index.get_additional_data("GCF_000001.1"))
+        self.assertIsNone(index.get_taxonomy("GCF_000003.1"))
+        self.assertIsNone(index.get_taxonomy("a_much_longer_accession_than_any_stored"))
+
+    def test_duplicates_last_wins(self):
+        with open(self.custom_tax, "a") as f:
+            f.write("GCF_000001.1\td__Archaea\n")
+        index = TaxonomyIndex(self.compile())
+        self.assertEqual(index.get_taxonomy("GCF_000001.1"), "d__Archaea;t__GCF_000001.1")
+
+    def test_stale_index_detected(self):
+        self.compile()
+        self.assertTrue(index_is_current(self.custom_tax))
+        with open(self.custom_tax, "a") as f:
+            f.write("NEW\td__Bacteria\n")
+        self.assertFalse(index_is_current(self.custom_tax))
+
+    def test_same_size_edit_of_large_file_detected(self):
+        rows = "".join(f"GCF_{i:09d}.1\td__Bacteria;s__S{i}\n" for i in range(120000))
+        self.custom_tax.write_text(rows)
+        self.assertGreater(self.custom_tax.stat().st_size, 3 << 20)
+        self.compile()
+        self.assertTrue(index_is_current(self.custom_tax))
+        ### Same size, changed in the middle
+        self.custom_tax.write_text(rows.replace("s__S60000\n", "s__X60000\n"))
+        self.assertFalse(index_is_current(self.custom_tax))
+
+    def test_download_keeps_current_index(self):
+        gz_tax = Path(self.temp_dir) / "custom_taxonomy.tsv.gz"
+        with gzip.open(gz_tax, "wt") as f:
+            f.write(self.custom_tax.read_text())
+        downloader = SylphTaxDownloader(self.temp_dir)
+        index_file = index_path_for(gz_tax)
+        self.assertEqual(downloader.index_taxonomy([gz_tax]), [index_file])
+        compiled = index_file.stat().st_mtime_ns
+        time.sleep(0.01)
+        downloader.index_taxonomy([gz_tax])
+        self.assertEqual(index_file.stat().st_mtime_ns, compiled)
+        downloader.index_taxonomy([gz_tax], force=True)
+        self.assertNotEqual(index_file.stat().st_mtime_ns, compiled)
+
+    def test_taxprof_output_identical_with_index(self):
+        outputs = []
+        for use_index in (False, True):
+            if use_index:
+                self.compile()
+            prefix = f"out{int(use_index)}_"
+            self.taxprof(prefix, annotate_virus_hosts=True)
+            outputs.append(
+                [(Path(self.temp_dir) / f"{prefix}{s}.sylphmpa").read_text() for s in ("s1.fq", "s2.fq")]
+            )
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue(index_path_for(self.custom_tax).exists())
+
+
+class TestParallelTaxprof(TaxprofInputsTestCase):
+    def run_taxprof(self, prefix, threads, sylph_results=None, overwrite=True):
+        self.taxprof(prefix, sylph_results, threads=threads, overwrite=overwrite)
+
+    def test_threads_match_sequential(self):
+        self.run_taxprof("seq_", 1)
+        self.run_taxprof("par_", 3)
+        for sample in ("s1.fq", "s2.fq"):
+            self.assertEqual(
+                (Path(self.temp_dir) / f"seq_{sample}.sylphmpa").read_text(),
+                (Path(self.temp_dir) / f"par_{sample}.sylphmpa").read_text(),
+            )
+
+    def test_worker_exit_reaches_parent(self):
+        def exit_in_worker(*args):
+            sys.exit(3)
+
+        ### Forked workers inherit the patch; the run must exit, not hang
+        with patch("sylph_tax.sylph_to_taxprof.write_sample_profile", exit_in_worker):
+            with self.assertRaises(SystemExit) as cm:
+                self.run_taxprof("exit_", 2)
+        self.assertEqual(cm.exception.code, 3)
+
+    def test_duplicate_outputs_across_files(self):
+        ### The same samples in a second input file would overwrite the outputs
+        ### of the first one, even if those have not been written yet
+        with self.assertRaises(SystemExit):
+            self.run_taxprof(
+                "dup_", 2, [str(self.sylph_result)] * 2, overwrite=False
+            )
+        self.assertTrue((Path(self.temp_dir) / "dup_s2.fq.sylphmpa").exists())
+
+
+class TestUnresolvedReport(TaxprofInputsTestCase):
+    def setUp(self):
+        super().setUp()
+        sylph_result = self.sylph_result
+        ### More unresolved rows: two more pairs in s1, and c9 in s2 as well
+        self.sylph_result = Path(self.temp_dir) / "unresolved.tsv"
+        self.sylph_result.write_text(
+            sylph_result.read_text()
+            + "s1.fq\tbins/bin_1.fa\t1.0\t2.0\t96.0\t1.0\tk1\n"
+            + "s1.fq\tbins/bin_2.fa\t0.5\t0.25\t96.0\t1.0\tk2 x\n"
+            + "s2.fq\tunknown.fna\t3.0\t4.0\t96.0\t1.0\tc9\n"
+        )
+
+    def run_taxprof(self, prefix, threads):
+        report = Path(self.temp_dir) / f"{prefix}unresolved.tsv"
+        output = self.taxprof(prefix, quiet=True, threads=threads, unresolved_report=str(report))
+        return output, report.read_text()
+
+    def test_one_warning_per_sample(self):
+        output, _ = self.run_taxprof("seq_", 1)
+        warnings = [line for line in output.splitlines() if line.startswith("WARNING: No taxonomy")]
+        self.assertEqual(len(warnings), 2)
+        self.assertIn("entry unknown.fna and contig c9 and 2 other entries in", warnings[0])
+        self.assertIn("entry unknown.fna and contig c9 in", warnings[1])
+
+    def test_report(self):
+        _, report = self.run_taxprof("seq_", 1)
+        self.assertEqual(
+            report.splitlines(),
+            [
+                "Genome_file\tContig_name\tcount\ttotal_taxonomic_abundance\ttotal_sequence_abundance",
+                "unknown.fna\tc9\t2\t8.0\t14.0",
+                "bins/bin_1.fa\tk1\t1\t1.0\t2.0",
+                "bins/bin_2.fa\tk2 x\t1\t0.5\t0.25",
+            ],
+        )
+        ### Rows resolved in worker processes are reported the same way
+        self.assertEqual(self.run_taxprof("par_", 3)[1], report)
+
+
+class TestIncrementalTaxprof(TaxprofInputsTestCase):
+    def run_taxprof(self, prefix, threads=1, **kwargs):
+        options = dict(overwrite=False, incremental=True)
+        options.update(kwargs)
+        return self.taxprof(prefix, quiet=True, threads=threads, **options)
+
+    def outputs(self, prefix):
+        return {
+            sample: (Path(self.temp_dir) / f"{prefix}{sample}.sylphmpa").stat().st_mtime_ns
+            for sample in ("s1.fq", "s2.fq")
+        }
+
+    def test_rerun_skips_current_outputs(self):
+        self.run_taxprof("ref_", incremental=False)
+        self.run_taxprof("inc_", threads=2)
+        for sample in ("s1.fq", "s2.fq"):
+            self.assertEqual(
+                (Path(self.temp_dir) / f"inc_{sample}.sylphmpa").read_text(),
+                (Path(self.temp_dir) / f"ref_{sample}.sylphmpa").read_text(),
+            )
+        written = self.outputs("inc_")
+
+        ### Nothing is read, not even the metadata, when all outputs are current
+        output = self.run_taxprof("inc_")
+        self.assertIn("All outputs are up to date.", output)
+        self.assertNotIn("Reading metadata", output)
+        self.assertEqual(self.outputs("inc_"), written)
+
+        ### Only a missing output is written again
+        os.unlink(Path(self.temp_dir) / "inc_s2.fq.sylphmpa")
+        output = self.run_taxprof("inc_")
+        self.assertIn("Up to date: " + str(Path(self.temp_dir) / "inc_s1.fq.sylphmpa"), output)
+        self.assertEqual(self.outputs("inc_")["s1.fq"], written["s1.fq"])
+
+    def test_changed_settings_rewrite_outputs(self):
+        self.run_taxprof("inc_")
+        written = self.outputs("inc_")
+        self.run_taxprof("inc_", annotate_virus_hosts=True)
+        rewritten = self.outputs("inc_")
+        self.assertNotEqual(rewritten["s1.fq"], written["s1.fq"])
+        self.assertIn(
+            "Virus_host", (Path(self.temp_dir) / "inc_s2.fq.sylphmpa").read_text()
+        )
+
+        ### A changed input is profiled again
+        with open(self.sylph_result, "a") as f:
+            f.write("s3.fq\tdb/GCF_000001.1_genomic.fna.gz\t100.0\t100.0\t99.0\t5.0\tc1\n")
+        output = self.run_taxprof("inc_", annotate_virus_hosts=True)
+        self.assertNotIn("Up to date", output)
+        self.assertTrue((Path(self.temp_dir) / "inc_s3.fq.sylphmpa").exists())
+
+    def test_same_size_input_edit_detected(self):
+        from sylph_tax.run_manifest import RunManifest
+
+        ### Two gzip members (as bgzip writes): the trailer of the last one
+        ### does not cover an edit in the middle of the first
+        payload = bytearray(os.urandom(3 << 20))
+        sylph_result = Path(self.temp_dir) / "big.tsv.gz"
+
+        def fingerprint():
+            sylph_result.write_bytes(
+                gzip.compress(bytes(payload), compresslevel=0, mtime=0)
+                + gzip.compress(b"tail\n", mtime=0)
+            )
+            manifest = RunManifest(str(Path(self.temp_dir) / "m.jsonl"), {})
+            return manifest.input_fingerprint(str(sylph_result))
+
+        before = fingerprint()
+        payload[3 << 19] ^= 1
+        self.assertNotEqual(fingerprint(), before)
+
+    def test_foreign_outputs_not_overwritten(self):
+        (Path(self.temp_dir) / "inc_s1.fq.sylphmpa").write_text("not ours\n")
+        with self.assertRaises(SystemExit):
+            self.run_taxprof("inc_")
+
+
+class TestConsolidatedOutput(TaxprofInputsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.taxprof("per_sample_")
+
+    def per_sample(self, sample):
+        return Path(self.temp_dir) / f"per_sample_{sample}.sylphmpa"
+
+    def run_consolidated(self, name, threads=1):
+        consolidated = str(Path(self.temp_dir) / name)
+        taxprof_main(
+            taxprof_args(
+                sylph_results=[str(self.sylph_result)],
+                taxonomy_metadata=[str(self.custom_tax)],
+                consolidated=consolidated,
+                threads=threads,
+            ),
+            config=None,
+        )
+        return consolidated
+
+    def test_records_match_per_sample_files(self):
+        for name, threads in (("all.sylphmpa", 1), ("all.sylphmpa.gz", 2)):
+            consolidated = self.run_consolidated(name, threads)
+            index = read_consolidated_index(consolidated)
+            self.assertEqual([e[0] for e in index], ["s1.fq", "s2.fq"])
+            for sample in ("s1.fq", "s2.fq"):
+                self.assertEqual(
+                    read_profile_record(consolidated, sample),
+                    self.per_sample(sample).read_text(),
+                )
+            self.assertEqual(
+                [s for s, _ in iter_profiles(consolidated)], ["s1.fq", "s2.fq"]
+            )
+            self.assertEqual(
+                read_profile(consolidated, "s2.fq").loc["d__Bacteria", "relative_abundance"],
+                100.0,
+            )
+
+    def test_merge_reads_consolidated(self):
+        consolidated = self.run_consolidated("all.sylphmpa.gz")
+        files = [str(self.per_sample(s)) for s in ("s1.fq", "s2.fq")]
+        pd.testing.assert_frame_equal(
+            merge_data([consolidated], "relative_abundance"),
+            merge_data(files, "relative_abundance"),
+        )
+
+    def test_consolidated_without_index(self):
+        files = [str(self.per_sample(s)) for s in ("s1.fq", "s2.fq")]
+        for name in ("plain.sylphmpa", "plain.sylphmpa.gz"):
+            consolidated = self.run_consolidated(name)
+            os.remove(consolidated + ".idx")
+            pd.testing.assert_frame_equal(
+                merge_data([consolidated], "relative_abundance"),
+                merge_data(files, "relative_abundance"),
+            )
+            self.assertEqual(
+                read_profile_record(consolidated, "s2.fq"), self.per_sample("s2.fq").read_text()
+            )
+
+    def run_per_sample(self, prefix, **kwargs):
+        self.taxprof(prefix, **kwargs)
+
+    def test_compressed_outputs(self):
+        self.run_per_sample("gz_", compress="gzip")
+        files = []
+        for sample in ("s1.fq", "s2.fq"):
+            compressed = Path(self.temp_dir) / f"gz_{sample}.sylphmpa.gz"
+            self.assertEqual(
+                gzip.decompress(compressed.read_bytes()).decode(),
+                self.per_sample(sample).read_text(),
+            )
+            files.append(str(compressed))
+        pd.testing.assert_frame_equal(
+            merge_data(files, "ANI"),
+            merge_data([str(self.per_sample(s)) for s in ("s1.fq", "s2.fq")], "ANI"),
+        )
+
+    def test_zstd_outputs(self):
+        try:
+            from compression import zstd  # noqa: F401
+        except ImportError:
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                self.skipTest("no zstd implementation available")
+        self.run_per_sample("zst_", compress="zstd")
+        consolidated = self.run_consolidated("all.sylphmpa.zst")
+        for sample in ("s1.fq", "s2.fq"):
+            self.assertEqual(
+                read_profile_record(consolidated, sample),
+                self.per_sample(sample).read_text(),
+            )
+        files = [str(Path(self.temp_dir) / f"zst_{s}.sylphmpa.zst") for s in ("s1.fq", "s2.fq")]
+        pd.testing.assert_frame_equal(
+            merge_data(files, "relative_abundance"),
+            merge_data([consolidated], "relative_abundance"),
+        )
+
+    def test_zstd_unavailable_exits_before_work(self):
+        from sylph_tax.profile_io import ZstdUnavailable
+
+        with patch("sylph_tax.profile_io._zstd", side_effect=ZstdUnavailable("no zstd")):
+            with self.assertRaises(SystemExit):
+                self.run_per_sample("nozst_", compress="zstd", threads=2)
+        self.assertEqual(list(Path(self.temp_dir).glob("nozst_*")), [])
+
+    def test_precision(self):
+        self.run_per_sample("p3_", precision=3)
+        full = read_profile_record(self.run_consolidated("all.sylphmpa"), "s1.fq")
+        rounded = (Path(self.temp_dir) / "p3_s1.fq.sylphmpa").read_text()
+        self.assertEqual(full.count("\n"), rounded.count("\n"))
+        for full_line, line in zip(full.splitlines()[2:], rounded.splitlines()[2:]):
+            for full_value, value in zip(full_line.split("\t")[1:], line.split("\t")[1:]):
+                if full_value == "NA":
+                    self.assertEqual(value, "NA")
+                else:
+                    self.assertEqual(float(value), float(f"{float(full_value):.3g}"))
+        with self.assertRaises(SystemExit):
+            self.run_per_sample("p0_", precision=0)
+
+    def test_existing_file_not_overwritten(self):
+        consolidated = self.run_consolidated("all.sylphmpa")
+        with self.assertRaises(SystemExit):
+            taxprof_main(
+                taxprof_args(
+                    sylph_results=[str(self.sylph_result)],
+                    taxonomy_metadata=[str(self.custom_tax)],
+                    consolidated=consolidated,
+                    overwrite=False,
+                ),
+                config=None,
+            )
+
+
+class TestProfileMatrix(TaxprofInputsTestCase):
+    def run_profile_matrix(self, output, sylph_results=None, threads=1, fmt="tsv"):
+        profile_matrix_main(
+            taxprof_args(
+                sylph_results=sylph_results or [str(self.sylph_result)],
+                taxonomy_metadata=[str(self.custom_tax)],
+                column=["all"],
+                format=fmt,
+                output=output,
+                threads=threads,
+            ),
+            config=None,
+        )
+
+    def test_same_tables_as_taxprof_and_merge(self):
+        d = Path(self.temp_dir)
+        self.taxprof("tp_")
+        files = [str(d / f"tp_{s}.sylphmpa") for s in ("s1.fq", "s2.fq")]
+        for threads, fmt in ((1, "tsv"), (2, "long")):
+            self.run_profile_matrix(str(d / f"pm.{fmt}"), threads=threads, fmt=fmt)
+            merge_main(
+                argparse.Namespace(
+                    files=files, column=["all"], format=fmt, output=str(d / f"mg.{fmt}")
+                ),
+                None,
+            )
+            merged_files = list(d.glob(f"mg*.{fmt}"))
+            self.assertEqual(len(merged_files), 4 if fmt == "tsv" else 1)
+            for merged in merged_files:
+                direct = d / ("pm" + merged.name[2:])
+                self.assertEqual(direct.read_text(), merged.read_text())
+
+    def test_duplicate_samples_rejected(self):
+        with self.assertRaises(SystemExit):
+            self.run_profile_matrix(
+                str(Path(self.temp_dir) / "pm.tsv"), [str(self.sylph_result)] * 2
+            )
+
+
+class TestServer(TaxprofInputsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = str(Path(self.temp_dir) / "serve.sock")
+        self.server = make_server(self.socket, [str(self.custom_tax)], None)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        send_request(self.socket, {"command": "stop"})
+        self.thread.join()
+        self.server.server_close()
+        super().tearDown()
+
+    def submit(self, **options):
+        request = {"command": "taxprof", "sylph_results": [str(self.sylph_result)]}
+        request.update(options)
+        return send_request(self.socket, request)
+
+    def test_concurrent_requests_match_taxprof(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        d = Path(self.temp_dir)
+        variants = {"plain": {}, "virus": {"annotate_virus_hosts": True}, "pavian": {"pavian": True}}
+        for name, options in variants.items():
+            self.taxprof(f"tp_{name}_", **options)
+        with ThreadPoolExecutor(6) as executor:
+            responses = list(
+                executor.map(
+                    lambda item: self.submit(output_prefix=f"sv_{item[0]}_", cwd=self.temp_dir, overwrite=True, **item[1]),
+                    list(variants.items()) * 2,
+                )
+            )
+        self.assertEqual([r["exit_code"] for r in responses], [0] * 6)
+        self.assertIn("Writing output to:", responses[0]["output"])
+        for name in variants:
+            for sample in ("s1.fq", "s2.fq"):
+                self.assertEqual(
+                    (d / f"sv_{name}_{sample}.sylphmpa").read_text(),
+                    (d / f"tp_{name}_{sample}.sylphmpa").read_text(),
+                )
+
+    def test_errors_are_returned(self):
+        self.assertEqual(send_request(self.socket, {"command": "ping"})["exit_code"], 0)
+        response = self.submit(sylph_results=["missing.tsv"], cwd=self.temp_dir)
+        self.assertEqual(response["exit_code"], 1)
+        self.assertIn("missing.tsv", response["output"])
+        ### Existing outputs are protected as in taxprof
+        self.submit(output_prefix="x_", cwd=self.temp_dir)
+        response = self.submit(output_prefix="x_", cwd=self.temp_dir)
+        self.assertEqual(response["exit_code"], 1)
+        self.assertIn("ERROR!", response["output"])
+
+
+class TestPythonAPI(TaxprofInputsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.taxonomy = sylph_tax.Taxonomy(self.custom_tax, use_config=False)
+
+    def test_profiles_match_taxprof_files(self):
+        d = Path(self.temp_dir)
+        self.taxprof("tp_", annotate_virus_hosts=True)
+        profiles = self.taxonomy.profile(self.sylph_result, annotate_virus_hosts=True)
+        self.assertEqual(list(profiles), ["s1.fq", "s2.fq"])
+        for sample, profile in profiles.items():
+            expected = pd.read_csv(
+                d / f"tp_{sample}.sylphmpa", sep="\t", skiprows=1, index_col=0
+            )
+            pd.testing.assert_frame_equal(profile, expected, check_dtype=False)
+
+        ### DataFrame input and the one-call function give the same profiles
+        df = pd.read_csv(self.sylph_result, sep="\t")
+        for other in (
+            self.taxonomy.profile(df, annotate_virus_hosts=True),
+            sylph_tax.profile(self.sylph_result, [str(self.custom_tax)], annotate_virus_hosts=True),
+        ):
+            for sample in profiles:
+                pd.testing.assert_frame_equal(other[sample], profiles[sample])
+
+    def test_merge_matches_merge_command(self):
+        d = Path(self.temp_dir)
+        self.taxprof("tp_")
+        files = [str(d / f"tp_{s}.sylphmpa") for s in ("s1.fq", "s2.fq")]
+        for column in ("relative_abundance", "ANI"):
+            expected = merge_data(files, column)
+            for as_frame in (True, False):
+                profiles = self.taxonomy.profile(self.sylph_result, as_frame=as_frame)
+                pd.testing.assert_frame_equal(sylph_tax.merge(profiles, column), expected)
+        with self.assertRaises(sylph_tax.SylphTaxError):
+            sylph_tax.merge(profiles, "abundance")
+
+    def test_errors_raise(self):
+        with self.assertRaisesRegex(sylph_tax.SylphTaxError, "missing.tsv not found"):
+            sylph_tax.Taxonomy(str(Path(self.temp_dir) / "missing.tsv"), use_config=False)
+        with self.assertRaises(FileNotFoundError):
+            self.taxonomy.profile(str(Path(self.temp_dir) / "missing_result.tsv"))
+
+
+class TestProfileReport(TaxprofInputsTestCase):
+    def tearDown(self):
+        profiling.stop()
+        super().tearDown()
+
+    def profiled(self, fn, args):
+        report = profiling.start("test")
+        try:
+            fn(args, None)
+        finally:
+            profiling.stop()
+        path = Path(self.temp_dir) / "report.json"
+        report.write(path)
+        return json.loads(path.read_text())
+
+    def test_taxprof_report(self):
+        for threads in (1, 2):
+            prefix = Path(self.temp_dir) / f"t{threads}_"
+            report = self.profiled(
+                taxprof_main,
+                taxprof_args(
+                    sylph_results=[str(self.sylph_result)],
+                    taxonomy_metadata=[str(self.custom_tax)],
+                    output_prefix=str(prefix),
+                    threads=threads,
+                ),
+            )
+            for phase in ("load_metadata", "read_sylph", "resolve", "aggregate", "write"):
+                self.assertIn(phase, report["phases"])
+            self.assertEqual(report["phases"]["resolve"]["calls"], 2)
+            counts = report["counts"]
+            self.assertEqual((counts["rows"], counts["samples"], counts["unique_genomes"]), (5, 2, 4))
+            rules = counts["resolver"]["rules"]
+            self.assertEqual(sum(r["rows"] for r in rules.values()), 5)
+            self.assertEqual(rules["unresolved"], {"rows": 1, "lookups": 1})
+            self.assertEqual(
+                counts["bytes_written"],
+                sum(os.path.getsize(f) for f in Path(self.temp_dir).glob(f"t{threads}_*.sylphmpa")),
+            )
+
+    def test_merge_report(self):
+        d = Path(self.temp_dir)
+        self.taxprof("tp_")
+        files = [str(d / f"tp_{s}.sylphmpa") for s in ("s1.fq", "s2.fq")]
+        output = d / "merged.tsv"
+        report = self.profiled(
+            merge_main,
+            argparse.Namespace(files=files, column=["relative_abundance"], format="tsv", output=str(output)),
+        )
+        self.assertEqual(set(report["phases"]), {"read", "parse", "build", "write"})
+        self.assertEqual(report["counts"]["files"], 2)
+        self.assertEqual(report["counts"]["samples"], 2)
+        self.assertEqual(report["counts"]["bytes_written"], os.path.getsize(output))
+
+    def test_inactive_by_default(self):
+        self.assertIsNone(profiling.active())
+        with profiling.phase("x"):
+            profiling.count("y")
+
+
+class TestMetadataStore(TestCase):
+    def test_duplicates_and_chunks(self):
+        builder = MetadataStoreBuilder(chunk_rows=2)
+        builder.add_rows(
+            [
+                ["GCF_1", "d__A;s__1", "HOST1"],
+                ["IMGVR_UViG_0001", "r__V;s__"],
+                ["GCF_1", "d__A;s__2"],
+                ["GCF_2", "d__A;s__1 "],
+                ["IMGVR_UViG_0001", "r__V;s__", "HOST2"],
+            ]
+        )
+        table = builder.build()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.num_lineages, 3)
+        self.assertEqual(table.get_taxonomy("GCF_1"), "d__A;s__2;t__GCF_1")
+        self.assertEqual(table.get_taxonomy("GCF_2"), "d__A;s__1;t__GCF_2")
+        ### The last row with additional data wins, even if a later row has none
+        self.assertEqual(table.get_additional_data("GCF_1"), "HOST1")
+        self.assertEqual(table.get_additional_data("IMGVR_UViG_0001"), "HOST2")
+        self.assertIsNone(table.get_additional_data("GCF_2"))
+        self.assertIsNone(table.get_taxonomy("GCF_3"))
+        self.assertIsNone(table.get_taxonomy("IMGVR_UViG_00011"))
+        self.assertEqual(table.nbytes(), sum(a.nbytes for a in table.arrays().values()))
+        self.assertEqual(len(MetadataStoreBuilder().build()), 0)
+
+    def test_load_metadata_uses_store(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            custom_tax, _ = write_taxprof_inputs(temp_dir)
+            metadata, _ = load_metadata([str(custom_tax)], None)
+            self.assertEqual(
+                metadata.get_taxonomy("GCF_000002.1"), "d__Bacteria;p__A;;s__A2;t__GCF_000002.1"
+            )
+            self.assertEqual(metadata.get_additional_data("GCF_000002.1"), "HOST;;x")
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestDemandDrivenLoading(TaxprofInputsTestCase):
+    def test_candidate_accessions(self):
+        candidates = collect_candidate_accessions([str(self.sylph_result)])
+        self.assertIn("GCF_000001.1", candidates)
+        self.assertIn("GCF_000002.1", candidates)
+        self.assertIn("GCF_000002.1_ASM2v1_genomic.fna.gz", candidates)
+        self.assertIn("IMGVR_1", candidates)
+        self.assertIn("unknown", candidates)
+        self.assertNotIn("GCF_000003.1", candidates)
+
+    def test_only_wanted_rows_loaded(self):
+        metadata, _ = load_metadata(
+            [str(self.custom_tax)], None, wanted_accessions=lambda: {"IMGVR_1"}
+        )
+        self.assertEqual(metadata.get_taxonomy("IMGVR_1"), "r__Virus;k__;t__IMGVR_1")
+        self.assertEqual(metadata.get_additional_data("IMGVR_1"), "d__Bacteria;p__H")
+        self.assertIsNone(metadata.get_taxonomy("GCF_000001.1"))
+
+
+class TestStreamingReader(TaxprofInputsTestCase):
+    def profiles(self, sylph_result, prefix, **kwargs):
+        self.taxprof(prefix, [str(sylph_result)], **kwargs)
+        return [
+            (Path(self.temp_dir) / f"{prefix}{s}.sylphmpa").read_text()
+            for s in ("s1.fq", "s2.fq")
+        ]
+
+    def test_stream_contiguous(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        self.assertEqual(
+            self.profiles(self.sylph_result, "stream_", stream=True, chunk_rows=2),
+            expected,
+        )
+
+    def test_stream_interleaved_spills(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        lines = self.sylph_result.read_text().splitlines()
+        ### Move s2 between the rows of s1
+        interleaved = Path(self.temp_dir) / "interleaved.tsv"
+        interleaved.write_text("\n".join(lines[:2] + lines[5:] + lines[2:5]) + "\n")
+        self.assertEqual(
+            self.profiles(interleaved, "spill_", stream=True, chunk_rows=2), expected
+        )
+
+    def test_stream_layout_from_accession_scan(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        lines = self.sylph_result.read_text().splitlines()
+        interleaved = Path(self.temp_dir) / "interleaved.tsv"
+        interleaved.write_text("\n".join(lines[:2] + lines[5:] + lines[2:5]) + "\n")
+        ### Metadata without an index is parsed after a scan of the sylph
+        ### result, which also finds its sample layout
+        with patch("sylph_tax.sylph_reader.read_sample_layout", side_effect=AssertionError):
+            for sylph_result, prefix in ((self.sylph_result, "scan_"), (interleaved, "scan_spill_")):
+                self.assertEqual(
+                    self.profiles(sylph_result, prefix, stream=True, chunk_rows=2), expected
+                )
+
+    def test_gzipped_input(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        gzipped = Path(self.temp_dir) / "result.tsv.gz"
+        gzipped.write_bytes(gzip.compress(self.sylph_result.read_bytes()))
+        self.assertEqual(self.profiles(gzipped, "gz_"), expected)
+        self.assertEqual(
+            self.profiles(gzipped, "gz_stream_", stream=True, chunk_rows=2), expected
+        )
+
+    def stdin_profiles(self, data, prefix, **kwargs):
+        stdin = MagicMock()
+        stdin.buffer = io.BytesIO(data)
+        with patch("sys.stdin", stdin):
+            return self.profiles("-", prefix, **kwargs)
+
+    def test_stdin_input(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        data = self.sylph_result.read_bytes()
+        self.assertEqual(self.stdin_profiles(data, "stdin_"), expected)
+        self.assertEqual(
+            self.stdin_profiles(data, "stdin_stream_", stream=True, chunk_rows=2),
+            expected,
+        )
+
+    def test_gzip_detected_by_content(self):
+        expected = self.profiles(self.sylph_result, "full_")
+        data = gzip.compress(self.sylph_result.read_bytes())
+        self.assertEqual(self.stdin_profiles(data, "stdin_gz_"), expected)
+        self.assertEqual(
+            self.stdin_profiles(data, "stdin_gz_stream_", stream=True, chunk_rows=2),
+            expected,
+        )
+        unsuffixed = Path(self.temp_dir) / "result_gzipped.tsv"
+        unsuffixed.write_bytes(data)
+        self.assertEqual(self.profiles(unsuffixed, "unsuffixed_"), expected)
+
+    def test_binary_input_exits_cleanly(self):
+        binary = Path(self.temp_dir) / "result.tsv.zst"
+        binary.write_bytes(b"\x28\xb5\x2f\xfd\xff\xfe\n\x80\x81\n")
+        with self.assertRaises(SystemExit):
+            self.profiles(binary, "binary_")
+
+    def test_stdin_stream_requires_grouped_samples(self):
+        lines = self.sylph_result.read_text().splitlines()
+        interleaved = "\n".join(lines[:2] + lines[5:] + lines[2:5]) + "\n"
+        with self.assertRaises(SystemExit):
+            self.stdin_profiles(interleaved.encode(), "bad_", stream=True, chunk_rows=2)
+
+
+class TestLineageResolver(TestCase):
+    def setUp(self):
+        self.metadata, _ = load_metadata([], None)
+        self.metadata.add_dict(
+            {
+                "GCF_1": "d__A;t__GCF_1",
+                "GCF_1_ASM1_genomic.fna.gz": "d__B;t__GCF_1_ASM1_genomic.fna.gz",
+                "IMGVR_1": "r__V;t__IMGVR_1",
+            },
+            {},
+        )
+
+    def test_trimmed_pass_takes_precedence(self):
+        resolver = LineageResolver(self.metadata)
+        resolution = resolver.resolve("db/GCF_1_ASM1_genomic.fna.gz", "c1")
+        self.assertEqual(resolution.tax_str, "d__B;t__GCF_1_ASM1_genomic.fna.gz")
+        self.assertEqual(resolution.rule, "trimmed:genome_file")
+        resolution = resolver.resolve("db/GCF_1_ASM2_genomic.fna.gz", "c1")
+        self.assertEqual(resolution.rule, "accession:genome_file")
+
+    def test_hits_and_misses_cached(self):
+        resolver = LineageResolver(self.metadata)
+        for _ in range(3):
+            self.assertTrue(resolver.resolve("viruses.fna", "IMGVR_1|a|b").found)
+            resolution = resolver.resolve("other.fna", "c9 desc")
+            self.assertFalse(resolution.found)
+            self.assertEqual(resolution.tax_str, "NO_TAXONOMY;t__other.fna:c9")
+        stats = resolver.stats()
+        self.assertEqual(stats["cache_misses"], 2)
+        self.assertEqual(stats["cache_hits"], 4)
+        self.assertEqual(stats["unresolved"], 1)
+        self.assertEqual(stats["rules"]["accession:contig"], 1)
+        ### Resolved lineages are interned into the run's taxonomy tree
+        node = resolver.resolve("other.fna", "c9 desc").node
+        self.assertEqual(resolver.tree.label[node], "NO_TAXONOMY|t__other.fna:c9")
+
+    def test_keyed_sources(self):
+        from sylph_tax.metadata_loader import CONTIG_KEYED, GENOME_KEYED
+
+        metadata, _ = load_metadata([], None)
+        metadata.add_dict({"GCF_1": "d__A;t__GCF_1"}, {}, GENOME_KEYED)
+        metadata.add_dict({"IMGVR_1": "r__V;t__IMGVR_1", "g": "r__W;t__g"}, {}, CONTIG_KEYED)
+        resolver = LineageResolver(metadata)
+        self.assertEqual(resolver.resolve("db/GCF_1_genomic.fna", "c1").rule, "accession:genome_file")
+        self.assertEqual(resolver.resolve("v.fna", "IMGVR_1|a").rule, "accession:contig")
+        ### Genome file keys are not looked up in contig-keyed sources
+        self.assertFalse(resolver.resolve("g", "c1").found)
+        self.assertEqual(resolver.resolve("x.fna", "g").tax_str, "r__W;t__g")
+        ### Every source is still searched for virus hosts and by get_taxonomy
+        self.assertEqual(metadata.get_taxonomy("g"), "r__W;t__g")
+
+    def test_contig_keyed_metadata_same_resolutions(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            genomes = Path(temp_dir) / "genomes.tsv"
+            genomes.write_text("GCF_1\td__A\n" "g.fna\td__B\n")
+            viruses = Path(temp_dir) / "viruses.tsv"
+            viruses.write_text("IMGVR_1\tr__V\tHOST\n" "IMGVR_2\tr__V;f__F\n")
+            files = [str(genomes), str(viruses)]
+            pairs = [
+                ("db/GCF_1_genomic.fna.gz", "c1 desc"),
+                ("g.fna", "c2"),
+                ("viruses.fna", "IMGVR_1|x|y"),
+                ("viruses.fna", "IMGVR_2 desc"),
+                ("viruses.fna", "IMGVR_3|x"),
+            ]
+            resolutions = []
+            for contig_keyed in (None, [str(viruses)]):
+                metadata, _ = load_metadata(files, None, contig_keyed=contig_keyed)
+                resolver = LineageResolver(metadata)
+                resolutions.append([resolver.resolve(g, c)[:5] for g, c in pairs])
+                self.assertEqual(metadata.get_additional_data("IMGVR_1"), "HOST")
+            self.assertEqual(resolutions[0], resolutions[1])
+            self.assertEqual(len(metadata.taxonomy_sources), 2)
+            with self.assertRaises(SystemExit):
+                load_metadata(files[:1], None, contig_keyed=files[1:])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestAggregateClades(TestCase):
+    def test_lineage_clades(self):
+        self.assertEqual(
+            lineage_clades("d__A;;s__B;t__x"),
+            ["d__A", "d__A|UNKNOWN", "d__A|UNKNOWN|s__B", "d__A|UNKNOWN|s__B|t__x"],
+        )
+
+    def test_matches_row_by_row_sums(self):
+        tax_strs = [
+            "d__A;p__B;t__1",
+            "d__A;p__C;t__2",
+            "d__A;p__B;t__3",
+            "NO_TAXONOMY;t__g.fna:IMGVR_1|x|y",
+            "d__A;p__B;t__1",
+            "d__D;;t__4",
+        ]
+        rel = [0.1, 0.2, 0.7, 0.3, 0.05, 0.2]
+        seq = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+        ani = [99.0, 98.0, 97.0, 96.0, 95.0, 94.0]
+        cov = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+        profile = aggregate_clades(tax_strs, rel, seq, ani, cov)
+
+        expected = dict()
+        for i, tax_str in enumerate(tax_strs):
+            for clade in lineage_clades(tax_str):
+                expected[clade] = expected.get(clade, 0.0) + rel[i]
+        self.assertEqual(
+            dict(zip(profile.clades, profile.tax_abundance.tolist())), expected
+        )
+        self.assertEqual(profile.clades[:3], ["d__A", "NO_TAXONOMY", "d__D"])
+        ### Ties at a level keep first-seen order
+        self.assertEqual(profile.clades[3:6], ["d__A|p__B", "d__A|p__C", "d__D|UNKNOWN"])
+        ### The clade containing pipes in the contig name sorts by its '|' count
+        self.assertEqual(profile.clades[-1], "NO_TAXONOMY|t__g.fna:IMGVR_1|x|y")
+
+        by_clade = {c: i for i, c in enumerate(profile.clades)}
+        ### Last row wins for strain-level ANI
+        self.assertEqual(profile.ani[by_clade["d__A|p__B|t__1"]], 95.0)
+        self.assertTrue(np.isnan(profile.ani[by_clade["d__A|p__B"]]))
+
+
+class TestTaxonomyTree(TestCase):
+    def test_prefixes_interned_once(self):
+        tree = TaxonomyTree()
+        a = tree.intern("d__A;;s__B;t__x")
+        b = tree.intern("d__A;UNKNOWN;s__B;t__y")
+        self.assertEqual(len(tree), 5)
+        self.assertEqual(tree.labels(tree.path(a)), lineage_clades("d__A;;s__B;t__x"))
+        self.assertEqual(tree.parent[a], tree.parent[b])
+        self.assertEqual(tree.depth[b], 4)
+        self.assertTrue(tree.strain[a])
+        self.assertFalse(tree.strain[tree.parent[a]])
+        self.assertEqual(tree.intern("d__A;;s__B;t__x"), a)
+
+    def test_shared_tree_keeps_sample_tie_order(self):
+        ### Node ids are run-wide, but ties within a sample still follow the
+        ### order in which that sample's rows reach each clade
+        tree = TaxonomyTree()
+        first = [tree.intern(t) for t in ("d__A;t__1", "d__B;t__2")]
+        second = [tree.intern(t) for t in ("d__B;t__2", "d__A;t__1")]
+        profile = aggregate_nodes(tree, second, [0.5, 0.5], [1.0, 1.0], [99.0, 98.0], [1.0, 2.0])
+        self.assertEqual(profile.clades[:2], ["d__B", "d__A"])
+        expected = aggregate_clades(
+            ["d__B;t__2", "d__A;t__1"], [0.5, 0.5], [1.0, 1.0], [99.0, 98.0], [1.0, 2.0]
+        )
+        self.assertEqual(profile.clades, expected.clades)
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(first, second[::-1])
+
+
+def write_profile(path, sample, rows):
+    header = "clade_name\trelative_abundance\tsequence_abundance\tANI (if strain-level)\tCoverage (if strain-level)\n"
+    Path(path).write_text(
+        f"#SampleID\t{sample}\tTaxonomies_used:['x']\n"
+        + header
+        + "".join("\t".join(map(str, r)) + "\n" for r in rows)
+    )
+    return str(path)
+
+
+class TestMerge(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        d = Path(self.temp_dir)
+        self.a = write_profile(
+            d / "a.sylphmpa",
+            "a.fq",
+            [("d__B", 60.0, 50.0, "NA", "NA"), ("d__A", 40.0, 50.0, "NA", "NA"),
+             ("d__A|t__1", 40.0, 50.0, 99.0, 2.0)],
+        )
+        self.b = write_profile(
+            d / "b.sylphmpa", "b.fq", [("d__C", 100.0, 100.0, "NA", "NA")]
+        )
+        self.empty = write_profile(d / "e.sylphmpa", "e.fq", [])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_single_file_keeps_order(self):
+        merged = merge_data([self.a], "relative_abundance")
+        self.assertEqual(merged.index.tolist(), ["d__B", "d__A", "d__A|t__1"])
+
+    def test_values_parsed_as_before(self):
+        ### The default pandas parser reads this as 12.1298, which merge has always written
+        c = write_profile(
+            Path(self.temp_dir) / "c.sylphmpa", "c.fq", [("d__A", "12.129800000000001", 100.0, "NA", "NA")]
+        )
+        merged = merge_data([c], "relative_abundance")
+        self.assertEqual(merged.loc["d__A"].tolist(), [12.1298])
+
+    def test_outer_merge_sorted_and_filled(self):
+        merged = merge_data([self.a, self.empty, self.b], "relative_abundance")
+        self.assertEqual(merged.columns.tolist(), ["a.fq", "e.fq", "b.fq"])
+        self.assertEqual(merged.index.tolist(), ["d__A", "d__A|t__1", "d__B", "d__C"])
+        self.assertEqual(merged.loc["d__C"].tolist(), [0.0, 0.0, 100.0])
+
+    def test_all_missing_rows_dropped(self):
+        merged = merge_data([self.a, self.b], "ANI")
+        self.assertEqual(merged.index.tolist(), ["d__A|t__1"])
+        self.assertEqual(merged.loc["d__A|t__1"].tolist(), [99.0, 0.0])
+
+    def test_all_columns_single_pass(self):
+        files = [self.a, self.empty, self.b]
+        columns = requested_columns(["all"])
+        self.assertEqual(
+            columns, ["relative_abundance", "sequence_abundance", "ANI", "Coverage"]
+        )
+        builders = build_matrices(files, columns)
+        for column in columns:
+            pd.testing.assert_frame_equal(
+                builders[column].to_dataframe(), merge_data(files, column)
+            )
+
+    def test_sparse_formats_match_dense(self):
+        files = [self.a, self.empty, self.b]
+        dense = merge_data(files, "relative_abundance")
+        builder = build_matrix(files, "relative_abundance")
+        out = str(Path(self.temp_dir) / "merged")
+
+        write_merged(builder, out + ".mtx", "mtx", "relative_abundance")
+        lines = Path(out + ".mtx").read_text().splitlines()
+        self.assertEqual(lines[1], f"{dense.shape[0]} {dense.shape[1]} 4")
+        clades = Path(out + ".mtx.clades.txt").read_text().splitlines()
+        samples = Path(out + ".mtx.samples.txt").read_text().splitlines()
+        self.assertEqual(clades, dense.index.tolist())
+        self.assertEqual(samples, dense.columns.tolist())
+        for line in lines[2:]:
+            r, c, v = line.split()
+            self.assertEqual(dense.iat[int(r) - 1, int(c) - 1], float(v))
+
+        write_merged(builder, out + ".biom", "biom", "relative_abundance")
+        biom = json.loads(Path(out + ".biom").read_text())
+        self.assertEqual(biom["shape"], list(dense.shape))
+        self.assertEqual([r["id"] for r in biom["rows"]], dense.index.tolist())
+        for r, c, v in biom["data"]:
+            self.assertEqual(dense.iat[r, c], v)
+
+        write_merged(builder, out + ".long.tsv", "long", "relative_abundance")
+        long_df = pd.read_csv(out + ".long.tsv", sep="\t")
+        self.assertEqual(len(long_df), 4)
+        pivot = long_df.pivot(index="clade_name", columns="sample", values="relative_abundance")
+        self.assertEqual(pivot.loc["d__C", "b.fq"], 100.0)
+
+    def test_default_output_follows_format(self):
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            for fmt in ("mtx", "biom"):
+                merge_main(
+                    argparse.Namespace(files=[self.a, self.b], column=["relative_abundance"], format=fmt, output=None),
+                    None,
+                )
+                self.assertTrue(os.path.exists(f"merged_data.{fmt}"))
+            self.assertFalse(os.path.exists("merged_data.tsv"))
+        finally:
+            os.chdir(cwd)
+
+    def merge(self, files, column, output, update=None, manifest=False):
+        merge_main(
+            argparse.Namespace(files=files, column=column, format="tsv", output=output, update=update, manifest=manifest),
+            None,
+        )
+
+    def test_update_matches_full_merge(self):
+        d = Path(self.temp_dir)
+        for column in (["relative_abundance"], ["ANI"], ["all"]):
+            self.merge([self.a, self.empty, self.b], column, str(d / "full.tsv"))
+            self.merge([self.a], column, str(d / "inc.tsv"), manifest=True)
+            self.merge([self.empty, self.b], column, None, update=str(d / "inc.tsv"))
+            for full, inc in zip(
+                sorted(d.glob("full*.tsv")), sorted(d.glob("inc*.tsv"))
+            ):
+                self.assertEqual(full.read_text(), inc.read_text(), column)
+            manifest = json.loads((d / "inc.tsv.manifest.json").read_text())
+            self.assertEqual(manifest["samples"], ["a.fq", "e.fq", "b.fq"])
+            self.assertEqual(len(manifest["files"]), 3)
+            for f in d.glob("*.tsv*"):
+                f.unlink()
+
+    def test_update_skips_merged_files(self):
+        d = Path(self.temp_dir)
+        out = str(d / "merged.tsv")
+        self.merge([self.a, self.b], ["relative_abundance"], out, manifest=True)
+        expected = Path(out).read_text()
+
+        ### Already merged files, also when copied elsewhere, are not read again
+        copy = d / "copy_of_b.sylphmpa"
+        copy.write_text(Path(self.b).read_text())
+        self.merge([self.a, str(copy)], ["relative_abundance"], None, update=out)
+        self.assertEqual(Path(out).read_text(), expected)
+
+        ### A changed file of a merged sample needs a full merge
+        changed = write_profile(d / "b2.sylphmpa", "b.fq", [("d__C", 90.0, 90.0, "NA", "NA")])
+        with self.assertRaises(SystemExit):
+            self.merge([changed], ["relative_abundance"], None, update=out)
+        self.assertEqual(Path(out).read_text(), expected)
+
+        ### Without a manifest, new files are merged by sample name
+        os.unlink(out + ".manifest.json")
+        self.merge([self.empty], ["relative_abundance"], None, update=out)
+        self.merge([self.a, self.b, self.empty], ["relative_abundance"], str(d / "full.tsv"))
+        self.assertEqual(Path(out).read_text(), (d / "full.tsv").read_text())
+
+    def test_manifest_only_on_request(self):
+        d = Path(self.temp_dir)
+        self.merge([self.a, self.b], ["relative_abundance"], str(d / "merged.tsv"))
+        self.assertFalse((d / "merged.tsv.manifest.json").exists())
+        self.merge([self.a, self.b], ["relative_abundance"], str(d / "merged.tsv"), manifest=True)
+        manifest = json.loads((d / "merged.tsv.manifest.json").read_text())
+        self.assertEqual(manifest["samples"], ["a.fq", "b.fq"])
+
+    def test_edited_copy_not_merged(self):
+        from sylph_tax.merge_sylph_taxprof import file_entry, new_files
+
+        ### Multi-member gzip, like consolidated profiles: an edit in the
+        ### first member leaves the size and the last trailer unchanged
+        d = Path(self.temp_dir)
+        payload = bytearray(os.urandom(3 << 20))
+
+        def write(path):
+            path.write_bytes(
+                gzip.compress(bytes(payload), compresslevel=0, mtime=0)
+                + gzip.compress(b"tail\n", mtime=0)
+            )
+            return str(path)
+
+        entries = [file_entry(write(d / "a.sylphmpa.gz"))]
+        payload[3 << 19] ^= 1
+        edited = write(d / "edited.sylphmpa.gz")
+        self.assertEqual(new_files([edited], entries)[0], [edited])
+
+
 if __name__ == "__main__":
     main()
 